@@ -12,7 +12,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import pkg_resources
+import os
 
 from cudet import utils
 
@@ -35,8 +35,9 @@ class CudetConfig(object):
             self._update_config_by_args(args)
 
     def _init_default_config(self):
-        default_config_file = pkg_resources.resource_filename(
-            'cudet',
+        # installed along with the package, see MANIFEST.in
+        default_config_file = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
             DEFAULT_CONFIG_FILE)
         self.config = utils.load_yaml_file(default_config_file)
 
@@ -56,6 +57,17 @@ class CudetConfig(object):
         if node_ids is not None:
             self.config['filters']['id'] = node_ids
 
+        if getattr(args, 'offline', None) is not None:
+            # the inventory and data of the last run are needed
+            self.config['clean'] = False
+
+        if getattr(args, 'resume', False):
+            # the data of the last run is needed
+            self.config['clean'] = False
+
+        if getattr(args, 'force_md5', False):
+            self.config['md5_verify']['force'] = True
+
     def _update_by_config_file(self, config_file):
         additional_config = utils.load_yaml_file(config_file)
         self.config.update(additional_config)
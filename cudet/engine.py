@@ -0,0 +1,280 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Single process data collection engine
+"""
+
+import logging
+import os
+import resource
+import select
+import signal
+import subprocess
+import time
+
+from cudet import utils
+from cudet.limiter import SSH_FAILURE
+
+
+logger = logging.getLogger(__name__)
+
+# file descriptors kept free for everything except node sessions
+RESERVED_FDS = 64
+# seconds a job killed by timeout has to exit before it gets SIGKILL
+KILL_GRACE = 5
+
+
+class NodeSession(object):
+    """State of a node being collected by PollEngine"""
+
+    def __init__(self, node, jobs):
+        self.node = node
+        self.jobs = jobs
+        self.queue = list(jobs)
+        self.job = None
+        self.proc = None
+        self.errs = []
+        self.eof = False
+        self.killed = False
+        self.deadline = None
+        self.started = None
+        # when a job which failed to connect is started again
+        self.retry_at = None
+
+
+class PollEngine(object):
+    """Collects data from all nodes without a worker process per node
+
+    Every node runs its jobs one after another, but all nodes are driven
+    from a single poll loop: each job's command is started as a subprocess
+    writing straight into the job's output file, stderr is read from a
+    non-blocking pipe, and jobs running longer than the node's timeout are
+    killed. A job which fails to connect is put back at the head of the
+    node's queue and started again once its retry delay has passed. Memory
+    and PIDs per node in flight are those of the ssh client only.
+    """
+
+    def __init__(self, max_sessions=1000, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_sessions = self._check_fd_limit(max_sessions)
+        self.poller = None
+        self.fds = {}
+        self.devnull = None
+        self.limiter = None
+        self.ok_codes = None
+
+    def _check_fd_limit(self, max_sessions):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = max_sessions + RESERVED_FDS
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            if hard == resource.RLIM_INFINITY or hard >= needed:
+                soft = needed
+            else:
+                soft = hard
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            max_sessions = max(1, soft - RESERVED_FDS)
+            self.logger.warning('open files limit is %d, running at most '
+                                '%d nodes at a time' % (soft, max_sessions))
+        return max_sessions
+
+    def _start_job(self, session):
+        """Starts the next job of a session, returns False if none is left"""
+        node = session.node
+        while session.queue:
+            job = session.queue.pop(0)
+            try:
+                cmd = node.get_job_cmd(job)
+                self.logger.info('launching cmd %s' % cmd)
+                with open(job['dfile'], 'w') as df:
+                    proc = subprocess.Popen(cmd,
+                                            shell=True,
+                                            stdin=self.devnull,
+                                            stdout=df,
+                                            stderr=subprocess.PIPE)
+            except (IOError, OSError) as e:
+                node.logger.error("can't run %s on node %s: %s" %
+                                  (job['label'], node.id, e))
+                node.fail_job(job, "can't run %s: %s" % (job['label'], e),
+                              self.ok_codes)
+                continue
+            session.job = job
+            session.proc = proc
+            session.errs = []
+            session.eof = False
+            session.killed = False
+            session.started = time.time()
+            session.deadline = session.started + job['args']['timeout']
+            fd = proc.stderr.fileno()
+            self.fds[fd] = session
+            self.poller.register(fd, select.POLLIN)
+            return True
+        return False
+
+    @staticmethod
+    def _timing(session, code):
+        try:
+            stdout_bytes = os.path.getsize(session.job['dfile'])
+        except OSError:
+            stdout_bytes = 0
+        return {'runtime': time.time() - session.started,
+                'exit_code': code,
+                'stdout_bytes': stdout_bytes,
+                'stderr_bytes': sum([len(d) for d in session.errs])}
+
+    def _read(self, fd):
+        session = self.fds[fd]
+        data = os.read(fd, 65536)
+        if data:
+            session.errs.append(data)
+            return
+        self.poller.unregister(fd)
+        del self.fds[fd]
+        session.proc.stderr.close()
+        session.eof = True
+
+    def _timeout(self, sessions):
+        """Returns poll timeout in milliseconds"""
+        if not sessions:
+            return None
+        if any(s.eof for s in sessions):
+            return 50
+        delay = min([s.retry_at if s.proc is None else s.deadline
+                     for s in sessions]) - time.time()
+        return max(0, int(delay * 1000)) + 1
+
+    def _finished(self, node, result):
+        if self.limiter is not None:
+            self.limiter.release(node.ip, result)
+        return node, result
+
+    def run(self, nodes, ok_codes=None, limiter=None):
+        """Runs the jobs of all nodes
+
+        :param limiter: optional limiter.AdaptiveLimiter keyed by node ip,
+                        which further limits how many nodes run at a time
+
+        Yields (node, (mapcmds, mapscr, timings)) pairs in completion
+        order. An exception raised while handling a node is yielded as its
+        result.
+        """
+        queued = time.time()
+        self.poller = select.poll()
+        self.fds = {}
+        self.devnull = open(os.devnull, 'r')
+        self.limiter = limiter
+        self.ok_codes = ok_codes
+        waiting = list(nodes)
+        waiting.reverse()
+        running = []
+        try:
+            while waiting or running:
+                while waiting and len(running) < self.max_sessions:
+                    if limiter is None:
+                        node = waiting.pop()
+                    else:
+                        node = limiter.pop(waiting, lambda n: n.ip)
+                        if node is None:
+                            break
+                    try:
+                        node.reset_timings(queued)
+                        session = NodeSession(node, node.get_jobs())
+                        started = self._start_job(session)
+                    except Exception as e:
+                        yield self._finished(node, e)
+                        continue
+                    if started:
+                        running.append(session)
+                    else:
+                        yield self._finished(node,
+                                             node.get_result(session.jobs))
+                for fd, event in self.poller.poll(self._timeout(running)):
+                    self._read(fd)
+                now = time.time()
+                for session in list(running):
+                    node = session.node
+                    proc = session.proc
+                    if proc is None:
+                        if now < session.retry_at:
+                            continue
+                        try:
+                            if self._start_job(session):
+                                continue
+                            result = node.get_result(session.jobs)
+                        except Exception as e:
+                            result = e
+                        running.remove(session)
+                        yield self._finished(node, result)
+                    elif session.eof and proc.poll() is not None:
+                        errs = ''.join(session.errs)
+                        errs = errs.decode('utf-8', 'replace').rstrip('\n')
+                        if self.logger.isEnabledFor(logging.DEBUG):
+                            self.logger.debug(
+                                ('___command: %s\n'
+                                 '_exit_code: %s\n'
+                                 '____stdout: %s\n'
+                                 '____stderr: %s') %
+                                (node.get_job_cmd(session.job),
+                                 proc.returncode,
+                                 utils.file_preview(session.job['dfile']),
+                                 errs))
+                        job = session.job
+                        code = proc.returncode
+                        timing = self._timing(session, code)
+                        try:
+                            delay = node.get_retry_delay(job, code)
+                            if delay is not None:
+                                session.queue.insert(0, job)
+                                session.proc = None
+                                session.retry_at = now + delay
+                                continue
+                            node.job_done(job, errs, code, ok_codes, timing)
+                            if job.get('connect') and code == SSH_FAILURE:
+                                node.skip_jobs(session.queue)
+                                session.queue = []
+                            if self._start_job(session):
+                                continue
+                            result = node.get_result(session.jobs)
+                        except Exception as e:
+                            result = e
+                        running.remove(session)
+                        yield self._finished(node, result)
+                    elif now > session.deadline:
+                        # a deadline in the past would make poll return
+                        # at once until the job is reaped
+                        session.deadline = now + KILL_GRACE
+                        try:
+                            if session.killed:
+                                os.kill(proc.pid, signal.SIGKILL)
+                            else:
+                                os.kill(proc.pid, signal.SIGTERM)
+                                self.logger.error('pid %d killed by timeout'
+                                                  % proc.pid)
+                        except OSError:
+                            pass
+                        session.killed = True
+        finally:
+            for session in running:
+                if session.proc is not None and session.proc.poll() is None:
+                    try:
+                        session.proc.kill()
+                    except OSError:
+                        pass
+            for session in self.fds.values():
+                # closed through the file object, which would close the fd
+                # again when collected
+                session.proc.stderr.close()
+            self.fds = {}
+            self.devnull.close()
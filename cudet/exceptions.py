@@ -29,3 +29,17 @@ class AllNodesFiltered(CudetBaseException):
     Indicates that there are no nodes which have been passed filtration
     """
     pass
+
+
+class ProcessTerminated(CudetBaseException):
+    """
+    Indicates that a worker process exited without returning a result
+    """
+    pass
+
+
+class FuelAPIError(CudetBaseException):
+    """
+    Indicates that the Fuel API returned an error
+    """
+    pass
@@ -18,30 +18,53 @@
 Working with fuel client as a library
 """
 
+import httplib
+import json
 import logging
+import socket
+import threading
 
-try:
-    from fuelclient.client import Client as FuelClient
-except ImportError:
-    try:
-        from fuelclient.client import APIClient as FuelClient
-    except ImportError:
-        FuelClient = None
+from cudet import exceptions
+from cudet import utils
 
-if FuelClient is not None:
-    from fuelclient import fuelclient_settings
 
-    # LP bug 1592445
+logger = logging.getLogger(__name__)
+
+# fuelclient Client class and settings module, see import_fuelclient
+_FUELCLIENT = None
+
+
+def import_fuelclient():
+    """Imports fuelclient on first use, it is slow to import
+
+    :returns: the fuelclient Client class (APIClient in older versions) and
+              the fuelclient_settings module, None and None if fuelclient
+              is not installed
+    """
+    global _FUELCLIENT
+    if _FUELCLIENT is not None:
+        return _FUELCLIENT
     try:
-        from fuelclient.client import logger
-        logger.handlers = []
-    except:
-        pass
+        from fuelclient.client import Client as FuelClient
+    except ImportError:
+        try:
+            from fuelclient.client import APIClient as FuelClient
+        except ImportError:
+            FuelClient = None
 
-from cudet import utils
+    fuelclient_settings = None
+    if FuelClient is not None:
+        from fuelclient import fuelclient_settings
 
+        # LP bug 1592445
+        try:
+            from fuelclient.client import logger as fuelclient_logger
+            fuelclient_logger.handlers = []
+        except:
+            pass
 
-logger = logging.getLogger(__name__)
+    _FUELCLIENT = (FuelClient, fuelclient_settings)
+    return _FUELCLIENT
 
 
 def get_client(config):
@@ -52,6 +75,7 @@ def get_client(config):
     """
 
     client = None
+    FuelClient, fuelclient_settings = import_fuelclient()
 
     if FuelClient is not None:
         with utils.environ_settings(http_proxy=config.fuel_http_proxy,
@@ -82,3 +106,82 @@ def get_client(config):
         logger.info('Fuelclient can not be imported')
 
     return client
+
+
+class FuelSession(object):
+    """Keep-alive connections to the Fuel API shared by concurrent requests
+
+    GET requests go straight to Nailgun over a pool of persistent HTTP
+    connections: a request takes an idle connection or opens a new one and
+    puts it back when done, so concurrent requests open one connection
+    each and later requests reuse them. The keystone token is taken from
+    the fuelclient instance once. When a proxy is configured, or a request
+    fails, fuelclient's own get_request is used instead.
+    """
+
+    api_path = '/api/v1/'
+
+    def __init__(self, client, config, timeout=60):
+        self.client = client
+        self.host = config.fuel_ip
+        self.port = int(config.fuel_port)
+        self.proxy = config.fuel_http_proxy
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.token = None
+
+    def get_token(self):
+        with self.lock:
+            if self.token is None:
+                self.token = getattr(self.client, 'auth_token', None) or ''
+            return self.token
+
+    def _connection(self):
+        """Returns an idle connection or a new one, and if it was idle"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout), False
+
+    def _get(self, api, headers):
+        conn, reused = self._connection()
+        try:
+            conn.request('GET', self.api_path + api, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # the server has closed the idle connection meanwhile
+            return self._get(api, headers)
+        with self.lock:
+            self.idle.append(conn)
+        if response.status != 200:
+            raise exceptions.FuelAPIError('GET %s: %s %s' %
+                                          (api, response.status,
+                                           response.reason))
+        return json.loads(body)
+
+    def get_request(self, api):
+        """Returns the decoded JSON response of GET /api/v1/<api>"""
+        if self.proxy:
+            return self.client.get_request(api)
+        try:
+            headers = {'Accept': 'application/json'}
+            token = self.get_token()
+            if token:
+                headers['X-Auth-Token'] = token
+            return self._get(api, headers)
+        except Exception as e:
+            logger.info('GET %s failed, retrying with fuelclient: %s' %
+                        (api, e))
+            return self.client.get_request(api)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
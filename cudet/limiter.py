@@ -0,0 +1,199 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Concurrency control for data collection
+"""
+
+import logging
+
+# exit code of ssh when it fails to connect
+SSH_FAILURE = 255
+
+
+class AdaptiveLimiter(object):
+    """Decides how many nodes are collected at a time
+
+    The limit starts at `initial` and doubles every round (every `limit`
+    finished nodes) while node latency stays flat, as TCP slow start does.
+    Once a node takes more than `latency_factor` times the best latency seen
+    so far, or fails to connect, the limit is multiplied by `backoff` and
+    then grows by one node per round only. Decreases happen at most once
+    per round, so a burst of slow nodes counts as a single event.
+
+    Latency of a node is the time of its connect step when connections are
+    multiplexed, the mean runtime of its jobs otherwise. Latencies below
+    `min_latency` seconds are taken as `min_latency`, so that jitter of fast
+    nodes is not seen as a latency rise.
+
+    Caps are enforced independently of the limit: at most `per_cluster`
+    nodes of the same cluster, and at most per_role[role] nodes having a
+    given role, are collected at a time. A cap of 0 means no cap. With
+    adaptive set to False only the caps and `maximum` are enforced.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=100, adaptive=True,
+                 latency_factor=2.0, backoff=0.5, per_cluster=0,
+                 per_role=None, alpha=0.3, min_latency=0.2, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.adaptive = adaptive
+        if adaptive:
+            self.limit = min(max(initial, self.minimum), self.maximum)
+        else:
+            self.limit = self.maximum
+        self.threshold = self.maximum
+        self.latency_factor = latency_factor
+        self.backoff = backoff
+        self.per_cluster = per_cluster
+        self.per_role = per_role or {}
+        self.alpha = alpha
+        self.min_latency = min_latency
+        self.baseline = None
+        self.latency = None
+        self.finished = 0
+        self.increased_at = None
+        self.decreased_at = None
+        self.groups = {}
+        self.running = {}
+        self.group_running = {}
+
+    @classmethod
+    def from_conf(cls, conf, maximum, logger=None):
+        return cls(initial=conf.concurrency_initial,
+                   minimum=conf.concurrency_min,
+                   maximum=min(conf.concurrency_max, maximum),
+                   adaptive=conf.concurrency_adaptive,
+                   latency_factor=conf.concurrency_latency_factor,
+                   backoff=conf.concurrency_backoff,
+                   per_cluster=conf.concurrency_per_cluster,
+                   per_role=conf.concurrency_per_role,
+                   logger=logger)
+
+    def register(self, key, cluster, roles):
+        """Makes the caps of a node known to the limiter"""
+        groups = []
+        if self.per_cluster:
+            groups.append((('cluster', cluster), self.per_cluster))
+        for role in roles or []:
+            if self.per_role.get(role):
+                groups.append((('role', role), self.per_role[role]))
+        self.groups[key] = groups
+
+    def admit(self, key):
+        """Returns True and counts the node as running if it may start"""
+        if len(self.running) >= self.limit:
+            return False
+        groups = self.groups.get(key, [])
+        for group, cap in groups:
+            if self.group_running.get(group, 0) >= cap:
+                return False
+        for group, cap in groups:
+            self.group_running[group] = self.group_running.get(group, 0) + 1
+        self.running[key] = groups
+        return True
+
+    def pop(self, items, key):
+        """Removes and returns the last item of a list which may start
+
+        key(item) gives the item's node key. Returns None if no item may
+        start right now.
+        """
+        if len(self.running) >= self.limit:
+            return None
+        for index in range(len(items) - 1, -1, -1):
+            if self.admit(key(items[index])):
+                return items.pop(index)
+        return None
+
+    def release(self, key, result):
+        """Stops counting a node as running and adapts the limit
+
+        result is what data collection returned for the node, an exception
+        if it failed.
+        """
+        for group, cap in self.running.pop(key, []):
+            self.group_running[group] -= 1
+        self.finished += 1
+        if not self.adaptive:
+            return
+        latency, failed = self.measure(result)
+        if failed:
+            self.decrease('ssh connect failed on %s' % key)
+            return
+        if latency is None:
+            return
+        latency = max(latency, self.min_latency)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        if self.latency > self.baseline * self.latency_factor:
+            self.decrease('latency %.2fs, baseline %.2fs' %
+                          (self.latency, self.baseline))
+        else:
+            self.increase()
+
+    @staticmethod
+    def measure(result):
+        """Returns (latency, failed) of a node's collection result"""
+        if isinstance(result, Exception):
+            return None, True
+        timings = result[2]
+        if timings.get('connect_code') == SSH_FAILURE:
+            return None, True
+        if timings.get('retries'):
+            # connected in the end, but only after a failure
+            return None, True
+        jobs = timings.get('jobs', [])
+        if any([j['exit_code'] == SSH_FAILURE for j in jobs]):
+            return None, True
+        if timings.get('connect') is not None:
+            return timings['connect'], False
+        runtimes = [j['runtime'] for j in jobs if j['runtime'] is not None]
+        if not runtimes:
+            return None, False
+        return sum(runtimes) / len(runtimes), False
+
+    def _round_passed(self, since):
+        return since is None or self.finished - since >= self.limit
+
+    def increase(self):
+        if self.limit >= self.maximum:
+            return
+        if self.limit < self.threshold:
+            # slow start, doubles the limit every round
+            new_limit = self.limit + 1
+        elif self._round_passed(self.increased_at):
+            new_limit = self.limit + 1
+            self.increased_at = self.finished
+        else:
+            return
+        self.logger.info('concurrency %d -> %d' % (self.limit, new_limit))
+        self.limit = new_limit
+
+    def decrease(self, reason):
+        if not self._round_passed(self.decreased_at):
+            return
+        self.decreased_at = self.finished
+        self.increased_at = self.finished
+        new_limit = max(self.minimum, int(self.limit * self.backoff))
+        self.threshold = new_limit
+        if new_limit != self.limit:
+            self.logger.warning('concurrency %d -> %d: %s' %
+                                (self.limit, new_limit, reason))
+        self.limit = new_limit
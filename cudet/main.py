@@ -17,19 +17,19 @@
 
 import argparse
 import csv
-import hashlib
 import logging
 import os
 import re
-import sqlite3
 import sys
-import urllib2
-import yaml
 
 from cudet import configuration
 from cudet import nodes
+from cudet import utils
+from cudet import versions_db
+from cudet import versions_sync
 from cudet.utils import interrupt_wrapper
 from cudet.vercmp import vercmp
+from cudet.versions_db import print_mu
 
 
 logger = logging.getLogger()
@@ -47,26 +47,7 @@ class Unbuffered(object):
         return getattr(self.stream, attr)
 
 
-def load_versions_dict(conf, nm):
-    def fetch(url):
-        try:
-            return urllib2.urlopen(url).read()
-        except:
-            return None
-
-    def online(release, os_platform, ext):
-        url = ('http://mirror.fuel-infra.org/mcv/mos/%s/'
-               '%s-latest.%s' % (release, os_platform, ext))
-        return fetch(url)
-
-    def update_db(db_file, release, os_platform):
-        ext_db = online(release, os_platform, 'sqlite')
-        if ext_db:
-            open(db_file, 'w').write(ext_db)
-        else:
-            return False
-        return True
-
+def load_versions_db(conf, nm):
     msg_newer_ok = ('a newer versions db for MOS %s %s was found online '
                     'and successfully downloaded.')
     msg_newer_unkn = ('could not check for versions db updates for '
@@ -79,7 +60,8 @@ def load_versions_dict(conf, nm):
                      'download from a mirror - this node will be skipped!')
     db_dir = os.path.join(conf['cudet_db_dir'], 'versions')
     dbs = {}
-    db_files = set()
+    versions = versions_db.VersionsIndex(conf['versions_backend'],
+                                         conf['versions_cache_dir'])
     output = {}
     for node in nm.nodes.values():
         r = node.release
@@ -100,101 +82,33 @@ def load_versions_dict(conf, nm):
             dbs[r][p]['dir'] = os.path.join(db_dir, r)
         if 'file' not in dbs[r][p]:
             dbs[r][p]['file'] = os.path.join(db_dir, r, '%s.sqlite' % p)
+    messages = {versions_sync.UPDATED: msg_newer_ok,
+                versions_sync.UNKNOWN: msg_newer_unkn,
+                versions_sync.UPDATE_FAILED: msg_newer_fail,
+                versions_sync.DOWNLOADED: msg_nodb_ok,
+                versions_sync.MISSING: msg_nodb_fail}
+    checks = []
     for r in dbs:
         for p in dbs[r]:
             d = dbs[r][p]['dir']
-            f = dbs[r][p]['file']
             if not os.path.isdir(d):
                 os.makedirs(d)
-            if f in db_files:
-                continue
-            if os.path.isfile(f):
-                ext_md5 = online(r, p, 'md5')
-                if ext_md5:
-                    ext_md5 = ext_md5.rstrip('\n')
-                    int_db = open(f, 'rb').read()
-                    int_md5 = hashlib.md5(int_db).hexdigest()
-                    if ext_md5 != int_md5:
-                        if update_db(f, r, p):
-                            for n in dbs[r][p]['nodes']:
-                                output_add(output, n, msg_newer_ok % (r, p))
-                        else:
-                            for n in dbs[r][p]['nodes']:
-                                output_add(output, n, msg_newer_fail % (r, p))
-                else:
-                    for n in dbs[r][p]['nodes']:
-                        output_add(output, n, msg_newer_unkn % (r, p))
-                db_files.add(f)
-            else:
-                if update_db(f, r, p):
-                    for n in dbs[r][p]['nodes']:
-                        output_add(output, n, msg_nodb_ok % (r, p))
-                    db_files.add(f)
-                else:
-                    for n in dbs[r][p]['nodes']:
-                        output_add(output, n, msg_nodb_fail % (r, p))
-    versions_dict = {}
-    for db_file in db_files:
-        import_db = sqlite3.connect(db_file)
-        import_dbc = import_db.cursor()
-        r = import_dbc.execute('''
-            SELECT
-                id,
-                job_id,
-                release,
-                mu,
-                os,
-                package_name,
-                package_version,
-                package_filename
-            FROM versions
-            ORDER BY package_name ASC, mu DESC
-            ''')
-        for row in r.fetchall():
-            release = row[2]
-            mu = row[3]
-            os_platform = row[4]
-            p_name = row[5]
-            p_version = row[6]
-            if release not in versions_dict:
-                versions_dict[release] = {}
-            vdr = versions_dict[release]
-            if os_platform not in vdr:
-                vdr[os_platform] = {}
-            if p_name not in vdr[os_platform]:
-                vdr[os_platform][p_name] = {}
-            p_dict = vdr[os_platform][p_name]
-            if 'mu' not in p_dict:
-                p_dict['mu'] = set()
-            p_dict['mu'].add(mu)
-            if 'versions' not in p_dict:
-                p_dict['versions'] = {}
-            if p_version not in p_dict['versions']:
-                p_dict['versions'][p_version] = set()
-            if 'max_version' not in p_dict:
-                p_dict['max_version'] = p_version
-            else:
-                r = vercmp(os_platform, p_version, p_dict['max_version'])
-                max_v_mus = p_dict['versions'][p_dict['max_version']]
-                if r > 0 and mu not in max_v_mus:
-                    '''Should never happen since the MU order is DESC.
-                    If this happens then it means that package version was
-                    lowered in a subsequent MU, which is against our policy as
-                    of Feb 2016.'''
-                    logging.warning('Downgrade detected in release '
-                                    '%s, os %s, %s to %s, package %s - '
-                                    "version '%s' was downgraded to '%s'\n"
-                                    % (release, os_platform, print_mu(mu),
-                                       print_mu(min(max_v_mus)), p_name,
-                                       p_version, p_dict['max_version']))
-                elif r > 0:
-                    p_dict['max_version'] = p_version
-            p_dict['versions'][p_version].add(mu)
-    return versions_dict, output
-
-
-def node_manager_init(conf):
-    return nodes.NodeManager(conf=conf)
+            checks.append((r, p, dbs[r][p]['file']))
+    sync = versions_sync.VersionsSync(conf['versions_mirror'],
+                                      conf['versions_mirror_timeout'],
+                                      conf['versions_cache_dir'])
+    for (r, p, f), result in zip(checks, sync.sync_all(checks)):
+        if result in messages:
+            for n in dbs[r][p]['nodes']:
+                output_add(output, n, messages[result] % (r, p))
+        if result != versions_sync.MISSING:
+            versions.add(r, p, f)
+    versions.load()
+    return versions, output
+
+
+def node_manager_init(conf, inventory=None):
+    return nodes.NodeManager(conf=conf, inventory=inventory)
 
 
 def output_add(output, node, message, key=None):
@@ -250,7 +164,8 @@ def output_prepare(output):
 def pretty_print(output, pre_indent=4):
     sys.stdout.write('\n')
     output_prepare(output)
-    for line in yaml.safe_dump(output, default_flow_style=False).split('\n'):
+    yaml_output = utils.dump_yaml(output, default_flow_style=False)
+    for line in yaml_output.split('\n'):
         if len(line) > 0:
             if re.match('^ *-', line):
                 # force ident for block sequences
@@ -262,48 +177,69 @@ def fstrip(text_file):
     return [line.rstrip('\n') for line in text_file]
 
 
-def verify_versions(node, versions_dict, output=None):
-    if (node.release not in versions_dict or (node.os_platform not in
-                                              versions_dict[node.release])):
+def collection_failed(node, command):
+    return node.get_job_status(nodes.Node.skey, command) == 'failed'
+
+
+def get_custom_packages(custom_packages, node):
+    """Returns the custom packages found on a node by the analyses
+
+    Analysis results are kept out of the nodes, in a dict by node id.
+    """
+    if custom_packages is None:
+        return {}
+    return custom_packages.setdefault(node.id, {})
+
+
+def verify_versions(node, versions, output=None, custom_packages=None):
+    vdb = versions.get(node.release, node.os_platform)
+    if vdb is None:
         return output_add(output, node,
                           ('the database does not have any data for MOS '
                            'release %s for %s!' % (str(node.release),
                                                    str(node.os_platform))))
     msg_custom = "installed version '%s' is not part of MOS %s"
-    vd = versions_dict[node.release][node.os_platform]
     command = 'packagelist-' + node.os_platform
     if command not in node.mapscr:
         return output_add(output, node, 'versions data was not collected!')
+    if collection_failed(node, command):
+        return output_add(output, node, ('versions data collection failed, '
+                                         'you may want to re-run!'))
     if not os.path.exists(node.mapscr[command]):
         return output_add(output, node, 'versions data output file missing!')
     if os.stat(node.mapscr[command]).st_size == 0:
         return output_add(output, node,
                           'versions data empty, you may want to re-run!')
     with open(node.mapscr[command], 'r') as packagelist:
-        reader = csv.reader(packagelist, delimiter='\t')
-        if not hasattr(node, 'custom_packages'):
-            node.custom_packages = {}
-        for p_name, p_version in reader:
+        rows = list(csv.reader(packagelist, delimiter='\t'))
+        # only the packages the node has are looked up
+        vd = vdb.packages([row[0] for row in rows])
+        packages = get_custom_packages(custom_packages, node)
+        for p_name, p_version in rows:
             if p_name in vd:
                 if p_version not in vd[p_name]['versions']:
-                    if p_name not in node.custom_packages:
-                        node.custom_packages[p_name] = {}
-                        node.custom_packages[p_name]['reasons'] = set()
-                    node.custom_packages[p_name]['version'] = p_version
+                    if p_name not in packages:
+                        packages[p_name] = {}
+                        packages[p_name]['reasons'] = set()
+                    packages[p_name]['version'] = p_version
                     if 0 not in vd[p_name]['mu']:
-                        node.custom_packages[p_name]['reasons'].add('upstream')
+                        packages[p_name]['reasons'].add('upstream')
                     else:
-                        node.custom_packages[p_name]['reasons'].add('version')
+                        packages[p_name]['reasons'].add('version')
                         output_add(output, node,
                                    {p_name: str(msg_custom % (str(p_version),
                                                               node.release))})
     return output
 
 
-def verify_md5_builtin_show_results(conf, node, output=None):
+def verify_md5_builtin_show_results(conf, node, output=None,
+                                    custom_packages=None):
     command = 'packages-md5-verify-'+node.os_platform
     if command not in node.mapscr:
         return output_add(output, node, 'builtin md5 data was not collected!')
+    if collection_failed(node, command):
+        return output_add(output, node, ('builtin md5 data collection failed, '
+                                         'you may want to re-run!'))
     if not os.path.exists(node.mapscr[command]):
         return output_add(output, node,
                           'builtin md5 data output file missing!')
@@ -327,23 +263,18 @@ def verify_md5_builtin_show_results(conf, node, output=None):
                 if excluded:
                     continue
                 p_name, p_version, details = line.split('\t')
-                if not hasattr(node, 'custom_packages'):
-                    node.custom_packages = {}
-                if p_name not in node.custom_packages:
-                    node.custom_packages[p_name] = {}
-                    node.custom_packages[p_name]['reasons'] = set()
-                node.custom_packages[p_name]['version'] = p_version
-                node.custom_packages[p_name]['reasons'].add('builtin-md5')
+                packages = get_custom_packages(custom_packages, node)
+                if p_name not in packages:
+                    packages[p_name] = {}
+                    packages[p_name]['reasons'] = set()
+                packages[p_name]['version'] = p_version
+                packages[p_name]['reasons'].add('builtin-md5')
                 output_add(output, node,
                            str(details).strip(),
                            '%s %s' % (str(p_name), str(p_version)))
     return output
 
 
-def print_mu(mu):
-    return 'MU'+str(mu) if mu > 0 else 'GA'
-
-
 def get_reasons_string(reasons_list):
     if 'upstream' in reasons_list:
         return 'upstream'
@@ -351,7 +282,7 @@ def get_reasons_string(reasons_list):
         return 'custom ['+', '.join(reasons_list)+']'
 
 
-def mu_safety_check(node, versions_dict, output=None):
+def mu_safety_check(node, versions, output=None, custom_packages=None):
 
     def _compare_with_mvd(vd_package, p_name, p_data):
         p_version = p_data['version']
@@ -379,48 +310,50 @@ def mu_safety_check(node, versions_dict, output=None):
                                       print_mu(mu),
                                       vd_package['max_version'])))
 
-    if hasattr(node, 'custom_packages'):
-        for p_name, p_data in node.custom_packages.items():
-            if node.release in versions_dict:
-                if node.os_platform in versions_dict[node.release]:
-                    vd = versions_dict[node.release][node.os_platform]
-                    if p_name in vd:
-                        vd_p = vd[p_name]
-                        if max(vd_p['mu']) > 0:
-                            _compare_with_mvd(vd_p, p_name, p_data)
+    vdb = versions.get(node.release, node.os_platform)
+    if vdb is not None:
+        packages = get_custom_packages(custom_packages, node)
+        vd = vdb.packages(packages.keys())
+        for p_name, p_data in packages.items():
+            if p_name in vd:
+                vd_p = vd[p_name]
+                if max(vd_p['mu']) > 0:
+                    _compare_with_mvd(vd_p, p_name, p_data)
     return output
 
 
-def update_candidates(node, versions_dict, output=None):
+def update_candidates(node, versions, output=None, custom_packages=None):
     # shortening fucntion name for pep8's sake...
     grs = get_reasons_string
-    if (node.release not in versions_dict or (node.os_platform not in
-                                              versions_dict[node.release])):
+    vdb = versions.get(node.release, node.os_platform)
+    if vdb is None:
             return output_add(output, node,
                               ('the database does not have any data for MOS '
                                'release %s, os %s!' % (str(node.release),
                                                        str(node.os_platform))))
-    vd = versions_dict[node.release][node.os_platform]
     command = 'packagelist-'+node.os_platform
     if command not in node.mapscr:
         return output_add(output, node, 'versions data was not collected!')
+    if collection_failed(node, command):
+        return output_add(output, node, ('versions data collection failed, '
+                                         'you may want to re-run!'))
     if not os.path.exists(node.mapscr[command]):
         return output_add(output, node, 'versions data output file missing!')
     if os.stat(node.mapscr[command]).st_size == 0:
         return output_add(output, node,
                           'versions data empty, you may want to re-run!')
+    packages = get_custom_packages(custom_packages, node)
     with open(node.mapscr[command], 'r') as packagelist:
-        reader = csv.reader(packagelist, delimiter='\t')
-        for p_name, p_version in reader:
+        rows = list(csv.reader(packagelist, delimiter='\t'))
+        vd = vdb.packages([row[0] for row in rows])
+        for p_name, p_version in rows:
             if p_name in vd:
                 vd_package = vd[p_name]
                 r = vercmp(node.os_platform, vd_package['max_version'],
                            p_version)
                 p_state = ''
-                if (hasattr(node, 'custom_packages') and
-                        p_name in node.custom_packages):
-                    p_state = ('%s ' %
-                               (grs(node.custom_packages[p_name]['reasons'])))
+                if p_name in packages:
+                    p_state = '%s ' % (grs(packages[p_name]['reasons']))
                 if p_version in vd_package['versions']:
                     p_mu = min(vd_package['versions'][p_version])
                     if p_mu:
@@ -442,19 +375,52 @@ def update_candidates(node, versions_dict, output=None):
     return output
 
 
-def perform(description, function, nm, args, ok_message):
-    sys.stdout.write(description+': ')
-    output = {}
-    if not args:
-        args = {}
-    for node in nm.nodes.values():
+def perform(node, analyses):
+    for analysis in analyses:
+        args = dict(analysis['args'])
         args['node'] = node
-        args['output'] = output
-        function(**args)
-    if output:
-        pretty_print(output)
-    else:
-        print(ok_message)
+        args['output'] = analysis['output']
+        analysis['function'](**args)
+
+
+def print_results(analyses):
+    for analysis in analyses:
+        sys.stdout.write(analysis['description']+': ')
+        if analysis['output']:
+            pretty_print(analysis['output'])
+        else:
+            print(analysis['ok_message'])
+
+
+def print_timings(nm):
+    nodes, jobs = nm.slowest()
+    if not nodes:
+        return
+    print('Slowest nodes:')
+    for runtime, node, timing in nodes:
+        connect = timing['connect']
+        print('    node-%s (%s): %.1fs, queued %.1fs, connect %s' %
+              (node.id, node.ip, runtime, timing['queue_wait'],
+               'n/a' if connect is None else '%.1fs' % connect))
+    print('Slowest scripts:')
+    for runtime, node, timing in jobs:
+        print('    %s on node-%s: %.1fs, exit code %s, %d bytes' %
+              (timing['name'], node.id, runtime, timing['exit_code'],
+               timing['stdout_bytes']))
+
+
+def print_statuses(nm):
+    by_status = {}
+    for node in nm.nodes.values():
+        status = node.timings.get('status')
+        by_status.setdefault(status, []).append(node)
+    for status, title in (('retried', 'Nodes collected after retries'),
+                          ('failed', 'Nodes with failed data collection')):
+        if status not in by_status:
+            continue
+        print('%s:' % title)
+        for node in sorted(by_status[status], key=lambda n: n.id):
+            print('    node-%s (%s)' % (node.id, node.ip))
 
 
 def _setup_logging(debug):
@@ -473,6 +439,12 @@ def main(argv=None):
                         help=('Do not perform remote commands, use already '
                               'collected data'),
                         action='store_true')
+    parser.add_argument('-o', '--offline', nargs='?', const='',
+                        metavar='INVENTORY',
+                        help=('Do not connect to Fuel, initialize nodes from '
+                              'the inventory saved by the last run in the '
+                              'output directory or from INVENTORY file, '
+                              'implies --fake'))
     parser.add_argument('-c', '--config',
                         help='Path to user config file')
     parser.add_argument('-e', '--env', nargs='*', type=int,
@@ -480,39 +452,72 @@ def main(argv=None):
                               'environment ids'))
     parser.add_argument('-n', '--node', nargs='*', type=int,
                         help='Perform check only for specified node ids')
+    parser.add_argument('-r', '--resume',
+                        help=('Only run commands and scripts which did not '
+                              'complete in the last run, reuse the data '
+                              'already collected'),
+                        action='store_true')
+    parser.add_argument('--force-md5',
+                        default=False, action='store_true',
+                        help=('Re-hash all packaged files when md5 '
+                              'verification runs in incremental mode'))
     parser.add_argument('-d', '--debug',
                         default=False, action='store_true',
                         help='Turn on debug messages')
     if argv is None:
         argv = sys.argv
     args = parser.parse_args(argv[1:])
+    if args.offline is not None:
+        args.fake = True
 
     _setup_logging(args.debug)
 
     try:
         conf = configuration.get_config(args)
-        nm = node_manager_init(conf)
+        nm = node_manager_init(conf, args.offline)
     except Exception as e:
         print("There are no nodes to check")
         raise e
 
-    versions_dict, output = load_versions_dict(conf, nm)
-    if not versions_dict:
+    versions, output = load_versions_db(conf, nm)
+    if not versions:
         print("[ERROR] Could't load databases.")
         return 1
     if output:
         pretty_print(output)
 
+    # packages found by the analyses, by node id
+    custom_packages = {}
+    analyses = [
+        {'description': '  Versions verification analysis',
+         'function': verify_versions,
+         'args': {'versions': versions,
+                  'custom_packages': custom_packages},
+         'ok_message': 'OK'},
+        {'description': '  Built-in md5 verification analysis',
+         'function': verify_md5_builtin_show_results,
+         'args': {'conf': conf, 'custom_packages': custom_packages},
+         'ok_message': 'OK'},
+        {'description': '  Potential updates',
+         'function': update_candidates,
+         'args': {'versions': versions,
+                  'custom_packages': custom_packages},
+         'ok_message': 'ALL NODES UP-TO-DATE'}]
+    for analysis in analyses:
+        analysis['output'] = {}
+
     sys.stdout.write('Collecting data from %d nodes: ' % len(nm.nodes))
-    nm.run_commands(conf['outdir'], fake=args.fake)
+    # nodes are analyzed as soon as their data is collected
+    nm.run_commands(timeout=conf['timeout'], fake=args.fake,
+                    callback=lambda node: perform(node, analyses),
+                    resume=args.resume)
+    versions.close()
     print('DONE')
     print('Results:')
-    perform('  Versions verification analysis', verify_versions, nm,
-            {'versions_dict': versions_dict}, 'OK')
-    perform('  Built-in md5 verification analysis',
-            verify_md5_builtin_show_results, nm, {'conf': conf}, 'OK')
-    perform('  Potential updates', update_candidates, nm,
-            {'versions_dict': versions_dict}, 'ALL NODES UP-TO-DATE')
+    print_results(analyses)
+    if not args.fake:
+        print_statuses(nm)
+        print_timings(nm)
     return 0
 
 
@@ -12,25 +12,41 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import binascii
 import copy
 import datetime
+import hashlib
 import logging
 import json
 import os
+import pipes
 import shutil
 import sys
+import time
 
 from collections import Iterable
 
 from cudet import configuration
+from cudet import engine
 from cudet import exceptions
 from cudet import fuel_client
+from cudet import limiter
 from cudet import utils
 from six import string_types
 
 
 logger = logging.getLogger(__name__)
 
+# one instance of every string value of node attributes
+_interned = {}
+
+
+def intern_value(value):
+    """Returns the same object for equal strings, unicode ones included"""
+    if isinstance(value, string_types):
+        return _interned.setdefault(value, value)
+    return value
+
 
 class Node(object):
     ckey = 'cmds'
@@ -47,137 +63,134 @@ class Node(object):
     conf_match_prefix = 'by_'
     conf_default_key = '__default'
     conf_priority_section = conf_match_prefix + 'id'
+    fp_marker = 'cudet-fingerprint: '
+    fp_unchanged = 'cudet-fingerprint-unchanged'
+    md5_stats_marker = 'cudet-md5-stats: '
+    # scripts set up by md5_verify, see get_md5_verify_env
+    md5_verify_prefix = 'packages-md5-verify-'
     header = ['node-id', 'env', 'ip', 'mac', 'os',
               'roles', 'online', 'status', 'name', 'fqdn']
 
+    # attributes from the configuration are kept in conf_attrs, which nodes
+    # given the same configuration plan share, and read through __getattr__
+    __slots__ = ['id', 'mac', 'cluster', 'roles', 'os_platform', 'online',
+                 'status', 'ip', 'release', 'name', 'fqdn', 'mapcmds',
+                 'mapscr', 'ssh_pool', 'timings', 'resume_jobs',
+                 'reused_jobs', 'manifest_file', 'manifest_jobs', 'logger',
+                 'conf_attrs']
+    # configuration attributes of a node before any configuration is applied
+    # put elements must be tuples - (src, dst)
+    conf_base = {fkey: [], flkey: [], ckey: [], skey: [], pkey: [],
+                 'outputs_timestamp': False}
+
     def __init__(self, id, name, fqdn, mac, cluster, release, roles,
-                 os_platform, online, status, ip, conf, logger=None):
+                 os_platform, online, status, ip, conf, logger=None,
+                 planner=None):
         self.id = id
         self.mac = mac
         self.cluster = cluster
-        self.roles = roles
-        self.os_platform = os_platform
+        self.roles = [intern_value(r) for r in utils.w_list(roles)]
+        self.os_platform = intern_value(os_platform)
         self.online = online
-        self.status = status
+        self.status = intern_value(status)
         self.ip = ip
-        self.release = release
-        self.files = []
-        self.filelists = []
-        self.cmds = []
-        self.scripts = []
-        # put elements must be tuples - (src, dst)
-        self.put = []
-        self.data = {}
-        self.logsize = 0
+        self.release = intern_value(release)
         self.mapcmds = {}
         self.mapscr = {}
         self.name = name
         self.fqdn = fqdn
-        self.outputs_timestamp = False
-        self.outputs_timestamp_dir = None
-        self.apply_conf(conf)
+        self.ssh_pool = None
+        self.timings = {}
+        # outputs of the last run which may be reused, by map and key
+        self.resume_jobs = {}
+        self.reused_jobs = []
+        # where completed jobs are recorded as they complete, see record_job
+        self.manifest_file = None
+        self.manifest_jobs = {}
+        self.conf_attrs = Node.conf_base
+        self.apply_conf(conf, planner=planner)
         self.logger = logger or logging.getLogger(__name__)
 
-    def apply_conf(self, conf, clean=True):
-
-        def apply(k, v, c_a, k_d, o, default=False):
-            if k in c_a:
-                if any([default,
-                        k not in k_d and k not in o,
-                        not hasattr(self, k)]):
-                    setattr(self, k, copy.deepcopy(utils.w_list(v)))
-                else:
-                    getattr(self, k).extend(copy.deepcopy(utils.w_list(v)))
-                if not default:
-                    o[k] = True
-            else:
-                setattr(self, k, copy.deepcopy(v))
-
-        def r_apply(el, p, p_s, c_a, k_d, o, d, clean=False):
-            # apply normal attributes
-            for k in [k for k in el if k != p_s and not k.startswith(p)]:
-                if el == conf and clean:
-                    apply(k, el[k], c_a, k_d, o, default=True)
-                else:
-                    apply(k, el[k], c_a, k_d, o)
-            # apply match attributes (by_xxx except by_id)
-            for k in [k for k in el if k != p_s and k.startswith(p)]:
-                attr_name = k[len(p):]
-                if hasattr(self, attr_name):
-                    attr = utils.w_list(getattr(self, attr_name))
-                    for v in attr:
-                        if v in el[k]:
-                            subconf = el[k][v]
-                            if d in el:
-                                d_conf = el[d]
-                                for a in d_conf:
-                                    apply(a, d_conf[a], c_a, k_d, o)
-                            r_apply(subconf, p, p_s, c_a, k_d, o, d)
-            # apply priority attributes (by_id)
-            if p_s in el:
-                if self.id in el[p_s]:
-                    p_conf = el[p_s][self.id]
-                    if d in el[p_s]:
-                        d_conf = el[p_s][d]
-                        for k in d_conf:
-                            apply(k, d_conf[k], c_a, k_d, o)
-                    for k in [k for k in p_conf if k != d]:
-                        apply(k, p_conf[k], c_a, k_d, o, default=True)
-
-        p = Node.conf_match_prefix
-        p_s = Node.conf_priority_section
-        c_a = Node.conf_appendable
-        k_d = Node.conf_keep_default
-        d = Node.conf_default_key
-        overridden = {}
-        if clean:
-            '''clean appendable keep_default params to ensure no content
-            duplication if this function gets called more than once'''
-            for f in set(c_a).intersection(k_d):
-                setattr(self, f, [])
-        r_apply(conf, p, p_s, c_a, k_d, overridden, d, clean=clean)
-
-    def exec_cmd(self, fake=False, ok_codes=None):
+    def __getattr__(self, name):
+        if name == 'conf_attrs':
+            raise AttributeError(name)
+        try:
+            return self.conf_attrs[name]
+        except KeyError:
+            raise AttributeError("'Node' object has no attribute '%s'" %
+                                 name)
+
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in Node.__slots__
+                     if hasattr(self, k)])
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def apply_conf(self, conf, clean=True, planner=None):
+        """Sets the node's attributes from a configuration
+
+        :param planner: ConfPlanner of conf, which shares plans between
+                        nodes alike, one for this call only by default
+        """
+        if planner is None:
+            planner = ConfPlanner(conf)
+        planner.plan(self, clean).apply(self)
+
+    def get_ssh_opts(self):
+        if self.ssh_pool is None:
+            return self.ssh_opts
+        return self.ssh_pool.ssh_opts + utils.w_list(self.ssh_opts)
+
+    def get_jobs(self, fake=False):
+        """Returns the commands and scripts to run on the node
+
+        Each job is a dict holding the output file ('dfile'), the map it
+        belongs to ('map', Node.ckey or Node.skey) and its key there ('key'),
+        a description for logging ('label') and the ssh_node arguments to
+        run it with ('args'). With batch_session set, all jobs are packed
+        into a single one unless fake is set. Jobs completed by the last
+        run according to resume_jobs are not returned, their outputs are
+        reused.
+        """
+        self.reused_jobs = []
+        self.manifest_jobs = {Node.ckey: {}, Node.skey: {}}
         sn = 'node-%s' % self.id
         cl = 'cluster-%s' % self.cluster
         self.logger.debug('%s/%s/%s/%s' % (self.outdir, Node.ckey, cl, sn))
         ddir = os.path.join(self.outdir, Node.ckey, cl, sn)
-        if self.cmds:
+        if self.cmds or self.scripts:
             utils.mdir(ddir)
-        self.cmds = sorted(self.cmds)
-        mapcmds = {}
-        for c in self.cmds:
+        jobs = []
+        for c in sorted(self.cmds):
             for cmd in c:
                 dfile = os.path.join(ddir, 'node-%s-%s-%s' %
                                      (self.id, self.ip, cmd))
                 if self.outputs_timestamp:
                         dfile += self.outputs_timestamp_str
                 self.logger.info('outfile: %s' % dfile)
-                mapcmds[cmd] = dfile
-                if not fake:
-                    outs, errs, code = utils.ssh_node(ip=self.ip,
-                                                      command=c[cmd],
-                                                      ssh_opts=self.ssh_opts,
-                                                      env_vars=self.env_vars,
-                                                      timeout=self.timeout,
-                                                      prefix=self.prefix)
-                    self.check_code(code, 'exec_cmd', c[cmd], errs, ok_codes)
-                    try:
-                        with open(dfile, 'w') as df:
-                            df.write(outs.encode('utf-8'))
-                    except:
-                        self.logger.error("can't write to file %s" %
-                                          dfile)
-        if self.scripts:
-            utils.mdir(ddir)
-        scripts = sorted(self.scripts)
-        mapscr = {}
-        for scr in scripts:
+                job = {'map': Node.ckey,
+                       'key': cmd,
+                       'dfile': dfile,
+                       'label': c[cmd],
+                       'args': {'command': c[cmd],
+                                'env_vars': self.env_vars,
+                                'prefix': self.prefix,
+                                'timeout': self.timeout}}
+                if not self.reuse_job(job):
+                    jobs.append(job)
+        for scr in sorted(self.scripts):
             if type(scr) is dict:
                 env_vars = scr.values()[0]
                 scr = scr.keys()[0]
             else:
                 env_vars = self.env_vars
+            env_vars = utils.w_list(env_vars or [])
+            prefix = self.prefix
+            if os.path.basename(scr).startswith(Node.md5_verify_prefix):
+                env_vars = env_vars + self.get_md5_verify_env()
+                prefix = self.get_md5_verify_cmd_prefix()
             if os.path.sep in scr:
                 f = scr
             else:
@@ -188,22 +201,557 @@ class Node(object):
             if self.outputs_timestamp:
                     dfile += self.outputs_timestamp_str
             self.logger.info('outfile: %s' % dfile)
-            mapscr[scr] = dfile
-            if not fake:
-                outs, errs, code = utils.ssh_node(ip=self.ip,
-                                                  filename=f,
-                                                  ssh_opts=self.ssh_opts,
-                                                  env_vars=env_vars,
-                                                  timeout=self.timeout,
-                                                  prefix=self.prefix)
-                self.check_code(code, 'exec_cmd', 'script %s' % f, errs,
-                                ok_codes)
+            job = {'map': Node.skey,
+                   'key': scr,
+                   'dfile': dfile,
+                   'label': 'script %s' % f,
+                   'args': {'filename': f,
+                            'env_vars': env_vars,
+                            'prefix': prefix,
+                            'timeout': self.timeout}}
+            if self.reuse_job(job):
+                continue
+            if scr in self.fingerprints and not fake:
+                self.fingerprint_job(job, ddir)
+            jobs.append(job)
+        if self.batch_session and not fake and len(jobs) > 1:
+            jobs = [self.get_batch_job(jobs, ddir)]
+        if self.ssh_pool is not None and jobs and not fake:
+            # establish the node's master connection first to time it
+            jobs.insert(0, {'map': None,
+                            'key': None,
+                            'dfile': os.devnull,
+                            'label': 'connect',
+                            'connect': True,
+                            'args': {'command': 'true',
+                                     'env_vars': '',
+                                     'prefix': '',
+                                     'timeout': self.timeout}})
+        return jobs
+
+    def reuse_job(self, job):
+        """Returns True if the output of a job's last run can be reused"""
+        entry = self.resume_jobs.get(job['map'], {}).get(job['key'])
+        if not entry or entry['status'] != 'ok':
+            return False
+        try:
+            if os.path.getsize(entry['dfile']) != entry['size']:
+                return False
+        except OSError:
+            return False
+        self.logger.info('node %s: reusing %s' % (self.id, entry['dfile']))
+        self.manifest_jobs[job['map']][job['key']] = entry
+        self.reused_jobs.append({'map': job['map'],
+                                 'key': job['key'],
+                                 'dfile': entry['dfile']})
+        if self.timings:
+            self.timings['jobs'].append({'name': job['key'],
+                                         'map': job['map'],
+                                         'runtime': None,
+                                         'exit_code': entry['exit_code'],
+                                         'stdout_bytes': 0,
+                                         'stderr_bytes': 0,
+                                         'ok': True,
+                                         'reused': True})
+        return True
+
+    def get_md5_verify_env(self):
+        """Returns env vars which set up the md5 verification scripts
+
+        Only the packages-md5-verify-* scripts get them, so that the
+        md5_verify settings do not change what other scripts run with.
+        """
+        conf = self.md5_verify
+        return ['CUDET_MD5_MODE=%s' % conf.get('mode', 'full'),
+                'CUDET_MD5_CACHE=%s' % conf.get('cache', ''),
+                'CUDET_MD5_FORCE=%d' % bool(conf.get('force')),
+                'CUDET_MD5_JOBS=%s' % conf.get('jobs', 1),
+                'CUDET_MD5_RATE=%s' % conf.get('rate', 0)]
+
+    def get_md5_verify_cmd_prefix(self):
+        """Returns the prefix the md5 verification scripts run with
+
+        With jobs or rate set, the scripts pace their reads themselves and
+        run with md5_verify's prefix, in the idle I/O class of prefix the
+        hashing would be starved by any other I/O on the node.
+        """
+        conf = self.md5_verify
+        if (int(conf.get('jobs') or 1) > 1 or
+                str(conf.get('rate') or 0) != '0'):
+            return conf.get('prefix', 'nice -n 19 ionice -c 2 -n 7')
+        return self.prefix
+
+    def get_fingerprint_dir(self):
+        fdir = self.fingerprint_dir or os.path.join(self.outdir,
+                                                    'fingerprints')
+        return os.path.join(fdir, 'node-%s-%s' % (self.id, self.ip))
+
+    def fingerprint_job(self, job, ddir):
+        """Makes a script job reuse its last output if nothing changed
+
+        The script is wrapped into one which runs the script's fingerprint
+        command first. If its output is the same as on the run which gave
+        the cached output, the script is not run and only a marker is
+        printed to stderr, job_done then takes the output from the cache.
+        Otherwise the new fingerprint is printed to stderr and the script
+        runs as usual.
+        """
+        key = job['key']
+        fdir = self.get_fingerprint_dir()
+        cache = os.path.join(fdir, os.path.basename(key))
+        with open(job['args']['filename'], 'r') as f:
+            content = f.read()
+        script_md5 = hashlib.md5(content).hexdigest()
+        cached = ''
+        try:
+            with open(cache + '.fingerprint', 'r') as f:
+                cached_md5, fingerprint = f.read().split('\n', 1)
+            if cached_md5 == script_md5 and os.path.exists(cache):
+                cached = fingerprint.rstrip('\n')
+        except (IOError, ValueError):
+            pass
+        wrapper = os.path.join(ddir, '.node-%s-%s-%s-fingerprint' %
+                               (self.id, self.ip, os.path.basename(key)))
+        with open(wrapper, 'w') as f:
+            f.write('fp="$( (%s) 2>/dev/null | tr \'\\n\' \' \')"\n'
+                    'if [ -n "$fp" ] && [ "$fp" = %s ]; then\n'
+                    '    echo %s >&2\n'
+                    '    exit 0\n'
+                    'fi\n'
+                    'echo %s"$fp" >&2\n' %
+                    (self.fingerprints[key], pipes.quote(cached),
+                     Node.fp_unchanged, pipes.quote(Node.fp_marker)))
+            f.write(content)
+        job['args']['filename'] = wrapper
+        job['fingerprint'] = script_md5
+
+    def _fingerprint_done(self, job, errs, code, timing=None):
+        """Takes or updates the cached output of a fingerprinted job
+
+        Returns errs without the fingerprint marker.
+        """
+        key = job['key']
+        fdir = self.get_fingerprint_dir()
+        cache = os.path.join(fdir, os.path.basename(key))
+        fingerprint = None
+        lines = []
+        for line in errs.split('\n'):
+            if line == Node.fp_unchanged:
+                fingerprint = line
+            elif line.startswith(Node.fp_marker) and fingerprint is None:
+                fingerprint = line[len(Node.fp_marker):]
+            else:
+                lines.append(line)
+        try:
+            os.remove(job['args']['filename'])
+        except OSError:
+            pass
+        if code == 0 and fingerprint == Node.fp_unchanged:
+            self.logger.info('node %s: %s did not change, using %s' %
+                             (self.id, key, cache))
+            shutil.copyfile(cache, job['dfile'])
+            if timing is not None:
+                timing['cached'] = True
+        elif code == 0 and fingerprint:
+            utils.mdir(fdir)
+            shutil.copyfile(job['dfile'], cache + '.tmp')
+            os.rename(cache + '.tmp', cache)
+            with open(cache + '.fingerprint', 'w') as f:
+                f.write('%s\n%s\n' % (job['fingerprint'], fingerprint))
+        elif code == 0:
+            self.logger.warning('node %s: fingerprint command of %s gave no '
+                                'output, not caching its output' %
+                                (self.id, key))
+        else:
+            self.logger.warning('node %s: %s exited %s, not caching its '
+                                'output' % (self.id, key, code))
+        return '\n'.join(lines)
+
+    def _md5_stats_done(self, job, errs, timing=None):
+        """Logs the throughput reported by the md5 verification scripts
+
+        Returns errs without the report.
+        """
+        lines = []
+        for line in errs.split('\n'):
+            if not line.startswith(Node.md5_stats_marker):
+                lines.append(line)
+                continue
+            stats = {}
+            for field in line[len(Node.md5_stats_marker):].split():
+                k, sep, v = field.partition('=')
                 try:
-                    with open(dfile, 'w') as df:
-                        df.write(outs.encode('utf-8'))
-                except:
-                    self.logger.error("can't write to file %s" % dfile)
-        return mapcmds, mapscr
+                    stats[k] = float(v)
+                except ValueError:
+                    pass
+            self.logger.info('node %s: %s hashed %d of %d files, %.1f MiB '
+                             'in %.1fs, %.1f MiB/s' %
+                             (self.id, job['key'], stats.get('hashed', 0),
+                              stats.get('files', 0),
+                              stats.get('bytes', 0) / 1048576,
+                              stats.get('seconds', 0),
+                              stats.get('rate', 0) / 1048576))
+            if timing is not None:
+                timing['md5_stats'] = stats
+        return '\n'.join(lines)
+
+    def get_batch_job(self, jobs, ddir):
+        """Packs jobs into one job which runs all of them in one session
+
+        Every job keeps its own env_vars, prefix and timeout. Its stdout and
+        stderr are framed by lines starting with a random boundary and the
+        job index, stdout frame lines also carry the job's start and end
+        time and its exit code, so that job_done can split the session
+        output back into the jobs' own files.
+        """
+        boundary = 'cudet-%s' % binascii.hexlify(os.urandom(16))
+        batch_file = os.path.join(ddir, '.node-%s-%s-batch' %
+                                  (self.id, self.ip))
+        script = ["b='%s'\n" % boundary,
+                  "now() { date +%s.%N; }\n"]
+        for index, job in enumerate(jobs):
+            args = job['args']
+            env_vars = args['env_vars'] or ''
+            if type(env_vars) is list:
+                env_vars = ' '.join(env_vars)
+            script.append("printf '%%s %d %%s\\n' \"$b\" \"$(now)\"; "
+                          "printf '%%s %d\\n' \"$b\" >&2\n" % (index, index))
+            if 'command' in args:
+                inner = '%s %s %s' % (env_vars, args['prefix'],
+                                      args['command'])
+                script.append('timeout %s bash -c %s < /dev/null\n' %
+                              (args['timeout'], pipes.quote(inner)))
+            else:
+                inner = '%s %s bash -s' % (env_vars, args['prefix'])
+                with open(args['filename'], 'r') as f:
+                    content = f.read()
+                if content and not content.endswith('\n'):
+                    content += '\n'
+                script.append("timeout %s bash -c %s <<'%s-eof'\n%s%s-eof\n" %
+                              (args['timeout'], pipes.quote(inner), boundary,
+                               content, boundary))
+            script.append("rc=$?; printf '\\n%%s %d %%d %%s\\n' "
+                          "\"$b\" \"$rc\" \"$(now)\"\n" % index)
+        with open(batch_file + '.sh', 'w') as f:
+            f.write(''.join(script))
+        return {'map': None,
+                'key': None,
+                'dfile': batch_file + '.out',
+                'label': 'batch session',
+                'jobs': jobs,
+                'boundary': boundary,
+                'args': {'filename': batch_file + '.sh',
+                         'env_vars': '',
+                         'prefix': '',
+                         'timeout': sum([j['args']['timeout']
+                                         for j in jobs])}}
+
+    def get_job_cmd(self, job):
+        return utils.ssh_node_cmd(ip=self.ip,
+                                  ssh_opts=self.get_ssh_opts(),
+                                  **job['args'])
+
+    def get_maps(self, jobs):
+        maps = {Node.ckey: {}, Node.skey: {}}
+        for job in jobs:
+            for j in job.get('jobs', [job]):
+                if j['map'] is not None:
+                    maps[j['map']][j['key']] = j['dfile']
+        return maps[Node.ckey], maps[Node.skey]
+
+    def reset_timings(self, queued=None):
+        now = time.time()
+        self.timings = {'started': now,
+                        'queue_wait': now - queued if queued else 0,
+                        'connect': None,
+                        'runtime': None,
+                        'retries': 0,
+                        'status': None,
+                        'jobs': []}
+
+    def get_result(self, jobs):
+        """Returns what the node's data collection gives to NodeManager
+
+        The node's status in timings is 'failed' if any of its commands or
+        scripts failed, 'retried' if some had to be retried to succeed, 'ok'
+        otherwise.
+        """
+        self.timings['runtime'] = time.time() - self.timings['started']
+        if any([not t['ok'] for t in self.timings['jobs']]):
+            self.timings['status'] = 'failed'
+        elif self.timings['retries']:
+            self.timings['status'] = 'retried'
+        else:
+            self.timings['status'] = 'ok'
+        mapcmds, mapscr = self.get_maps(jobs + self.reused_jobs)
+        return mapcmds, mapscr, self.timings
+
+    def get_job_status(self, m, key):
+        """Returns 'ok', 'retried' or 'failed' for a command or script
+
+        Returns None if it did not run.
+        """
+        for timing in self.timings.get('jobs', []):
+            if timing['map'] == m and timing['name'] == key:
+                if not timing['ok']:
+                    return 'failed'
+                if timing.get('attempts', 1) > 1:
+                    return 'retried'
+                return 'ok'
+        return None
+
+    def get_job_retries(self, job):
+        if job['key'] is None:
+            # the connect and batch jobs
+            return max([self.get_job_retries(j)
+                        for j in job.get('jobs', [])] + [self.retries])
+        key = os.path.basename(job['key'])
+        return self.script_retries.get(key, self.retries)
+
+    def get_retry_delay(self, job, code):
+        """Returns seconds to wait before re-running a job, None if done
+
+        Only jobs which failed to connect are retried, with exponential
+        backoff.
+        """
+        if code != limiter.SSH_FAILURE:
+            return None
+        attempt = job.get('attempt', 0)
+        retries = self.get_job_retries(job)
+        if attempt >= retries:
+            return None
+        job['attempt'] = attempt + 1
+        self.timings['retries'] = self.timings.get('retries', 0) + 1
+        delay = self.retry_backoff * 2 ** attempt
+        self.logger.warning('node %s: ssh failed for %s, retry %d of %d '
+                            'in %.1fs' % (self.id, job['label'], attempt + 1,
+                                          retries, delay))
+        return delay
+
+    def skip_jobs(self, jobs):
+        """Records jobs which are not run as the node is unreachable"""
+        for job in jobs:
+            for j in job.get('jobs', [job]):
+                if 'fingerprint' in j:
+                    self._remove(j['args']['filename'])
+                self.timings['jobs'].append({'name': j['key'],
+                                             'map': j['map'],
+                                             'runtime': None,
+                                             'exit_code': limiter.SSH_FAILURE,
+                                             'stdout_bytes': 0,
+                                             'stderr_bytes': 0,
+                                             'ok': False,
+                                             'attempts': 0})
+            if 'jobs' in job:
+                self._remove(job['dfile'], job['args']['filename'])
+        if jobs:
+            self.logger.error('node %s (%s): unreachable, %d jobs skipped' %
+                              (self.id, self.ip, len(jobs)))
+
+    def fail_job(self, job, errs, ok_codes=None):
+        """Records a job which could not be started as failed
+
+        The job gets exit code -1 and errs as its stderr, like a job of a
+        batch session which ended before it has finished.
+        """
+        for j in job.get('jobs', [job]):
+            timing = {'runtime': None,
+                      'exit_code': -1,
+                      'stdout_bytes': 0,
+                      'stderr_bytes': len(errs.encode('utf-8'))}
+            j['attempt'] = job.get('attempt', 0)
+            self.job_done(j, errs, -1, ok_codes, timing)
+        if 'jobs' in job:
+            self._remove(job['dfile'], job['args']['filename'])
+
+    @staticmethod
+    def _remove(*files):
+        for f in files:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+    def job_done(self, job, errs, code, ok_codes=None, timing=None):
+        if 'jobs' in job:
+            return self._batch_job_done(job, errs, code, ok_codes)
+        if 'fingerprint' in job:
+            errs = self._fingerprint_done(job, errs, code, timing)
+        if Node.md5_stats_marker in errs:
+            errs = self._md5_stats_done(job, errs, timing)
+        ok = not code or bool(ok_codes and code in ok_codes)
+        if timing is not None:
+            if job.get('connect'):
+                self.timings['connect'] = timing['runtime']
+                self.timings['connect_code'] = timing['exit_code']
+            else:
+                timing['name'] = job['key']
+                timing['map'] = job['map']
+                timing['ok'] = ok
+                timing['attempts'] = job.get('attempt', 0) + 1
+                self.timings['jobs'].append(timing)
+        if not job.get('connect'):
+            self.record_job(job, ok, code)
+        self.check_code(code, 'exec_cmd', job['label'], errs, ok_codes)
+
+    @staticmethod
+    def manifest_entry(dfile, ok, exit_code):
+        """Returns what a manifest keeps of a command's or script's output"""
+        try:
+            size = os.path.getsize(dfile)
+        except OSError:
+            size = None
+        return {'dfile': dfile,
+                'size': size,
+                'status': 'ok' if ok and size is not None else 'failed',
+                'exit_code': exit_code}
+
+    def record_job(self, job, ok, code):
+        """Adds a completed job to the node's manifest
+
+        The manifest file, if the node has one, is written again after
+        every job, so that an interrupted run leaves the jobs it completed
+        to --resume.
+        """
+        if self.manifest_file is None:
+            return
+        self.manifest_jobs[job['map']][job['key']] = Node.manifest_entry(
+            job['dfile'], ok, code)
+        self.save_manifest()
+
+    def save_manifest(self):
+        """Writes manifest_jobs into manifest_file, replacing it at once"""
+        utils.mdir(os.path.dirname(self.manifest_file))
+        tmp_file = '%s.%d.tmp' % (self.manifest_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'id': self.id, 'ip': self.ip,
+                           'jobs': self.manifest_jobs,
+                           'status': self.timings.get('status')}, f,
+                          indent=2, sort_keys=True)
+            os.rename(tmp_file, self.manifest_file)
+        except (IOError, OSError) as e:
+            self.logger.error("can't write manifest %s: %s" %
+                              (self.manifest_file, e))
+
+    def _batch_job_done(self, job, errs, code, ok_codes=None):
+        boundary = job['boundary']
+        timings = {}
+        try:
+            with open(job['dfile'], 'r') as src:
+                timings = self._split_batch_output(src, boundary, job['jobs'])
+        except IOError as e:
+            self.logger.error("can't split batch output %s: %s" %
+                              (job['dfile'], e))
+        job_errs = {}
+        index = None
+        for line in errs.split('\n'):
+            fields = line.split(' ')
+            if fields[0] == boundary and len(fields) == 2:
+                index = int(fields[1])
+                job_errs[index] = []
+            elif index is not None:
+                job_errs[index].append(line)
+        for index, j in enumerate(job['jobs']):
+            if index in timings:
+                timing = timings[index]
+                j_errs = '\n'.join(job_errs.get(index, [])).rstrip('\n')
+            else:
+                # the session ended before this job has finished
+                timing = {'runtime': None, 'exit_code': code or -1,
+                          'stdout_bytes': 0}
+                j_errs = errs
+                if not os.path.exists(j['dfile']):
+                    open(j['dfile'], 'w').close()
+            timing['stderr_bytes'] = len(j_errs.encode('utf-8'))
+            j['attempt'] = job.get('attempt', 0)
+            self.job_done(j, j_errs, timing['exit_code'], ok_codes, timing)
+        self._remove(job['dfile'], job['args']['filename'])
+
+    @staticmethod
+    def _split_batch_output(src, boundary, jobs):
+        """Writes framed batch session output into the jobs' files
+
+        Returns runtime, exit_code and stdout_bytes of the jobs which have
+        finished, by job index.
+        """
+        timings = {}
+        out = None
+        index = None
+        start = None
+        line_start = True
+        newline = False
+        while True:
+            chunk = src.readline(65536)
+            if not chunk:
+                break
+            if line_start and chunk.startswith(boundary + ' '):
+                fields = chunk.split()
+                if out is None and len(fields) == 3:
+                    index = int(fields[1])
+                    start = float(fields[2])
+                    out = open(jobs[index]['dfile'], 'w')
+                    newline = False
+                    continue
+                if out is not None and len(fields) == 4:
+                    # the newline before the end line is not job output
+                    timings[index] = {'runtime': float(fields[3]) - start,
+                                      'exit_code': int(fields[2]),
+                                      'stdout_bytes': out.tell()}
+                    out.close()
+                    out = None
+                    continue
+            line_start = chunk.endswith('\n')
+            if out is None:
+                continue
+            if newline:
+                out.write('\n')
+            newline = line_start
+            out.write(chunk[:-1] if line_start else chunk)
+        if out is not None:
+            if newline:
+                out.write('\n')
+            out.close()
+        return timings
+
+    def exec_cmd(self, fake=False, ok_codes=None, queued=None):
+        self.reset_timings(queued)
+        jobs = self.get_jobs(fake=fake)
+        if not fake:
+            ssh_opts = self.get_ssh_opts()
+            for index, job in enumerate(jobs):
+                code = self.run_job(job, ssh_opts, ok_codes)
+                if job.get('connect') and code == limiter.SSH_FAILURE:
+                    self.skip_jobs(jobs[index + 1:])
+                    break
+        return self.get_result(jobs)
+
+    def run_job(self, job, ssh_opts, ok_codes=None):
+        """Runs a job until it connects or retries run out
+
+        Returns the job's exit code, None if it could not be started.
+        """
+        while True:
+            try:
+                df = open(job['dfile'], 'w')
+            except IOError as e:
+                self.logger.error("can't write to file %s" % job['dfile'])
+                self.fail_job(job, "can't write to file %s: %s" %
+                              (job['dfile'], e), ok_codes)
+                return None
+            timing = {}
+            with df:
+                outs, errs, code = utils.ssh_node(ip=self.ip,
+                                                  ssh_opts=ssh_opts,
+                                                  stdout=df,
+                                                  timing=timing,
+                                                  **job['args'])
+            delay = self.get_retry_delay(job, code)
+            if delay is None:
+                break
+            time.sleep(delay)
+        self.job_done(job, errs, code, ok_codes, timing)
+        return code
 
     def exec_simple_cmd(self, cmd, timeout=15, infile=None, outfile=None,
                         fake=False, ok_codes=None, input=None):
@@ -211,7 +759,7 @@ class Node(object):
         if not fake:
             outs, errs, code = utils.ssh_node(ip=self.ip,
                                               command=cmd,
-                                              ssh_opts=self.ssh_opts,
+                                              ssh_opts=self.get_ssh_opts(),
                                               env_vars=self.env_vars,
                                               timeout=timeout,
                                               outputfile=outfile,
@@ -229,13 +777,196 @@ class Node(object):
                                      func_name, cmd, code, err))
 
 
+class ConfPlan(object):
+    """Attribute assignments of a configuration to nodes alike
+
+    ops are (attribute, value, extend) triples. Plans and their values are
+    shared between nodes and must not be modified: applying a plan gives
+    the node a new dict of configuration attributes, or the dict the plan
+    gave to another node starting from Node.conf_base. Attributes with a
+    slot, like release, are set on the node.
+    """
+
+    def __init__(self, ops):
+        self.ops = tuple([op for op in ops if op[0] not in Node.__slots__])
+        self.slot_ops = tuple([(k, v) for k, v, extend in ops
+                               if k in Node.__slots__])
+        self.values = None
+
+    def apply(self, node):
+        fresh = node.conf_attrs is Node.conf_base
+        if fresh and self.values is not None:
+            attrs = self.values
+        else:
+            attrs = dict(node.conf_attrs)
+            for k, v, extend in self.ops:
+                if extend:
+                    attrs[k] = utils.w_list(attrs[k]) + v
+                else:
+                    attrs[k] = v
+            if fresh:
+                self.values = attrs
+        node.conf_attrs = attrs
+        for k, v in self.slot_ops:
+            setattr(node, k, v)
+
+
+class ConfPlanner(object):
+    """Compiles a configuration into plans of node attribute assignments
+
+    Applying a configuration walks its by_* sections, the sections matching
+    the node's attribute values are applied after the attributes they are
+    nested in, and the by_id section last. The assignments made only depend
+    on the values of the attributes matched on, on the node id if a by_id
+    section has it, and on which appendable attributes the node already
+    has, so the plans are memoized by these and nodes alike share a plan.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.match_attrs = set()
+        self.ids = set()
+        self._scan(conf)
+        self.match_attrs = sorted(self.match_attrs)
+        self.plans = {}
+
+    def _scan(self, el):
+        """Collects the attributes and ids the walk can match on"""
+        p = Node.conf_match_prefix
+        p_s = Node.conf_priority_section
+        for k in el:
+            if k == p_s:
+                self.ids.update([i for i in el[k]
+                                 if i != Node.conf_default_key])
+            elif k.startswith(p):
+                self.match_attrs.add(k[len(p):])
+                for subconf in el[k].values():
+                    if isinstance(subconf, dict):
+                        self._scan(subconf)
+
+    def key(self, node, clean):
+        values = []
+        for attr in self.match_attrs:
+            if hasattr(node, attr):
+                values.append(tuple(utils.w_list(getattr(node, attr))))
+            else:
+                values.append(None)
+        return (clean,
+                tuple(values),
+                node.id if node.id in self.ids else None,
+                tuple([hasattr(node, k) for k in Node.conf_appendable]))
+
+    def plan(self, node, clean=True):
+        """Returns the ConfPlan of the configuration for a node"""
+        key = self.key(node, clean)
+        try:
+            plan = self.plans.get(key)
+        except TypeError:
+            # unhashable attribute values
+            return self.compile(node, clean)
+        if plan is None:
+            plan = self.plans[key] = self.compile(node, clean)
+        return plan
+
+    def compile(self, node, clean=True):
+        """Walks the configuration the way it applies to a node"""
+        p = Node.conf_match_prefix
+        p_s = Node.conf_priority_section
+        c_a = Node.conf_appendable
+        k_d = Node.conf_keep_default
+        d = Node.conf_default_key
+        conf = self.conf
+        # values of the attributes matched on and appendables the node has,
+        # as they change during the walk
+        state = {}
+        for attr in self.match_attrs:
+            if hasattr(node, attr):
+                state[attr] = getattr(node, attr)
+        has = set([k for k in c_a if hasattr(node, k)])
+        overridden = {}
+        ops = []
+
+        def apply(k, v, default=False):
+            v = copy.deepcopy(v)
+            if k in c_a:
+                v = utils.w_list(v)
+                extend = not any([default,
+                                  k not in k_d and k not in overridden,
+                                  k not in has])
+                if extend and k in state:
+                    state[k] = utils.w_list(state[k]) + v
+                else:
+                    state[k] = v
+                has.add(k)
+                if not default:
+                    overridden[k] = True
+            else:
+                extend = False
+                state[k] = v
+            ops.append((k, v, extend))
+
+        def r_apply(el, clean=False):
+            # apply normal attributes
+            for k in [k for k in el if k != p_s and not k.startswith(p)]:
+                apply(k, el[k], default=el is conf and clean)
+            # apply match attributes (by_xxx except by_id)
+            for k in [k for k in el if k != p_s and k.startswith(p)]:
+                attr_name = k[len(p):]
+                if attr_name in state:
+                    for v in utils.w_list(state[attr_name]):
+                        if v in el[k]:
+                            subconf = el[k][v]
+                            if d in el:
+                                d_conf = el[d]
+                                for a in d_conf:
+                                    apply(a, d_conf[a])
+                            r_apply(subconf)
+            # apply priority attributes (by_id)
+            if p_s in el:
+                if node.id in el[p_s]:
+                    p_conf = el[p_s][node.id]
+                    if d in el[p_s]:
+                        d_conf = el[p_s][d]
+                        for k in d_conf:
+                            apply(k, d_conf[k])
+                    for k in [k for k in p_conf if k != d]:
+                        apply(k, p_conf[k], default=True)
+
+        if clean:
+            # clean appendable keep_default params to ensure no content
+            # duplication if the configuration gets applied more than once
+            for f in set(c_a).intersection(k_d):
+                ops.append((f, [], False))
+                has.add(f)
+                state[f] = []
+        r_apply(conf, clean=clean)
+        return ConfPlan(ops)
+
+
 class NodeManager(object):
     """Class nodes """
 
-    def __init__(self, conf, nodes_json=None, logger=None):
+    inventory_file = 'inventory.json'
+
+    def __init__(self, conf, nodes_json=None, logger=None, inventory=None):
+        """
+        :param nodes_json: file with the Fuel nodes list to use instead of
+                           the one from Fuel
+        :param inventory: file with an inventory saved by an earlier run,
+                          nodes are initialized from it without Fuel
+        """
         self.conf = conf
         self.logger = logger or logging.getLogger(__name__)
 
+        if not conf.fingerprint_dir:
+            # keep the cache in the same place when dir_timestamp is set
+            conf['fingerprint_dir'] = os.path.join(conf.outdir,
+                                                   'fingerprints')
+        if not conf.inventory_file:
+            # the same for every run, for --offline to find it
+            conf['inventory_file'] = os.path.join(
+                conf.outdir, NodeManager.inventory_file)
+
         if conf.outputs_timestamp or conf.dir_timestamp:
             timestamp_str = datetime.datetime.now().strftime('_%F_%H-%M-%S')
             if conf.outputs_timestamp:
@@ -256,27 +987,39 @@ class NodeManager(object):
 
         self.nodes = {}
         self.nodes_filter = NodeFilter()
-        self.fuel_client = fuel_client.get_client(self.conf)
+        self.planner = ConfPlanner(self.conf)
+        self.master_release = None
+        self.release_map = None
 
-        if self.fuel_client is None:
-            self.cli_creds = 'OS_TENANT_NAME={tenant} OS_USERNAME={user} ' \
-                             'OS_PASSWORD={password}'.\
-                format(tenant=self.conf.fuel_tenant,
-                       user=self.conf.fuel_user,
-                       password=self.conf.fuel_pass)
+        if inventory is not None:
+            self.load_inventory(inventory)
+        else:
+            self.fuel_client = fuel_client.get_client(self.conf)
+            self.fuel_session = None
+            self.fuel_cli_results = {}
+
+            if self.fuel_client is None:
+                self.cli_creds = 'OS_TENANT_NAME={tenant} ' \
+                                 'OS_USERNAME={user} ' \
+                                 'OS_PASSWORD={password}'.\
+                    format(tenant=self.conf.fuel_tenant,
+                           user=self.conf.fuel_user,
+                           password=self.conf.fuel_pass)
+            else:
+                self.fuel_session = fuel_client.FuelSession(self.fuel_client,
+                                                            self.conf)
+
+            if nodes_json is not None:
+                self.nodes_json = utils.load_json_file(nodes_json)
+            if not self.discover(nodes_json is None):
+                sys.exit(4)
+            self.save_inventory()
 
         if self.nodes_filter.check_master:
             self._fuel_node_init()
 
-        if nodes_json is not None:
-            self.nodes_json = utils.load_json_file(nodes_json)
-        else:
-            if not self.get_nodes():
-                sys.exit(4)
-
         self._nodes_init()
 
-        self.nodes_reapply_conf()
         self._conf_assign_once()
 
     def _import_rq(self):
@@ -331,7 +1074,7 @@ class NodeManager(object):
             self.logger.critical('NodeManager: fuel_ip is not set')
             sys.exit(7)
 
-        fuel_release = self.get_master_release()
+        fuel_release = self.master_release
 
         fuelnode = Node(id=0,
                         cluster=0,
@@ -344,9 +1087,125 @@ class NodeManager(object):
                         status='ready',
                         online=True,
                         ip=self.conf.fuel_ip,
-                        conf=self.conf)
+                        conf=self.conf,
+                        planner=self.planner)
         self.nodes[self.conf.fuel_ip] = fuelnode
 
+    def load_inventory(self, filename=None):
+        """Takes the Fuel nodes list and releases from a saved inventory"""
+        filename = filename or self.conf.inventory_file
+        self.logger.info('loading inventory %s' % filename)
+        inventory = utils.load_json_file(filename)
+        self.fuel_client = None
+        self.fuel_session = None
+        self.nodes_json = inventory['nodes']
+        self.master_release = inventory['master_release']
+        self.release_map = dict(inventory['release_map'])
+
+    def save_inventory(self):
+        """Writes what Fuel reported about the nodes for offline runs"""
+        filename = self.conf.inventory_file
+        release_map = self.release_map or {}
+        utils.mdir(os.path.dirname(filename))
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump({'fuel_ip': self.conf.fuel_ip,
+                           'master_release': self.master_release,
+                           'release_map': sorted(release_map.items()),
+                           'nodes': self.nodes_json}, f,
+                          indent=2, sort_keys=True)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            self.logger.error("can't write inventory %s: %s" % (filename, e))
+
+    def discover(self, get_nodes=True):
+        """Gets the master release, nodes list and releases from Fuel
+
+        The requests run concurrently, sharing the keep-alive connections
+        of fuel_session with fuelclient, in a single ssh session to the
+        master with the CLI. The master release is always asked for, so
+        that the inventory has it for --offline runs. Returns False if the
+        nodes list is unavailable.
+        """
+        calls = [('version', self.get_master_release)]
+        if get_nodes:
+            calls.append(('nodes', self.get_nodes))
+        calls.append(('clusters', self.get_slave_nodes_release))
+        if self.fuel_client is None:
+            self.fuel_cli_batch([name for name, call in calls])
+        try:
+            results = dict(zip([name for name, call in calls],
+                               utils.run_threads([call for name, call
+                                                  in calls])))
+        finally:
+            if self.fuel_session is not None:
+                self.fuel_session.close()
+        self.master_release = results.get('version')
+        self.release_map = results['clusters']
+        return results.get('nodes', True)
+
+    fuel_cli_cmds = {'version': 'fuel --fuel-version --json',
+                     'nodes': 'fuel node list --json',
+                     'clusters': 'fuel environment --json'}
+
+    def fuel_cli(self, name):
+        """Returns (stdout, stderr, exit code) of a Fuel CLI command
+
+        A result prefetched by fuel_cli_batch is returned, and forgotten,
+        instead of running the command again.
+        """
+        if name in self.fuel_cli_results:
+            return self.fuel_cli_results.pop(name)
+        return utils.ssh_node(ip=self.conf.fuel_ip,
+                              command=self.fuel_cli_cmds[name],
+                              env_vars=self.cli_creds,
+                              ssh_opts=self.conf.ssh_opts,
+                              timeout=self.conf.timeout)
+
+    def fuel_cli_batch(self, names):
+        """Runs Fuel CLI commands concurrently in one ssh session
+
+        The stdout and stderr of every command are printed framed by lines
+        starting with a random boundary, the command name and stream, and
+        the exit code for stdout. The results are kept for fuel_cli, none
+        if the session failed.
+        """
+        boundary = 'cudet-%s' % binascii.hexlify(os.urandom(16))
+        script = ['d="$(mktemp -d)"\n']
+        for name in names:
+            script.append('({ %s; } > "$d/%s.out" 2> "$d/%s.err"; '
+                          'echo $? > "$d/%s.rc") &\n' %
+                          (self.fuel_cli_cmds[name], name, name, name))
+        script.append('wait\n')
+        for name in names:
+            script.append('echo "%s %s out $(cat "$d/%s.rc")"; '
+                          'cat "$d/%s.out"; echo\n'
+                          'echo "%s %s err"; cat "$d/%s.err"; echo\n' %
+                          (boundary, name, name, name, boundary, name, name))
+        script.append('rm -rf "$d"\n')
+        self.logger.info('use CLI for getting %s' % ', '.join(names))
+        out, err, code = utils.ssh_node(ip=self.conf.fuel_ip,
+                                        command='bash -s',
+                                        input=''.join(script),
+                                        env_vars=self.cli_creds,
+                                        ssh_opts=self.conf.ssh_opts,
+                                        timeout=self.conf.timeout)
+        results = {}
+        current = None
+        for line in out.splitlines(True):
+            fields = line.split()
+            if fields and fields[0] == boundary:
+                name, stream = fields[1], fields[2]
+                if stream == 'out':
+                    results[name] = ['', '', int(fields[3])]
+                current = (results[name], 0 if stream == 'out' else 1)
+            elif current is not None:
+                current[0][current[1]] += line
+        self.fuel_cli_results = {}
+        for name, (n_out, n_err, n_code) in results.items():
+            self.fuel_cli_results[name] = (n_out, n_err.rstrip('\n'),
+                                           n_code)
+
     def get_nodes(self):
         if self.fuel_client is not None:
             return self._get_nodes_fuelclient()
@@ -357,7 +1216,7 @@ class NodeManager(object):
         if not self.fuel_client:
             return False
         try:
-            self.nodes_json = self.fuel_client.get_request('nodes')
+            self.nodes_json = self.fuel_session.get_request('nodes')
             self.logger.debug(self.nodes_json)
             return True
         except Exception as e:
@@ -369,13 +1228,7 @@ class NodeManager(object):
     def _get_nodes_cli(self):
         self.logger.info('use CLI for getting node information')
 
-        cmd = 'fuel node list --json'
-
-        nodes_json_str, err, code = utils.ssh_node(ip=self.conf.fuel_ip,
-                                                   command=cmd,
-                                                   env_vars=self.cli_creds,
-                                                   ssh_opts=self.conf.ssh_opts,
-                                                   timeout=self.conf.timeout)
+        nodes_json_str, err, code = self.fuel_cli('nodes')
         if code != 0:
             self.logger.warning(('NodeManager: cannot get '
                                  'fuel node list from CLI: %s') % err)
@@ -395,7 +1248,7 @@ class NodeManager(object):
 
         try:
             self.logger.info('getting release using fuelclient')
-            v = self.fuel_client.get_request('version')
+            v = self.fuel_session.get_request('version')
             fuel_version = v['release']
             self.logger.debug('version response:%s' % v)
         except Exception as e:
@@ -407,14 +1260,7 @@ class NodeManager(object):
     def _get_master_release_fuel_cli(self):
         self.logger.info('use CLI for getting fuel release')
 
-        cmd = 'fuel --fuel-version --json'
-
-        version_info_str, err, code = utils.ssh_node(
-            ip=self.conf.fuel_ip,
-            command=cmd,
-            env_vars=self.cli_creds,
-            ssh_opts=self.conf.ssh_opts,
-            timeout=self.conf.timeout)
+        version_info_str, err, code = self.fuel_cli('version')
         if code != 0:
             self.logger.warning('NodeManager: cannot get fuel release '
                                 'from CLI: {}'.format(err))
@@ -434,7 +1280,7 @@ class NodeManager(object):
     def _get_slaves_release_fuel_client(self):
 
         try:
-            clusters = self.fuel_client.get_request('clusters')
+            clusters = self.fuel_session.get_request('clusters')
             self.logger.debug('clusters response:%s' % clusters)
         except Exception as e:
             self.logger.warning('Cannot get clusters info using fuelclient')
@@ -452,14 +1298,7 @@ class NodeManager(object):
     def _get_slaves_release_fuel_cli(self):
         self.logger.info('use CLI for getting nodes release')
 
-        cmd = 'fuel environment --json'
-
-        clusters_info_str, err, code = utils.ssh_node(
-            ip=self.conf.fuel_ip,
-            command=cmd,
-            env_vars=self.cli_creds,
-            ssh_opts=self.conf.ssh_opts,
-            timeout=self.conf.timeout)
+        clusters_info_str, err, code = self.fuel_cli('clusters')
 
         if code != 0:
             self.logger.warning(('NodeManager: cannot get '
@@ -477,7 +1316,7 @@ class NodeManager(object):
         return release_map
 
     def _nodes_init(self):
-        release_map = self.get_slave_nodes_release()
+        release_map = self.release_map or {}
 
         filtered_nodes = self.nodes_filter.filter_nodes(self.nodes_json)
 
@@ -507,7 +1346,8 @@ class NodeManager(object):
                       'cluster': cluster_id,
                       'release': node_release,
                       'roles': roles,
-                      'conf': self.conf}
+                      'conf': self.conf,
+                      'planner': self.planner}
 
             for key in keys:
                 params[key] = node_data[key]
@@ -533,40 +1373,175 @@ class NodeManager(object):
                 all_nodes_num - filtered_nodes))
 
     def _conf_assign_once(self):
+        """Applies every once_by_* value's section to one node having it"""
         once = Node.conf_once_prefix
         p = Node.conf_match_prefix
         once_p = once + p
         for k in [k for k in self.conf if k.startswith(once)]:
             attr_name = k[len(once_p):]
-            assigned = dict((k, None) for k in self.conf[k])
-            for ak in assigned:
-                for node in self.nodes.values():
-                    if hasattr(node, attr_name) and not assigned[ak]:
-                        attr = utils.w_list(getattr(node, attr_name))
-                        for v in attr:
-                            if v == ak:
-                                once_conf = self.conf[k][ak]
-                                node.apply_conf(once_conf, clean=False)
-                                assigned[ak] = node.id
-                                break
-                    if assigned[ak]:
-                        break
+            # the first node having each value of the attribute
+            index = {}
+            for node in self.nodes.values():
+                if hasattr(node, attr_name):
+                    for v in utils.w_list(getattr(node, attr_name)):
+                        if v not in index:
+                            index[v] = node
+            for ak in self.conf[k]:
+                if ak in index:
+                    index[ak].apply_conf(self.conf[k][ak], clean=False)
 
     def nodes_reapply_conf(self):
         for node in self.nodes.values():
-            node.apply_conf(self.conf)
+            node.apply_conf(self.conf, planner=self.planner)
 
     @utils.run_with_lock
-    def run_commands(self, timeout=15, fake=False, maxthreads=100):
-        run_items = []
-        for key, node in self.nodes.items():
-            run_items.append(utils.RunItem(target=node.exec_cmd,
-                                           args={'fake': fake},
-                                           key=key))
-        result = utils.run_batch(run_items, maxthreads, dict_result=True)
-        for key in result:
-            self.nodes[key].mapcmds = result[key][0]
-            self.nodes[key].mapscr = result[key][1]
+    def run_commands(self, timeout=15, fake=False, maxthreads=100,
+                     callback=None, resume=False):
+        """Collects data from all nodes
+
+        :param callback: called with each node as soon as its data has been
+                         collected, in completion order
+        :param resume: only run commands and scripts which did not complete
+                       according to the manifests of the last run, reuse
+                       the outputs of the others
+        """
+        if not fake:
+            self.load_manifests(resume)
+        ssh_pool = None
+        if self.conf.ssh_multiplex and not fake:
+            ssh_pool = utils.SSHControlPool(self.conf.ssh_control_persist)
+        for node in self.nodes.values():
+            node.ssh_pool = ssh_pool
+        if self.conf.engine == 'poll' and not fake:
+            poll_engine = engine.PollEngine(self.conf.poll_max_sessions)
+            lim = self.get_limiter(poll_engine.max_sessions)
+            results = poll_engine.run(self.nodes.values(), limiter=lim)
+        else:
+            lim = None if fake else self.get_limiter(maxthreads)
+            run_items = []
+            for key, node in self.nodes.items():
+                run_items.append(utils.RunItem(target=node.exec_cmd,
+                                               args={'fake': fake,
+                                                     'queued': time.time()},
+                                               key=key))
+            results = ((self.nodes[run_item.key], result) for run_item, result
+                       in utils.run_batch_iter(run_items, maxthreads, lim))
+        try:
+            for node, result in results:
+                if isinstance(result, Exception):
+                    self.logger.error('node %s (%s): data collection '
+                                      'failed: %s' % (node.id, node.ip,
+                                                      result))
+                    node.timings['status'] = 'failed'
+                else:
+                    node.mapcmds, node.mapscr, node.timings = result
+                    if not fake:
+                        self.save_manifest(node)
+                if callback:
+                    callback(node)
+        finally:
+            results.close()
+            if not fake:
+                self.save_timings()
+            for node in self.nodes.values():
+                node.ssh_pool = None
+            if ssh_pool is not None:
+                ssh_pool.close()
+
+    def get_manifest_file(self, node):
+        return os.path.join(self.conf.outdir, 'manifest',
+                            'node-%s.json' % node.id)
+
+    def load_manifests(self, resume=False):
+        """Sets up nodes to reuse the outputs completed by the last run
+
+        Without resume the manifests of the last run are removed, as its
+        outputs are about to be overwritten.
+        """
+        for node in self.nodes.values():
+            node.resume_jobs = {}
+            filename = self.get_manifest_file(node)
+            node.manifest_file = filename
+            if not resume:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                continue
+            try:
+                with open(filename, 'r') as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if manifest and manifest.get('ip') == node.ip:
+                node.resume_jobs = manifest['jobs']
+
+    def save_manifest(self, node):
+        """Writes which commands and scripts of a node completed
+
+        Nodes record their jobs as they complete (see Node.record_job), in
+        worker processes with the process engine, the manifest is written
+        once more from the node's result.
+        """
+        timings = {}
+        for timing in node.timings.get('jobs', []):
+            timings[(timing['map'], timing['name'])] = timing
+        jobs = {}
+        for m, outputs in ((Node.ckey, node.mapcmds),
+                           (Node.skey, node.mapscr)):
+            jobs[m] = {}
+            for key, dfile in outputs.items():
+                timing = timings.get((m, key), {})
+                jobs[m][key] = Node.manifest_entry(dfile, timing.get('ok'),
+                                                   timing.get('exit_code'))
+        node.manifest_jobs = jobs
+        node.save_manifest()
+
+    def get_limiter(self, maximum):
+        """Returns an AdaptiveLimiter for the nodes, None if not configured
+
+        :param maximum: the most nodes the engine can run at a time
+        """
+        if not any([self.conf.concurrency_adaptive,
+                    self.conf.concurrency_per_cluster,
+                    self.conf.concurrency_per_role]):
+            return None
+        lim = limiter.AdaptiveLimiter.from_conf(self.conf, maximum)
+        for node in self.nodes.values():
+            lim.register(node.ip, node.cluster, node.roles)
+        self.logger.info('concurrency limit %d, at most %d' %
+                         (lim.limit, lim.maximum))
+        return lim
+
+    def save_timings(self):
+        """Writes per-node and per-script timings of the last run"""
+        timings = {}
+        for node in self.nodes.values():
+            if node.timings:
+                timings[node.id] = dict(node.timings, ip=node.ip,
+                                        name=node.name)
+        filename = os.path.join(self.conf.outdir, 'timings.json')
+        try:
+            with open(filename, 'w') as f:
+                json.dump(timings, f, indent=2, sort_keys=True)
+        except IOError as e:
+            self.logger.error("can't write timings to %s: %s" % (filename, e))
+
+    def slowest(self, count=5):
+        """Returns the slowest nodes and node scripts of the last run
+
+        Both are lists of (runtime, node, timing) sorted slowest first.
+        """
+        nodes = []
+        jobs = []
+        for node in self.nodes.values():
+            if node.timings.get('runtime') is None:
+                continue
+            nodes.append((node.timings['runtime'], node, node.timings))
+            for timing in node.timings['jobs']:
+                if timing['runtime'] is not None:
+                    jobs.append((timing['runtime'], node, timing))
+        nodes.sort(key=lambda x: x[0], reverse=True)
+        jobs.sort(key=lambda x: x[0], reverse=True)
+        return nodes[:count], jobs[:count]
 
 
 class NodeFilter(object):
@@ -586,39 +1561,117 @@ class NodeFilter(object):
         return self.filters.get('check_master', False)
 
     def filter_nodes(self, nodes_info):
+        """Returns the nodes of the Fuel nodes list which pass the filters
 
-        filtered_nodes = copy.deepcopy(nodes_info)
-        filter_attrs = self._prepare_filter_attrs()
-
-        for filter_attr in filter_attrs:
-            filtered_nodes = self._do_filter(filtered_nodes, filter_attr)
-
-        self._online_filter(filtered_nodes)
-        return filtered_nodes
+        The nodes are returned as they are, in the same order.
+        """
+        index = NodeIndex(nodes_info)
+        return [nodes_info[pos] for pos in sorted(self.select(index))]
 
     def _prepare_filter_attrs(self):
         filter_attrs = [attr for attr in self.filters.keys()
                         if attr not in ['check_master', 'online']]
 
         non_empty_filter_attrs = [attr for attr in filter_attrs
-                                  if len(self.filters[attr]) > 0]
+                                  if len(utils.w_list(self.filters[attr])) > 0]
 
         return non_empty_filter_attrs
 
-    def _online_filter(self, nodes_info):
-        return [node for node in nodes_info if node.get('online')]
-
-    def _do_filter(self, nodes_info, attr):
-        # attr from node can be a string or a list
-        # so we have to handle it properly
-        # TODO: refactor this ugly solution
-        def _to_set(data):
-            return set([data]) if \
-                isinstance(data, string_types) or \
-                not isinstance(data, Iterable) else set(data)
-
-        return [node for node in nodes_info
-                if len(
-                    _to_set(node.get(attr)).intersection(
-                        _to_set(self.filters[attr]))
-                ) > 0]
+    @staticmethod
+    def _parse(value):
+        """Returns a filter value as a list of (term, negated) pairs"""
+        if not isinstance(value, string_types):
+            return [(value, False)]
+        return [(term[1:], True) if term.startswith('!') else (term, False)
+                for term in value.split('+')]
+
+    def compile(self):
+        """Returns the filters as (attr, include, exclude) triples
+
+        A filter value matches the nodes having all of its '+' separated
+        terms, a term starting with '!' matches the nodes not having the
+        rest, ex. 'controller+!mongo'. A node passes the filter of an
+        attribute if it matches any of its values not starting with '!',
+        if there are such, and none of the values starting with '!', ex.
+        ['!controller', '!mongo']. include and exclude are lists of the
+        parsed values.
+        """
+        compiled = []
+        for attr in self._prepare_filter_attrs():
+            include = []
+            exclude = []
+            for value in utils.w_list(self.filters[attr]):
+                if isinstance(value, string_types) and value.startswith('!'):
+                    exclude.append(self._parse(value[1:]))
+                else:
+                    include.append(self._parse(value))
+            compiled.append((attr, include, exclude))
+        return compiled
+
+    @staticmethod
+    def _match(index, attr, terms):
+        """Returns positions of the nodes matching all terms"""
+        matched = index.all
+        for term, negated in terms:
+            if negated:
+                matched = matched - index.get(attr, term)
+            else:
+                matched = matched & index.get(attr, term)
+        return matched
+
+    def select(self, index):
+        """Returns positions of the nodes of a NodeIndex passing the filters"""
+        selected = index.all
+        for attr, include, exclude in self.compile():
+            if include:
+                matched = set()
+                for terms in include:
+                    matched |= self._match(index, attr, terms)
+                selected = selected & matched
+            for terms in exclude:
+                selected = selected - self._match(index, attr, terms)
+        if self.filters.get('online'):
+            selected = selected & index.get('online', True)
+        return selected
+
+
+class NodeIndex(object):
+    """Positions of the nodes of the Fuel nodes list by attribute value
+
+    The index of an attribute is built on its first lookup. Values are
+    compared as strings, list values (and roles given by the CLI as a comma
+    separated string) are indexed by each item.
+    """
+
+    def __init__(self, nodes_info):
+        self.nodes_info = nodes_info
+        self.all = frozenset(range(len(nodes_info)))
+        self.indexes = {}
+
+    @staticmethod
+    def _items(attr, value):
+        if isinstance(value, string_types):
+            if attr == 'roles':
+                return value.split(', ')
+            return [value]
+        if isinstance(value, Iterable):
+            return value
+        return [value]
+
+    def build(self, attr):
+        index = {}
+        for pos, node in enumerate(self.nodes_info):
+            for item in self._items(attr, node.get(attr)):
+                key = '%s' % (item,)
+                if key not in index:
+                    index[key] = set()
+                index[key].add(pos)
+        self.indexes[attr] = index
+        return index
+
+    def get(self, attr, value):
+        """Returns positions of the nodes having value of attr"""
+        index = self.indexes.get(attr)
+        if index is None:
+            index = self.build(attr)
+        return index.get('%s' % (value,), frozenset())
@@ -18,11 +18,13 @@ import logging
 import multiprocessing
 import os
 import pipes
+import Queue
+import shutil
 import subprocess
 import sys
 import tempfile
 import threading
-import yaml
+import time
 
 from cudet import exceptions
 from cudet import flock
@@ -30,6 +32,12 @@ from cudet import flock
 
 logger = logging.getLogger(__name__)
 
+# yaml module with its Loader and Dumper, see get_yaml
+_YAML = None
+
+# amount of command output which goes to the debug log
+LOG_PREVIEW_SIZE = 1024
+
 
 def interrupt_wrapper(f):
     def wrapper(*args, **kwargs):
@@ -74,7 +82,8 @@ class RunItem():
 
 
 class SemaphoreProcess(multiprocessing.Process):
-    def __init__(self, semaphore, target, args=None, queue=None, logger=None):
+    def __init__(self, semaphore, target, args=None, queue=None, logger=None,
+                 tag=None):
         super(SemaphoreProcess, self).__init__()
         self.logger = logger or logging.getLogger(__name__)
         self.semaphore = semaphore
@@ -83,57 +92,131 @@ class SemaphoreProcess(multiprocessing.Process):
             args = {}
         self.args = args
         self.queue = queue
+        self.tag = tag
+
+    def put_result(self, result):
+        if self.queue:
+            if self.tag is None:
+                self.queue.put_nowait(result)
+            else:
+                self.queue.put_nowait((self.tag, result))
 
     def run(self):
         try:
             result = self.target(**self.args)
-            if self.queue:
-                self.queue.put_nowait(result)
+            self.put_result(result)
         except Exception as error:
             self.logger.exception(error)
-            if self.queue:
-                self.queue.put_nowait(error)
+            self.put_result(error)
         finally:
             self.logger.debug('finished call: %s' % self.target)
-            self.semaphore.release()
-            self.logger.debug('semaphore released')
+            if self.semaphore:
+                self.semaphore.release()
+                self.logger.debug('semaphore released')
 
 
-def run_batch(item_list, maxthreads, dict_result=False):
-    def cleanup():
-        logger.debug('cleanup processes')
-        for run_item in item_list:
-            if run_item.process:
-                run_item.process.terminate()
-    semaphore = multiprocessing.BoundedSemaphore(maxthreads)
+def run_threads(funcs):
+    """Calls functions in threads and returns their results in order
+
+    The first exception raised by any of them is raised again once all
+    are done.
+    """
+    results = [None] * len(funcs)
+    errors = []
+
+    def call(index, func):
+        try:
+            results[index] = func()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = []
+    for index, func in enumerate(funcs):
+        t = threading.Thread(target=call, args=(index, func))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def run_batch_iter(item_list, maxthreads, limiter=None):
+    """Runs items in separate processes, at most maxthreads at a time
+
+    Yields (run_item, result) pairs in completion order, so results of fast
+    items are available while slow ones are still running. An exception
+    raised by an item's target is yielded as its result instead of stopping
+    the batch.
+
+    :param limiter: optional limiter.AdaptiveLimiter keyed by the items'
+                    keys, which further limits what may run at a time
+    """
+    queue = multiprocessing.Queue()
+    pending = list(enumerate(item_list))
+    pending.reverse()
+    running = {}
     try:
-        for run_item in item_list:
-            semaphore.acquire(True)
-            run_item.queue = multiprocessing.Queue()
-            p = SemaphoreProcess(target=run_item.target,
-                                 semaphore=semaphore,
-                                 args=run_item.args,
-                                 queue=run_item.queue)
-            run_item.process = p
-            p.start()
-        for run_item in item_list:
-            run_item.result = run_item.queue.get()
-            if isinstance(run_item.result, Exception):
-                logger.critical('%s, exiting' % run_item.result)
-                cleanup()
-                sys.exit(42)
+        while pending or running:
+            while pending and len(running) < maxthreads:
+                if limiter is None:
+                    index, run_item = pending.pop()
+                else:
+                    item = limiter.pop(pending, lambda i: i[1].key)
+                    if item is None:
+                        break
+                    index, run_item = item
+                p = SemaphoreProcess(target=run_item.target,
+                                     semaphore=None,
+                                     args=run_item.args,
+                                     queue=queue,
+                                     tag=index)
+                run_item.process = p
+                run_item.queue = queue
+                p.start()
+                running[index] = run_item
+            try:
+                index, result = queue.get(timeout=1)
+            except Queue.Empty:
+                for index, run_item in running.items():
+                    code = run_item.process.exitcode
+                    if code:
+                        del running[index]
+                        run_item.process = None
+                        result = exceptions.ProcessTerminated(
+                            'process exited with code %s' % code)
+                        if limiter is not None:
+                            limiter.release(run_item.key, result)
+                        yield run_item, result
+                continue
+            run_item = running.pop(index)
             run_item.process.join()
             run_item.process = None
-        if dict_result:
-            result = {}
-            for run_item in item_list:
-                result[run_item.key] = run_item.result
-            return result
-        else:
-            return [run_item.result for run_item in item_list]
-    except KeyboardInterrupt:
-        cleanup()
-        raise KeyboardInterrupt()
+            if limiter is not None:
+                limiter.release(run_item.key, result)
+            yield run_item, result
+    finally:
+        if running:
+            logger.debug('cleanup processes')
+        for run_item in running.values():
+            if run_item.process:
+                run_item.process.terminate()
+
+
+def run_batch(item_list, maxthreads, dict_result=False):
+    for run_item, result in run_batch_iter(item_list, maxthreads):
+        run_item.result = result
+        if isinstance(result, Exception):
+            logger.error('%s: %s' % (run_item.key, result))
+    if dict_result:
+        result = {}
+        for run_item in item_list:
+            result[run_item.key] = run_item.result
+        return result
+    else:
+        return [run_item.result for run_item in item_list]
 
 
 def load_json_file(filename):
@@ -152,13 +235,29 @@ def load_json_file(filename):
         sys.exit(1)
 
 
+def get_yaml():
+    """
+    Returns the yaml module and the safe Loader and Dumper to use with it,
+    the C ones when libyaml is available. yaml takes long to import and is
+    not needed by everything, ex. cudet -h, so it is imported on first use
+    """
+    global _YAML
+    if _YAML is None:
+        import yaml
+        _YAML = (yaml,
+                 getattr(yaml, 'CSafeLoader', yaml.SafeLoader),
+                 getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
+    return _YAML
+
+
 def load_yaml_file(filename):
     """
     Loads yaml data from file
     """
+    yaml, loader, dumper = get_yaml()
     try:
         with open(filename, 'r') as f:
-            return yaml.load(f)
+            return yaml.load(f, Loader=loader)
     except IOError as e:
         logger.critical("I/O error(%s): file: %s; msg: %s" %
                         (e.errno, e.filename, e.strerror))
@@ -166,12 +265,20 @@ def load_yaml_file(filename):
     except ValueError:
         logger.critical("Could not convert data")
         sys.exit(1)
-    except yaml.parser.ParserError as e:
+    except yaml.YAMLError as e:
         logger.critical("Could not parse %s:\n%s" %
                         (filename, str(e)))
         sys.exit(1)
 
 
+def dump_yaml(data, **kwargs):
+    """
+    Returns data as yaml, the way yaml.safe_dump does
+    """
+    yaml, loader, dumper = get_yaml()
+    return yaml.dump(data, Dumper=dumper, **kwargs)
+
+
 def mdir(directory):
     """
     Creates a directory if it doesn't exist
@@ -185,7 +292,24 @@ def mdir(directory):
             sys.exit(3)
 
 
-def launch_cmd(cmd, timeout, input=None, ok_codes=None):
+def log_preview(data, size=None):
+    """Returns the beginning of data suitable for logging"""
+    if size is None:
+        size = LOG_PREVIEW_SIZE
+    if data is None or len(data) <= size:
+        return data
+    return '%s... [%d bytes total]' % (data[:size], len(data))
+
+
+def launch_cmd(cmd, timeout, input=None, ok_codes=None, stdout=None,
+               timing=None):
+    """Runs a shell command and returns its stdout, stderr and exit code
+
+    :param stdout: file object to stream the command's stdout into, as is,
+                   instead of returning it, None is returned in its place
+    :param timing: dict to record runtime, exit_code, stdout_bytes and
+                   stderr_bytes of the command into
+    """
     def _timeout_terminate(pid):
         try:
             os.kill(pid, 15)
@@ -193,46 +317,119 @@ def launch_cmd(cmd, timeout, input=None, ok_codes=None):
         except:
             pass
 
+    def _decode(outs, errs):
+        if timing is not None:
+            if stdout is None:
+                timing['stdout_bytes'] = len(outs)
+            else:
+                timing['stdout_bytes'] = os.fstat(stdout.fileno()).st_size
+            timing['stderr_bytes'] = len(errs)
+        if outs is not None:
+            outs = outs.decode('utf-8')
+        errs = errs.decode('utf-8')
+        errs = errs.rstrip('\n')
+        return outs, errs
+
     logger.info('launching cmd %s' % cmd)
+    start = time.time()
     p = subprocess.Popen(cmd,
                          shell=True,
                          stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
+                         stdout=stdout or subprocess.PIPE,
                          stderr=subprocess.PIPE)
     timeout_killer = None
     try:
         timeout_killer = threading.Timer(timeout, _timeout_terminate, [p.pid])
         timeout_killer.start()
-        outs, errs = p.communicate(input=input)
-        outs = outs.decode('utf-8')
-        errs = errs.decode('utf-8')
-        errs = errs.rstrip('\n')
+        outs, errs = _decode(*p.communicate(input=input))
     except:
         try:
             p.kill()
         except:
             pass
         p.stdin = None
-        outs, errs = p.communicate()
-        outs = outs.decode('utf-8')
-        errs = errs.decode('utf-8')
-        errs = errs.rstrip('\n')
+        outs, errs = _decode(*p.communicate())
     finally:
         if timeout_killer:
             timeout_killer.cancel()
-        input = input.decode('utf-8') if input else None
-        logger.debug(('___command: %s\n'
-                      '_exit_code: %s\n'
-                      '_____stdin: %s\n'
-                      '____stdout: %s\n'
-                      '____stderr: %s') % (cmd, p.returncode, input, outs,
-                                           errs))
+        if timing is not None:
+            timing['runtime'] = time.time() - start
+            timing['exit_code'] = p.returncode
+        if logger.isEnabledFor(logging.DEBUG):
+            input = input.decode('utf-8') if input else None
+            if stdout is None:
+                log_outs = log_preview(outs)
+            else:
+                log_outs = file_preview(getattr(stdout, 'name', None))
+            logger.debug(('___command: %s\n'
+                          '_exit_code: %s\n'
+                          '_____stdin: %s\n'
+                          '____stdout: %s\n'
+                          '____stderr: %s') % (cmd, p.returncode,
+                                               log_preview(input), log_outs,
+                                               errs))
     return outs, errs, p.returncode
 
 
-def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
-             filename=None, inputfile=None, outputfile=None,
-             ok_codes=None, input=None, prefix=None):
+def file_preview(filename, size=None):
+    """Returns the beginning of a file suitable for logging"""
+    if size is None:
+        size = LOG_PREVIEW_SIZE
+    try:
+        with open(filename, 'r') as f:
+            data = f.read(size).decode('utf-8', 'replace')
+            total = os.fstat(f.fileno()).st_size
+    except (IOError, TypeError):
+        return None
+    if total > len(data):
+        data = '%s... [%d bytes total]' % (data, total)
+    return data
+
+
+def is_local(ip):
+    return (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.')
+
+
+class SSHControlPool(object):
+    """Multiplexed ssh connections, one master per node
+
+    The first ssh call to a node made with ``ssh_opts`` becomes a
+    ControlMaster which keeps running in the background, every later call
+    to the same node is passed through its control socket instead of doing
+    a full handshake. ``close`` stops all masters and removes the sockets.
+    """
+
+    def __init__(self, persist=60, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.directory = tempfile.mkdtemp(prefix='cudet-ssh-')
+        self.ssh_opts = ['-oControlMaster=auto',
+                         '-oControlPath=%s' % os.path.join(self.directory,
+                                                           '%h'),
+                         '-oControlPersist=%s' % persist]
+
+    def close(self):
+        if not os.path.isdir(self.directory):
+            return
+        # all masters are stopped at once, a run leaves one per node
+        procs = []
+        with open(os.devnull, 'r+') as devnull:
+            for ip in os.listdir(self.directory):
+                path = os.path.join(self.directory, ip)
+                procs.append((ip, subprocess.Popen(
+                    ['timeout', '15', 'ssh', '-O', 'exit',
+                     '-oControlPath=%s' % path, ip],
+                    stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)))
+        for ip, p in procs:
+            errs = p.communicate()[1]
+            if p.returncode:
+                self.logger.debug('ssh master for %s: %s' %
+                                  (ip, errs.decode('utf-8').rstrip('\n')))
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def ssh_node_cmd(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
+                 filename=None, inputfile=None, outputfile=None, prefix=None):
+    """Returns the shell command used by ssh_node to run on a node"""
     if ssh_opts is None:
         ssh_opts = ''
     if env_vars is None:
@@ -243,7 +440,7 @@ def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
         ssh_opts = ' '.join(ssh_opts)
     if type(env_vars) is list:
         env_vars = ' '.join(env_vars)
-    if (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.'):
+    if is_local(ip):
         logger.info("skip ssh")
         bstr = "%s timeout '%s' bash -c " % (
                env_vars, timeout)
@@ -252,21 +449,36 @@ def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
         bstr = "timeout '%s' ssh -t -T %s '%s' '%s' " % (
                timeout, ssh_opts, ip, env_vars)
     if filename is None:
-        cmd = '%s %s' % (bstr, pipes.quote(prefix + ' ' + command))
+        cmd = '%s %s <&3 3<&-' % (bstr, pipes.quote(prefix + ' ' + command))
         if inputfile is not None:
-            '''inputfile and stdin will not work together,
-            give priority to inputfile'''
-            input = None
             cmd = "%s < '%s'" % (cmd, inputfile)
     else:
-        cmd = "%s'%s bash -s' < '%s'" % (bstr, prefix, filename)
+        cmd = "%s'%s bash -s' 3<&- < '%s'" % (bstr, prefix, filename)
         logger.info("inputfile selected, cmd: %s" % cmd)
     if outputfile is not None:
         cmd = "%s > '%s'" % (cmd, outputfile)
-    cmd = ("input=\"$(cat | xxd -p)\"; trap 'kill $pid' 15; " +
-           "trap 'kill $pid' 2; echo -n \"$input\" | xxd -r -p | " + cmd +
-           ' &:; pid=$!; wait $!')
-    return launch_cmd(cmd, timeout, input=input, ok_codes=ok_codes)
+    '''the command runs in background so that the traps can forward
+    signals to it, a background command gets /dev/null as stdin, so
+    the shell's stdin is passed to it as fd 3'''
+    cmd = ("trap 'kill $pid' 15; trap 'kill $pid' 2; exec 3<&0; " + cmd +
+           ' & pid=$!; wait $!')
+    return cmd
+
+
+def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
+             filename=None, inputfile=None, outputfile=None,
+             ok_codes=None, input=None, prefix=None, stdout=None,
+             timing=None):
+    if filename is None and inputfile is not None:
+        '''inputfile and stdin will not work together,
+        give priority to inputfile'''
+        input = None
+    cmd = ssh_node_cmd(ip, command=command, ssh_opts=ssh_opts,
+                       env_vars=env_vars, timeout=timeout, filename=filename,
+                       inputfile=inputfile, outputfile=outputfile,
+                       prefix=prefix)
+    return launch_cmd(cmd, timeout, input=input, ok_codes=ok_codes,
+                      stdout=stdout, timing=timing)
 
 
 # wrap non-list into list
@@ -0,0 +1,555 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Package versions of MOS releases, looked up in the versions databases
+"""
+
+import hashlib
+import logging
+import marshal
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from cudet.vercmp import vercmp
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'versions_os_package'
+
+# bytes of a database read through mmap, see connect
+MMAP_SIZE = 256 * 1024 * 1024
+
+# read-only connections by database file, see connect
+_connections = {}
+# md5s of databases, see md5_file
+_md5s = {}
+_uri = None
+
+# rows of a release and OS in the order max_version is computed in
+QUERY = '''
+    SELECT
+        mu,
+        package_name,
+        package_version
+    FROM versions
+    WHERE os = ? AND release = ?%s
+    ORDER BY package_name ASC, mu DESC, id ASC
+    '''
+
+
+def print_mu(mu):
+    return 'MU'+str(mu) if mu > 0 else 'GA'
+
+
+def md5_file(db_file, cache_dir=None):
+    """Returns the md5 of a database
+
+    The md5 is computed once per process for the same file, inode, size
+    and mtime. With cache_dir, it is also kept there for the next runs
+    (see md5_cache_file), which only read the database again once it has
+    changed.
+    """
+    path = os.path.abspath(db_file)
+    st = os.stat(path)
+    stamp = '%d %d %r' % (st.st_ino, st.st_size, st.st_mtime)
+    md5 = _md5s.get((path, stamp))
+    if md5 is not None:
+        return md5
+    cache_file = cache_dir and md5_cache_file(path, cache_dir)
+    if cache_file:
+        md5 = read_md5(cache_file, stamp)
+    if md5 is None:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        md5 = digest.hexdigest()
+        if cache_file:
+            write_md5(cache_file, stamp, md5)
+    _md5s[(path, stamp)] = md5
+    return md5
+
+
+def md5_cache_file(db_file, cache_dir):
+    """Returns the file in cache_dir the md5 of a database is kept in
+
+    It is in the md5 subdirectory, apart from the copies, named after the
+    database and the md5 of its absolute path, as databases of different
+    releases have the same name.
+    """
+    path = os.path.abspath(db_file)
+    return os.path.join(os.path.expanduser(cache_dir), 'md5', '%s-%s.md5' %
+                        (os.path.basename(path),
+                         hashlib.md5(path).hexdigest()))
+
+
+def read_md5(cache_file, stamp):
+    """Returns the md5 kept in cache_file, None if stamp does not match"""
+    try:
+        with open(cache_file, 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    if len(lines) == 2 and lines[0] == stamp and len(lines[1]) == 32:
+        return lines[1]
+    return None
+
+
+def write_md5(cache_file, stamp, md5):
+    """Keeps the md5 of a database with the stamp of the file it is of"""
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.',
+                                        suffix='.md5')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('%s\n%s\n' % (stamp, md5))
+            os.rename(tmp_file, cache_file)
+        except:
+            os.remove(tmp_file)
+            raise
+    except (IOError, OSError) as e:
+        logger.info('could not save md5 %s: %s' % (cache_file, e))
+
+
+def uri_supported():
+    """Whether sqlite3 takes URI file names, Python 2 cannot ask for them"""
+    global _uri
+    if _uri is None:
+        c = sqlite3.connect(':memory:')
+        try:
+            options = [o for o, in c.execute('PRAGMA compile_options')]
+        finally:
+            c.close()
+        _uri = 'USE_URI' in options or 'USE_URI=1' in options
+    return _uri
+
+
+def connect(db_file):
+    """Returns a read-only connection to a database
+
+    Databases are opened once per process and stay open until
+    close_connections. They are read through mmap, so that processes
+    reading the same database share the page cache. Where sqlite3 takes
+    URI file names, databases are opened as immutable, which also spares
+    locking. Such files must never change in place, and nothing in cudet
+    writes them: indexed copies are made under a temporary name (see
+    VersionsDB.create_index) and databases are only replaced by rename
+    (see VersionsSync.download), readers keep the file they opened.
+    Otherwise the connection is made read-only with PRAGMA query_only.
+    """
+    path = os.path.abspath(db_file)
+    c = _connections.get(path)
+    if c is None:
+        if uri_supported():
+            uri = path
+            for char, code in (('%', '%25'), ('?', '%3f'), ('#', '%23')):
+                uri = uri.replace(char, code)
+            c = sqlite3.connect('file:%s?mode=ro&immutable=1' % uri)
+        else:
+            c = sqlite3.connect(path)
+            c.execute('PRAGMA query_only = ON')
+        c.execute('PRAGMA mmap_size = %d' % MMAP_SIZE)
+        _connections[path] = c
+    return c
+
+
+def close_connection(db_file):
+    c = _connections.pop(os.path.abspath(db_file), None)
+    if c is not None:
+        c.close()
+
+
+def close_connections():
+    for path in _connections.keys():
+        close_connection(path)
+
+
+class VersionsDB(object):
+    """Versions of the packages of a release for an OS
+
+    Packages are looked up on demand, only the packages asked for are read
+    from the database, in batches of at most batch_size names, and kept.
+    If the database has no index on (os, package_name, package_version),
+    the first lookup makes a copy of it with the index in cache_dir, named
+    after the md5 of the database, which the next runs use as long as the
+    database does not change. The database itself is never written, without
+    cache_dir, or if the copy cannot be made, lookups go without the index.
+    Databases are read through the shared read-only connections (see
+    connect).
+
+    Each package is a dict with the MUs it was shipped in ('mu'), the MUs of
+    each of its versions ('versions') and the latest version of the latest
+    MU ('max_version').
+    """
+
+    # below SQLITE_MAX_VARIABLE_NUMBER, which is 999 by default
+    batch_size = 500
+
+    def __init__(self, db_file, release, os_platform, cache_dir=None,
+                 logger=None):
+        self.db_file = db_file
+        self.release = release
+        self.os_platform = os_platform
+        self.cache_dir = cache_dir and os.path.expanduser(cache_dir)
+        self.logger = logger or logging.getLogger(__name__)
+        # the database or its indexed copy, which is looked up in
+        self.connection = None
+        self.connection_file = None
+        # packages looked up so far, None for those not in the database
+        self.cache = {}
+
+    def connect(self):
+        if self.connection is None:
+            self.connection_file = self.db_file
+            if not self.has_index():
+                self.connection_file = self.indexed_file() or self.db_file
+            self.connection = connect(self.connection_file)
+        return self.connection
+
+    def has_index(self):
+        return bool(connect(self.db_file).execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            'AND name = ?', (INDEX_NAME,)).fetchone())
+
+    def prepared(self):
+        """Whether lookups can start without building anything first"""
+        return (self.connection is not None or self.cache_dir is None or
+                self.has_index() or os.path.isfile(self.indexed_name()))
+
+    def build(self):
+        """Builds what the lookups need, in a worker process of load
+
+        Returns what built takes in the main process.
+        """
+        self.indexed_file()
+
+    def built(self, result):
+        pass
+
+    def load(self):
+        self.connect()
+
+    def cache_prefix(self):
+        return '%s-%s-%s-' % (os.path.basename(self.db_file), self.release,
+                              self.os_platform)
+
+    def indexed_name(self):
+        return os.path.join(self.cache_dir, '%s%s.sqlite' %
+                            (self.cache_prefix(),
+                             md5_file(self.db_file, self.cache_dir)))
+
+    def indexed_file(self):
+        """Returns the copy of the database with the index, None if none"""
+        if self.cache_dir is None:
+            return None
+        indexed_file = self.indexed_name()
+        if not os.path.isfile(indexed_file):
+            try:
+                self.create_index(indexed_file)
+            except (IOError, OSError, sqlite3.Error) as e:
+                self.logger.info('could not index %s: %s' % (self.db_file, e))
+                return None
+        return indexed_file
+
+    def create_index(self, indexed_file):
+        """Makes an indexed copy of the database
+
+        The copy is indexed under a temporary name and renamed into place,
+        so that indexed_file never changes once it exists, as connect
+        requires. Copies for other md5s of the database are removed.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, prefix='.',
+                                        suffix='.sqlite')
+        os.close(fd)
+        try:
+            shutil.copyfile(self.db_file, tmp_file)
+            c = sqlite3.connect(tmp_file)
+            try:
+                with c:
+                    c.execute('CREATE INDEX IF NOT EXISTS %s ON versions '
+                              '(os, package_name, package_version)' %
+                              INDEX_NAME)
+            finally:
+                c.close()
+            os.rename(tmp_file, indexed_file)
+        except:
+            os.remove(tmp_file)
+            raise
+        remove_other_md5s(indexed_file, self.cache_prefix(), '.sqlite')
+
+    def packages(self, names):
+        """Returns a dict of the packages with the given names
+
+        Packages which are not in the database are left out.
+        """
+        missing = [n for n in set(names) if n not in self.cache]
+        for i in range(0, len(missing), self.batch_size):
+            self._load(missing[i:i + self.batch_size])
+        result = {}
+        for name in names:
+            if self.cache[name] is not None:
+                result[name] = self.cache[name]
+        return result
+
+    def get(self, name):
+        return self.packages([name]).get(name)
+
+    def _load(self, names):
+        for name in names:
+            self.cache[name] = None
+        rows = self.connect().execute(
+            QUERY % (' AND package_name IN (%s)' %
+                     ', '.join(['?'] * len(names))),
+            [self.os_platform, self.release] + list(names))
+        self._compile(rows)
+
+    def compile_all(self):
+        """Reads all packages of the release and OS"""
+        self.cache = {}
+        try:
+            self._compile(connect(self.db_file).execute(
+                QUERY % '', [self.os_platform, self.release]))
+        finally:
+            close_connection(self.db_file)
+
+    def _compile(self, rows):
+        for mu, p_name, p_version in rows:
+            p_dict = self.cache.get(p_name)
+            if p_dict is None:
+                p_dict = self.cache[p_name] = {'mu': set(), 'versions': {}}
+            self._add(p_dict, mu, p_name, p_version)
+
+    def _add(self, p_dict, mu, p_name, p_version):
+        p_dict['mu'].add(mu)
+        if p_version not in p_dict['versions']:
+            p_dict['versions'][p_version] = set()
+        if 'max_version' not in p_dict:
+            p_dict['max_version'] = p_version
+        else:
+            r = vercmp(self.os_platform, p_version, p_dict['max_version'])
+            max_v_mus = p_dict['versions'][p_dict['max_version']]
+            if r > 0 and mu not in max_v_mus:
+                '''Should never happen since the MU order is DESC.
+                If this happens then it means that package version was
+                lowered in a subsequent MU, which is against our policy as
+                of Feb 2016.'''
+                self.logger.warning('Downgrade detected in release '
+                                    '%s, os %s, %s to %s, package %s - '
+                                    "version '%s' was downgraded to '%s'\n"
+                                    % (self.release, self.os_platform,
+                                       print_mu(mu),
+                                       print_mu(min(max_v_mus)), p_name,
+                                       p_version, p_dict['max_version']))
+            elif r > 0:
+                p_dict['max_version'] = p_version
+        p_dict['versions'][p_version].add(mu)
+
+    def close(self):
+        """Closes the connections to the database and to its copy"""
+        close_connection(self.db_file)
+        if self.connection is not None:
+            close_connection(self.connection_file)
+            self.connection = None
+
+
+class VersionsCache(VersionsDB):
+    """Versions of the packages of a release for an OS, compiled once
+
+    All packages of the release and OS are compiled from the database into
+    a marshal file in cache_dir named after the md5 of the database, the
+    next runs only read that file as long as the database does not change.
+    Files of other md5s of the database are removed.
+    """
+
+    # bump when the compiled data changes
+    version = 1
+
+    def __init__(self, db_file, release, os_platform, cache_dir,
+                 logger=None):
+        super(VersionsCache, self).__init__(db_file, release, os_platform,
+                                            cache_dir, logger)
+        self.loaded = False
+
+    def packages(self, names):
+        if not self.loaded:
+            self.load()
+        result = {}
+        for name in names:
+            if name in self.cache:
+                result[name] = self.cache[name]
+        return result
+
+    def cache_file(self):
+        return os.path.join(self.cache_dir, '%s%s.v%d.marshal' %
+                            (self.cache_prefix(),
+                             md5_file(self.db_file, self.cache_dir),
+                             self.version))
+
+    def load(self):
+        if not self.read():
+            self.compile_all()
+            self.compiled(self.cache)
+
+    def prepared(self):
+        return self.loaded or self.read()
+
+    def build(self):
+        self.compile_all()
+        # marshalled to be sent back compactly
+        return marshal.dumps(self.cache)
+
+    def built(self, result):
+        self.compiled(marshal.loads(result))
+
+    def read(self):
+        """Reads the cache file, returns False if it has to be compiled"""
+        cache_file = self.cache_file()
+        try:
+            with open(cache_file, 'rb') as f:
+                self.cache = marshal.load(f)
+        except IOError:
+            return False
+        except (EOFError, ValueError, TypeError) as e:
+            self.logger.warning('versions cache %s is broken, rebuilding: '
+                                '%s' % (cache_file, e))
+            return False
+        self.loaded = True
+        return True
+
+    def compiled(self, cache):
+        """Takes the packages compiled from the database and saves them"""
+        self.cache = cache
+        self.loaded = True
+        cache_file = self.cache_file()
+        try:
+            self.save(cache_file)
+        except (IOError, OSError) as e:
+            self.logger.info('could not save versions cache %s: %s' %
+                             (cache_file, e))
+
+    def save(self, cache_file):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(self.cache, f)
+            os.rename(tmp_file, cache_file)
+        except:
+            os.remove(tmp_file)
+            raise
+        remove_other_md5s(cache_file, self.cache_prefix(),
+                          '.v%d.marshal' % self.version)
+
+
+def remove_other_md5s(keep, prefix, suffix):
+    """Removes the files made for other md5s of a database but keep
+
+    :param prefix: the start of the names of the files made for the database
+    :param suffix: the end of the names of the files of this kind
+    """
+    cache_dir = os.path.dirname(keep)
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if (name.startswith(prefix) and name.endswith(suffix) and
+                path != keep):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def build_db(args):
+    """Builds what a database needs for lookups in a pool worker process
+
+    :param args: the VersionsDB class of the database, then db_file,
+                 release, os_platform and cache_dir
+    :returns: the result of its build method
+    """
+    return args[0](*args[1:]).build()
+
+
+class VersionsIndex(object):
+    """VersionsDB of every release and OS which has a database
+
+    :param backend: 'index' - look packages up in the databases, or their
+                    indexed copies in cache_dir, on demand (VersionsDB),
+                    'cache' - read all packages from a cache compiled in
+                    cache_dir (VersionsCache)
+    """
+
+    def __init__(self, backend='index', cache_dir=None, logger=None):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.logger = logger or logging.getLogger(__name__)
+        self.dbs = {}
+
+    def add(self, release, os_platform, db_file):
+        if self.backend == 'cache':
+            db = VersionsCache(db_file, release, os_platform, self.cache_dir,
+                               self.logger)
+        else:
+            db = VersionsDB(db_file, release, os_platform, self.cache_dir,
+                            self.logger)
+        self.dbs[(release, os_platform)] = db
+
+    def load(self, processes=None):
+        """Prepares all databases for lookups
+
+        Caches of the cache backend and indexed copies of the index backend
+        which have to be made are made at once in up to processes (by
+        default, as many as there are CPUs) worker processes, so that it
+        takes about as long as for the largest database. No worker
+        processes are started for a single database or a single process.
+        """
+        missing = [db for db in self.dbs.values() if not db.prepared()]
+        processes = min(len(missing),
+                        processes or multiprocessing.cpu_count())
+        if processes < 2:
+            for db in missing:
+                db.load()
+            return
+        self.logger.info('preparing %d versions databases in %d processes' %
+                         (len(missing), processes))
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(build_db, [(type(db), db.db_file, db.release,
+                                           db.os_platform, db.cache_dir)
+                                          for db in missing])
+        finally:
+            pool.close()
+            pool.join()
+        for db, result in zip(missing, results):
+            db.built(result)
+
+    def get(self, release, os_platform):
+        """Returns the VersionsDB of a release and OS, None if none"""
+        return self.dbs.get((release, os_platform))
+
+    def __len__(self):
+        return len(self.dbs)
+
+    def close(self):
+        for db in self.dbs.values():
+            db.close()
@@ -0,0 +1,147 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Keeping the versions databases up to date with the mirror
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from cudet import utils
+from cudet import versions_db
+
+
+logger = logging.getLogger(__name__)
+
+# results of VersionsSync.sync
+CURRENT = 'current'
+# the mirror had another database, which replaced the local one
+UPDATED = 'updated'
+UPDATE_FAILED = 'update failed'
+# the mirror could not be checked, the local database is used
+UNKNOWN = 'unknown'
+# there was no local database, the one on the mirror was downloaded
+DOWNLOADED = 'downloaded'
+MISSING = 'missing'
+
+SQLITE_HEADER = 'SQLite format 3\0'
+
+
+class VersionsSync(object):
+    """Checks the versions databases against the mirror and updates them
+
+    The mirror has <release>/<os>-latest.sqlite and the .md5 of each. A
+    database is downloaded to a temporary file next to the local one,
+    which replaces it only once its md5 matches the mirror's and it is an
+    SQLite database. All databases are checked at once, every request to
+    the mirror times out after timeout seconds. The md5s of the local
+    databases are kept in cache_dir, if given, so that a database is only
+    read to compute its md5 after it has changed (see versions_db.md5_file).
+    """
+
+    def __init__(self, mirror, timeout=10, cache_dir=None, logger=None):
+        self.mirror = mirror.rstrip('/')
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.logger = logger or logging.getLogger(__name__)
+
+    def url(self, release, os_platform, ext):
+        return '%s/%s/%s-latest.%s' % (self.mirror, release, os_platform,
+                                       ext)
+
+    def open(self, url):
+        # urllib2 is slow to import and only needed here
+        import urllib2
+        return urllib2.urlopen(url, timeout=self.timeout)
+
+    def fetch_md5(self, release, os_platform):
+        """Returns the md5 of the database on the mirror, None if unknown"""
+        url = self.url(release, os_platform, 'md5')
+        try:
+            response = self.open(url)
+            try:
+                md5 = response.read(1024).split()
+            finally:
+                response.close()
+        except Exception as e:
+            self.logger.info('could not get %s: %s' % (url, e))
+            return None
+        return md5[0] if md5 else None
+
+    def download(self, release, os_platform, db_file, md5=None):
+        """Replaces db_file with the database on the mirror
+
+        The directory of db_file must exist.
+
+        :param md5: md5 the database must have, not checked if None
+        :returns: True if db_file was replaced
+        """
+        url = self.url(release, os_platform, 'sqlite')
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(db_file),
+                                        prefix='.%s-' %
+                                        os.path.basename(db_file))
+        try:
+            digest = hashlib.md5()
+            with os.fdopen(fd, 'wb') as f:
+                response = self.open(url)
+                try:
+                    for chunk in iter(lambda: response.read(65536), ''):
+                        digest.update(chunk)
+                        f.write(chunk)
+                finally:
+                    response.close()
+            digest = digest.hexdigest()
+            with open(tmp_file, 'rb') as f:
+                if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                    raise ValueError('not an SQLite database')
+            if md5 is not None and digest != md5:
+                raise ValueError('md5 %s does not match %s' % (digest, md5))
+            # mkstemp creates files readable by the owner only
+            os.chmod(tmp_file, 0o644)
+            # a connection open here would go on reading the replaced file
+            versions_db.close_connection(db_file)
+            os.rename(tmp_file, db_file)
+        except Exception as e:
+            self.logger.info('could not download %s: %s' % (url, e))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        return True
+
+    def sync(self, release, os_platform, db_file):
+        """Brings a database up to date, returns what was done"""
+        md5 = self.fetch_md5(release, os_platform)
+        if not os.path.isfile(db_file):
+            if self.download(release, os_platform, db_file, md5):
+                return DOWNLOADED
+            return MISSING
+        if md5 is None:
+            return UNKNOWN
+        if md5 == versions_db.md5_file(db_file, self.cache_dir):
+            return CURRENT
+        if self.download(release, os_platform, db_file, md5):
+            return UPDATED
+        return UPDATE_FAILED
+
+    def sync_all(self, dbs):
+        """Brings databases up to date, all at once
+
+        :param dbs: list of (release, os_platform, db_file)
+        :returns: the results of sync, in the same order
+        """
+        return utils.run_threads([
+            lambda db=db: self.sync(*db) for db in dbs])
@@ -0,0 +1,151 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from six import StringIO
+
+from cudet import configuration
+from cudet.nodes import Node
+
+
+B = 'cudet-0123456789abcdef'
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+class SplitBatchOutputTest(unittest.TestCase):
+    """Node._split_batch_output on framed session output"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        self.jobs = [{'dfile': os.path.join(self.tmpdir, 'job-%d' % i)}
+                     for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def split(self, text):
+        return Node._split_batch_output(StringIO(text), B, self.jobs)
+
+    def test_jobs_are_split(self):
+        timings = self.split('%s 0 10.0\none\ntwo\n\n%s 0 0 12.5\n'
+                             '%s 1 13.0\n\n%s 1 3 13.25\n' % (B, B, B, B))
+        self.assertEqual(read(self.jobs[0]['dfile']), 'one\ntwo\n')
+        self.assertEqual(read(self.jobs[1]['dfile']), '')
+        self.assertEqual(timings, {0: {'runtime': 2.5, 'exit_code': 0,
+                                       'stdout_bytes': 8},
+                                   1: {'runtime': 0.25, 'exit_code': 3,
+                                       'stdout_bytes': 0}})
+        self.assertFalse(os.path.exists(self.jobs[2]['dfile']))
+
+    def test_output_without_trailing_newline(self):
+        timings = self.split('%s 0 1.0\nno newline\n%s 0 0 2.0\n' % (B, B))
+        self.assertEqual(read(self.jobs[0]['dfile']), 'no newline')
+        self.assertEqual(timings[0]['stdout_bytes'], len('no newline'))
+
+    def test_boundary_inside_a_line_is_output(self):
+        text = 'x%s 0 0 2.0' % B
+        self.split('%s 0 1.0\n%s\n\n%s 0 0 2.0\n' % (B, text, B))
+        self.assertEqual(read(self.jobs[0]['dfile']), text + '\n')
+
+    def test_long_lines(self):
+        long_line = 'a' * 65535 + B + ' 0 0 2.0'
+        self.split('%s 0 1.0\n%s\n\n%s 0 0 2.0\n' % (B, long_line, B))
+        self.assertEqual(read(self.jobs[0]['dfile']), long_line + '\n')
+
+    def test_unfinished_job(self):
+        timings = self.split('%s 0 1.0\nfirst\n\n%s 0 0 2.0\n'
+                             '%s 1 2.0\npartial\n' % (B, B, B))
+        self.assertEqual(list(timings), [0])
+        self.assertEqual(read(self.jobs[1]['dfile']), 'partial\n')
+
+
+class BatchJobTest(unittest.TestCase):
+    """A batch session run by bash, split back by job_done"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        conf = configuration.CudetConfig()
+        self.node = Node(id=1, name='node-1', fqdn='node-1', mac='n/a',
+                         cluster=1, release='9.0', roles=['compute'],
+                         os_platform='ubuntu', online=True, status='ready',
+                         ip='127.0.0.1', conf=conf,
+                         logger=logging.getLogger('test'))
+        self.node.reset_timings()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def job(self, name, **args):
+        args.setdefault('env_vars', '')
+        args.setdefault('prefix', '')
+        args.setdefault('timeout', 10)
+        return {'map': Node.ckey if 'command' in args else Node.skey,
+                'key': name,
+                'label': name,
+                'dfile': os.path.join(self.tmpdir, name),
+                'args': args}
+
+    def run_batch(self, jobs):
+        batch = self.node.get_batch_job(jobs, self.tmpdir)
+        with open(batch['dfile'], 'w') as out:
+            p = subprocess.Popen(['bash', batch['args']['filename']],
+                                 stdout=out, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+            errs = p.communicate()[1]
+        self.node.job_done(batch, errs, p.returncode)
+        self.assertFalse(os.path.exists(batch['dfile']))
+        self.assertFalse(os.path.exists(batch['args']['filename']))
+        return dict([(t['name'], t) for t in self.node.timings['jobs']])
+
+    def test_jobs_keep_their_output(self):
+        script = os.path.join(self.tmpdir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('echo "script $X"\necho oops >&2\nexit 2')
+        jobs = [self.job('hello', command='echo hello; echo world'),
+                self.job('script.sh', filename=script, env_vars=['X=1']),
+                self.job('quiet', command='printf partial')]
+        timings = self.run_batch(jobs)
+        self.assertEqual(read(jobs[0]['dfile']), 'hello\nworld\n')
+        self.assertEqual(read(jobs[1]['dfile']), 'script 1\n')
+        self.assertEqual(read(jobs[2]['dfile']), 'partial')
+        self.assertEqual(timings['hello']['exit_code'], 0)
+        self.assertTrue(timings['hello']['ok'])
+        self.assertEqual(timings['hello']['stderr_bytes'], 0)
+        self.assertEqual(timings['script.sh']['exit_code'], 2)
+        self.assertFalse(timings['script.sh']['ok'])
+        self.assertEqual(timings['script.sh']['stderr_bytes'],
+                         len('oops'))
+        self.assertEqual(timings['quiet']['stdout_bytes'], len('partial'))
+
+    def test_timeout_of_one_job(self):
+        jobs = [self.job('slow', command='sleep 5', timeout=1),
+                self.job('fast', command='echo done')]
+        timings = self.run_batch(jobs)
+        self.assertEqual(timings['slow']['exit_code'], 124)
+        self.assertEqual(timings['fast']['exit_code'], 0)
+        self.assertEqual(read(jobs[1]['dfile']), 'done\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
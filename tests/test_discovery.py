@@ -0,0 +1,210 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib2
+
+from cudet import configuration
+from cudet import fuel_client
+from cudet import nodes
+from cudet import utils
+
+
+UTIL_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'util')
+NODES = 10
+# seconds each Fuel API request takes
+DELAY = 0.5
+
+
+class Client(object):
+    """fuelclient stand-in, opening a new connection for every request"""
+
+    auth_token = ''
+
+    def __init__(self, url):
+        self.url = url
+        self.requests = []
+
+    def get_request(self, api):
+        self.requests.append(api)
+        return json.loads(urllib2.urlopen('%s/api/v1/%s' %
+                                          (self.url, api)).read())
+
+
+class DiscoveryTest(unittest.TestCase):
+    """NodeManager.discover against util/fake-fuel-api.py
+
+    The fuel CLI is util/fake-fuel, run through util/fake-ssh, which logs
+    every ssh handshake.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = subprocess.Popen(
+            [sys.executable, os.path.join(UTIL_DIR, 'fake-fuel-api.py'),
+             '--port', '0', '--nodes', str(NODES), '--clusters', '2',
+             '--delay', str(DELAY), '--connect-delay', '0'],
+            stdout=subprocess.PIPE)
+        cls.port = int(cls.server.stdout.readline())
+        cls.url = 'http://127.0.0.1:%d' % cls.port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        for name in ('fake-ssh', 'fake-fuel'):
+            os.symlink(os.path.join(UTIL_DIR, name),
+                       os.path.join(self.tmpdir, name[len('fake-'):]))
+        self.ssh_log = os.path.join(self.tmpdir, 'ssh.log')
+        self.environ = dict(os.environ)
+        os.environ.update({'PATH': self.tmpdir + os.pathsep +
+                           os.environ['PATH'],
+                           'FAKE_SSH_DELAY': '0',
+                           'FAKE_SSH_LOG': self.ssh_log,
+                           'FAKE_FUEL_STARTUP': '0',
+                           'FAKE_FUEL_API': self.url})
+        self.conf = configuration.CudetConfig()
+        self.conf['fuel_port'] = self.port
+        self.conf['fuel_http_proxy'] = ''
+        self.conf['ssh_opts'] = []
+        self.conf['timeout'] = 30
+        self.ssh_node = utils.ssh_node
+
+    def tearDown(self):
+        utils.ssh_node = self.ssh_node
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def make_manager(self, client):
+        nm = nodes.NodeManager.__new__(nodes.NodeManager)
+        nm.conf = self.conf
+        nm.logger = logging.getLogger('test')
+        nm.nodes = {}
+        nm.fuel_client = client
+        nm.fuel_session = None
+        nm.fuel_cli_results = {}
+        nm.cli_creds = ''
+        if client is not None:
+            nm.fuel_session = fuel_client.FuelSession(client, self.conf)
+        return nm
+
+    def stats(self):
+        return json.loads(urllib2.urlopen(self.url + '/stats').read())
+
+    def handshakes(self):
+        if not os.path.exists(self.ssh_log):
+            return 0
+        with open(self.ssh_log, 'r') as f:
+            return len(f.readlines())
+
+    def check_discovered(self, nm):
+        self.assertEqual(len(nm.nodes_json), NODES)
+        self.assertEqual(nm.master_release, '9.0')
+        self.assertEqual(nm.release_map, {1: '9.0', 2: '9.0'})
+
+    def test_fuelclient(self):
+        self.conf['fuel_ip'] = '127.0.0.1'
+        client = Client(self.url)
+        nm = self.make_manager(client)
+        before = self.stats()
+        start = time.time()
+        self.assertTrue(nm.discover())
+        elapsed = time.time() - start
+        after = self.stats()
+        self.check_discovered(nm)
+        # concurrent, one request at a time would take 3 * DELAY
+        self.assertLess(elapsed, 2 * DELAY)
+        # the /stats request itself is one more of each
+        self.assertEqual(after['requests'] - before['requests'], 4)
+        self.assertLessEqual(after['connections'] - before['connections'],
+                             4)
+        self.assertEqual(client.requests, [])
+        self.assertEqual(nm.fuel_session.idle, [])
+
+    def test_fuelclient_fallback(self):
+        # nothing listens on the port FuelSession connects to
+        self.conf['fuel_ip'] = '127.0.0.1'
+        self.conf['fuel_port'] = 1
+        client = Client(self.url)
+        nm = self.make_manager(client)
+        self.assertTrue(nm.discover())
+        self.check_discovered(nm)
+        self.assertEqual(sorted(client.requests),
+                         ['clusters', 'nodes', 'version'])
+
+    def test_cli_batch(self):
+        # not a local address, so that commands go through ssh
+        self.conf['fuel_ip'] = '10.20.0.2'
+        nm = self.make_manager(None)
+        start = time.time()
+        self.assertTrue(nm.discover())
+        elapsed = time.time() - start
+        self.check_discovered(nm)
+        self.assertLess(elapsed, 2 * DELAY)
+        self.assertEqual(self.handshakes(), 1)
+        self.assertEqual(nm.fuel_cli_results, {})
+
+    def test_cli_batch_output(self):
+        self.conf['fuel_ip'] = '10.20.0.2'
+        nm = self.make_manager(None)
+        nm.fuel_cli_cmds = dict(nm.fuel_cli_cmds,
+                                clusters='fuel unknown --json',
+                                nodes='printf "no newline"; echo oops >&2')
+        nm.fuel_cli_batch(['version', 'nodes', 'clusters'])
+        results = nm.fuel_cli_results
+        self.assertEqual(sorted(results), ['clusters', 'nodes', 'version'])
+        out, err, code = results['version']
+        self.assertEqual((json.loads(out)['release'], err, code),
+                         ('9.0', '', 0))
+        self.assertEqual(results['nodes'], ('no newline\n', 'oops', 0))
+        out, err, code = results['clusters']
+        self.assertEqual(code, 1)
+        self.assertIn('unsupported command', err)
+        self.assertEqual(self.handshakes(), 1)
+
+    def test_cli_fallback(self):
+        self.conf['fuel_ip'] = '10.20.0.2'
+        calls = []
+
+        def ssh_node(**kwargs):
+            calls.append(kwargs['command'])
+            if kwargs['command'] == 'bash -s':
+                return '', 'ssh: connect to host failed', 255
+            return self.ssh_node(**kwargs)
+
+        utils.ssh_node = ssh_node
+        nm = self.make_manager(None)
+        self.assertTrue(nm.discover())
+        self.check_discovered(nm)
+        self.assertEqual(calls[0], 'bash -s')
+        self.assertEqual(sorted(calls[1:]),
+                         sorted(nodes.NodeManager.fuel_cli_cmds.values()))
+        self.assertEqual(self.handshakes(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
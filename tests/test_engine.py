@@ -0,0 +1,77 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from cudet import configuration
+from cudet.engine import PollEngine
+from cudet.nodes import Node
+
+
+class JobsNotStartedTest(unittest.TestCase):
+    """Jobs which cannot be started are recorded as failed by both engines
+
+    The output file of the 'sub/x' command is in a directory which does not
+    exist, so that it cannot be opened.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        conf = configuration.CudetConfig()
+        conf['outdir'] = self.tmpdir
+        conf['prefix'] = ''
+        conf['cmds'] = [{'a': 'echo a'}, {'sub/x': 'echo x'},
+                        {'z': 'echo z'}]
+        conf['scripts'] = []
+        self.node = Node(id=1, name='node-1', fqdn='node-1', mac='n/a',
+                         cluster=1, release='9.0', roles=['compute'],
+                         os_platform='ubuntu', online=True, status='ready',
+                         ip='127.0.0.1', conf=conf,
+                         logger=logging.getLogger('test'))
+        self.node.manifest_file = os.path.join(self.tmpdir, 'node-1.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, result):
+        mapcmds, mapscr, timings = result
+        self.assertEqual(timings['status'], 'failed')
+        jobs = dict([(t['name'], t) for t in timings['jobs']])
+        self.assertEqual(sorted(jobs), ['a', 'sub/x', 'z'])
+        self.assertFalse(jobs['sub/x']['ok'])
+        self.assertEqual(jobs['sub/x']['exit_code'], -1)
+        self.assertTrue(jobs['sub/x']['stderr_bytes'])
+        self.assertTrue(jobs['a']['ok'])
+        self.assertTrue(jobs['z']['ok'])
+        with open(self.node.manifest_file, 'r') as f:
+            manifest = json.load(f)['jobs'][Node.ckey]
+        self.assertEqual(manifest['sub/x']['status'], 'failed')
+        self.assertEqual(manifest['z']['status'], 'ok')
+
+    def test_process_engine(self):
+        self.check(self.node.exec_cmd())
+
+    def test_poll_engine(self):
+        results = list(PollEngine(max_sessions=4).run([self.node]))
+        self.assertEqual(len(results), 1)
+        self.check(results[0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
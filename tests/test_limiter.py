@@ -0,0 +1,164 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from cudet.limiter import AdaptiveLimiter
+from cudet.limiter import SSH_FAILURE
+
+
+def result(connect=None, runtimes=(), connect_code=0, retries=0,
+           exit_code=0):
+    """Returns a node collection result as the engines give it"""
+    jobs = [{'runtime': r, 'exit_code': exit_code} for r in runtimes]
+    return {}, {}, {'connect': connect,
+                    'connect_code': connect_code,
+                    'retries': retries,
+                    'jobs': jobs}
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def finish(self, lim, count, latency, key='n'):
+        for i in range(count):
+            self.assertTrue(lim.admit('%s%d' % (key, i)))
+            lim.release('%s%d' % (key, i), result(connect=latency))
+
+    def test_starts_at_initial_within_bounds(self):
+        self.assertEqual(AdaptiveLimiter(initial=10, maximum=100).limit, 10)
+        self.assertEqual(AdaptiveLimiter(initial=500, maximum=100).limit,
+                         100)
+        self.assertEqual(AdaptiveLimiter(initial=0, minimum=3).limit, 3)
+        self.assertEqual(AdaptiveLimiter(initial=10, maximum=100,
+                                         adaptive=False).limit, 100)
+
+    def test_slow_start_doubles_every_round(self):
+        lim = AdaptiveLimiter(initial=4, maximum=100)
+        self.finish(lim, 4, 1.0)
+        self.assertEqual(lim.limit, 8)
+        self.finish(lim, 8, 1.0)
+        self.assertEqual(lim.limit, 16)
+
+    def test_stops_at_maximum(self):
+        lim = AdaptiveLimiter(initial=4, maximum=6)
+        self.finish(lim, 10, 1.0)
+        self.assertEqual(lim.limit, 6)
+
+    def test_latency_rise_backs_off_once_per_round(self):
+        lim = AdaptiveLimiter(initial=10, maximum=100, backoff=0.5,
+                              alpha=1.0)
+        self.finish(lim, 10, 1.0)
+        self.assertEqual(lim.limit, 20)
+        self.finish(lim, 3, 5.0, key='slow')
+        self.assertEqual(lim.limit, 10)
+
+    def test_grows_by_one_per_round_after_backoff(self):
+        lim = AdaptiveLimiter(initial=10, maximum=100, backoff=0.5,
+                              alpha=1.0)
+        self.finish(lim, 10, 1.0)
+        self.finish(lim, 1, 5.0, key='slow')
+        self.assertEqual(lim.limit, 10)
+        self.finish(lim, 9, 1.0, key='a')
+        self.assertEqual(lim.limit, 10)
+        self.finish(lim, 1, 1.0, key='b')
+        self.assertEqual(lim.limit, 11)
+        self.finish(lim, 10, 1.0, key='c')
+        self.assertEqual(lim.limit, 11)
+        self.finish(lim, 1, 1.0, key='d')
+        self.assertEqual(lim.limit, 12)
+
+    def test_jitter_below_min_latency_is_ignored(self):
+        lim = AdaptiveLimiter(initial=4, maximum=100, min_latency=0.2,
+                              alpha=1.0)
+        self.finish(lim, 4, 0.01)
+        self.finish(lim, 4, 0.15, key='b')
+        self.assertEqual(lim.limit, 12)
+
+    def test_failures_back_off(self):
+        for failed in (Exception('boom'),
+                       result(connect=1.0, connect_code=SSH_FAILURE),
+                       result(connect=1.0, retries=1),
+                       result(runtimes=[1.0], exit_code=SSH_FAILURE)):
+            lim = AdaptiveLimiter(initial=10, backoff=0.5)
+            self.assertTrue(lim.admit('n'))
+            lim.release('n', failed)
+            self.assertEqual(lim.limit, 5, failed)
+
+    def test_never_below_minimum(self):
+        lim = AdaptiveLimiter(initial=2, minimum=2, backoff=0.1)
+        self.assertTrue(lim.admit('n'))
+        lim.release('n', Exception('boom'))
+        self.assertEqual(lim.limit, 2)
+
+    def test_not_adaptive_keeps_the_limit(self):
+        lim = AdaptiveLimiter(initial=2, maximum=50, adaptive=False)
+        self.finish(lim, 1, 1.0)
+        self.finish(lim, 1, 50.0, key='slow')
+        lim.admit('f')
+        lim.release('f', Exception('boom'))
+        self.assertEqual(lim.limit, 50)
+
+    def test_measure(self):
+        self.assertEqual(AdaptiveLimiter.measure(
+            result(connect=0.5, runtimes=[3.0])), (0.5, False))
+        self.assertEqual(AdaptiveLimiter.measure(
+            result(runtimes=[1.0, 3.0, None])), (2.0, False))
+        self.assertEqual(AdaptiveLimiter.measure(result()), (None, False))
+
+    def test_admit_up_to_the_limit(self):
+        lim = AdaptiveLimiter(initial=2)
+        self.assertTrue(lim.admit('a'))
+        self.assertTrue(lim.admit('b'))
+        self.assertFalse(lim.admit('c'))
+        lim.release('a', result())
+        self.assertTrue(lim.admit('c'))
+
+    def test_per_cluster_cap(self):
+        lim = AdaptiveLimiter(initial=10, per_cluster=1)
+        lim.register('a', 1, [])
+        lim.register('b', 1, [])
+        lim.register('c', 2, [])
+        self.assertTrue(lim.admit('a'))
+        self.assertFalse(lim.admit('b'))
+        self.assertTrue(lim.admit('c'))
+        lim.release('a', result())
+        self.assertTrue(lim.admit('b'))
+
+    def test_per_role_cap(self):
+        lim = AdaptiveLimiter(initial=10, per_role={'controller': 1,
+                                                    'compute': 0})
+        lim.register('a', 1, ['controller'])
+        lim.register('b', 2, ['controller', 'mongo'])
+        lim.register('c', 1, ['compute'])
+        lim.register('d', 1, ['compute'])
+        self.assertTrue(lim.admit('a'))
+        self.assertFalse(lim.admit('b'))
+        self.assertTrue(lim.admit('c'))
+        self.assertTrue(lim.admit('d'))
+
+    def test_pop_skips_capped_items(self):
+        lim = AdaptiveLimiter(initial=2, per_cluster=1)
+        for key, cluster in (('a', 1), ('b', 1), ('c', 2)):
+            lim.register(key, cluster, [])
+        items = ['c', 'b', 'a']
+        self.assertEqual(lim.pop(items, lambda k: k), 'a')
+        self.assertEqual(lim.pop(items, lambda k: k), 'c')
+        self.assertEqual(items, ['b'])
+        self.assertIsNone(lim.pop(items, lambda k: k))
+        lim.release('a', result())
+        self.assertEqual(lim.pop(items, lambda k: k), 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from cudet import configuration
+from cudet import nodes
+from cudet.nodes import Node
+
+
+class ManifestResumeTest(unittest.TestCase):
+    """Nodes record completed jobs, a resumed run skips them"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        self.conf = configuration.CudetConfig()
+        self.conf['outdir'] = self.tmpdir
+        self.conf['cmds'] = [{'a': 'echo a'}, {'b': 'echo b'}]
+        self.conf['scripts'] = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_node(self, resume=False, ip='10.0.0.1'):
+        """Returns the node of a new manager, its jobs not run yet"""
+        nm = nodes.NodeManager.__new__(nodes.NodeManager)
+        nm.conf = self.conf
+        nm.logger = logging.getLogger('test')
+        node = Node(id=1, name='node-1', fqdn='node-1', mac='n/a',
+                    cluster=1, release='9.0', roles=['compute'],
+                    os_platform='ubuntu', online=True, status='ready',
+                    ip=ip, conf=self.conf, logger=nm.logger)
+        nm.nodes = {ip: node}
+        nm.load_manifests(resume=resume)
+        node.reset_timings()
+        self.nm = nm
+        return node
+
+    def finish(self, node, job, output, code=0):
+        with open(job['dfile'], 'w') as f:
+            f.write(output)
+        node.job_done(job, '', code, timing={'runtime': 0.1,
+                                             'exit_code': code,
+                                             'stdout_bytes': len(output),
+                                             'stderr_bytes': 0})
+
+    def manifest(self, node):
+        with open(node.manifest_file, 'r') as f:
+            return json.load(f)
+
+    def interrupted_run(self, code=0):
+        """Runs only the first job of the node, as if interrupted"""
+        node = self.run_node()
+        jobs = node.get_jobs()
+        self.assertEqual([j['key'] for j in jobs], ['a', 'b'])
+        self.finish(node, jobs[0], 'a\n', code)
+        return jobs
+
+    def test_jobs_are_recorded_as_they_complete(self):
+        node = self.run_node()
+        jobs = node.get_jobs()
+        self.finish(node, jobs[0], 'a\n')
+        manifest = self.manifest(node)
+        self.assertEqual(manifest['ip'], '10.0.0.1')
+        self.assertEqual(manifest['jobs'][Node.ckey],
+                         {'a': {'dfile': jobs[0]['dfile'], 'size': 2,
+                                'status': 'ok', 'exit_code': 0}})
+        self.finish(node, jobs[1], 'b\n', code=1)
+        entry = self.manifest(node)['jobs'][Node.ckey]['b']
+        self.assertEqual((entry['status'], entry['exit_code']),
+                         ('failed', 1))
+        self.assertEqual(os.listdir(os.path.dirname(node.manifest_file)),
+                         ['node-1.json'])
+
+    def test_resume_skips_completed_jobs(self):
+        done = self.interrupted_run()[0]
+        node = self.run_node(resume=True)
+        jobs = node.get_jobs()
+        self.assertEqual([j['key'] for j in jobs], ['b'])
+        self.assertEqual(node.reused_jobs, [{'map': Node.ckey, 'key': 'a',
+                                             'dfile': done['dfile']}])
+        self.assertIn('a', self.manifest(node)['jobs'][Node.ckey])
+        self.finish(node, jobs[0], 'b\n')
+        mapcmds, mapscr, timings = node.get_result(jobs)
+        self.assertEqual(sorted(mapcmds), ['a', 'b'])
+        self.assertEqual(timings['status'], 'ok')
+        self.assertEqual(sorted(self.manifest(node)['jobs'][Node.ckey]),
+                         ['a', 'b'])
+
+    def test_failed_jobs_are_run_again(self):
+        self.interrupted_run(code=1)
+        node = self.run_node(resume=True)
+        self.assertEqual([j['key'] for j in node.get_jobs()], ['a', 'b'])
+
+    def test_changed_outputs_are_run_again(self):
+        done = self.interrupted_run()[0]
+        with open(done['dfile'], 'a') as f:
+            f.write('more\n')
+        node = self.run_node(resume=True)
+        self.assertEqual([j['key'] for j in node.get_jobs()], ['a', 'b'])
+
+    def test_other_node_is_not_resumed(self):
+        self.interrupted_run()
+        node = self.run_node(resume=True, ip='10.0.0.2')
+        self.assertEqual(node.resume_jobs, {})
+
+    def test_without_resume_manifests_are_removed(self):
+        jobs = self.interrupted_run()
+        manifest_file = self.nm.get_manifest_file(self.nm.nodes['10.0.0.1'])
+        self.assertTrue(os.path.exists(manifest_file))
+        node = self.run_node()
+        self.assertFalse(os.path.exists(manifest_file))
+        self.assertEqual(node.get_jobs(), jobs)
+
+    def test_manager_saves_the_result(self):
+        node = self.run_node()
+        jobs = node.get_jobs()
+        for job in jobs:
+            self.finish(node, job, 'out\n')
+        node.mapcmds, node.mapscr, node.timings = node.get_result(jobs)
+        self.nm.save_manifest(node)
+        manifest = self.manifest(node)
+        self.assertEqual(manifest['status'], 'ok')
+        self.assertEqual(sorted(manifest['jobs'][Node.ckey]), ['a', 'b'])
+        self.assertEqual(manifest['jobs'][Node.skey], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import ast
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from distutils.spawn import find_executable
+
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'rq', 'scripts')
+
+
+def read_script(name):
+    with open(os.path.join(SCRIPTS_DIR, name), 'r') as f:
+        return f.read()
+
+
+def rpm_query(qf):
+    """Returns the lines of rpm -qa --qf qf, of all installed packages"""
+    p = subprocess.Popen(['rpm', '-qa', '--qf', qf],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise AssertionError('rpm -qa --qf %r failed: %s' % (qf, err))
+    return out.splitlines()
+
+
+@unittest.skipUnless(find_executable('rpm'), 'rpm is not installed')
+class CentosRpmQueryTest(unittest.TestCase):
+    """The rpm queries of packages-md5-verify-centos on the installed rpm
+
+    Every file line must carry its package's name and version, those of
+    files after the first included.
+    """
+
+    def setUp(self):
+        self.script = read_script('packages-md5-verify-centos')
+        names = rpm_query('%{NAME}\n')
+        if not names:
+            self.skipTest('no rpm packages installed')
+        self.names = set(names)
+
+    def test_incremental_query(self):
+        qf = ast.literal_eval(re.search(r'^QF = (\(.*?\))$', self.script,
+                                        re.M | re.S).group(1))
+        lines = rpm_query(qf)
+        self.assertTrue(lines)
+        for line in lines:
+            fields = line.split('\t', 10)
+            self.assertEqual(len(fields), 11, line)
+            name, version = fields[:2]
+            self.assertIn(name, self.names, line)
+            self.assertNotIn('(none)-', version, line)
+            for field in fields[4:6]:
+                self.assertRegexpMatches(field, r'^-?\d+$')
+            self.assertTrue(fields[10].startswith('/'), line)
+
+    def test_full_query(self):
+        # passed as is, rpm takes the \t and \n escapes itself
+        qf = re.search(r"<\(rpm -qa --qf '([^']*)'\)", self.script).group(1)
+        lines = rpm_query(qf)
+        self.assertTrue(lines)
+        for line in lines:
+            fields = line.split('\t')
+            self.assertEqual(len(fields), 3, line)
+            self.assertTrue(fields[0].startswith('/'), line)
+            self.assertIn(fields[1], self.names, line)
+            self.assertNotIn('(none)-', fields[2], line)
+
+
+
+class CentosHashedVerifyTest(unittest.TestCase):
+    """The hashing path of packages-md5-verify-centos against a fake rpm
+
+    Files are reported as rpm -V would: only those whose %verify flags
+    ask for a digest check and which are in the normal state.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        self.lines = []
+        self.rpm_qa = os.path.join(self.tmpdir, 'rpm-qa')
+        with open(os.path.join(self.tmpdir, 'rpm'), 'w') as f:
+            f.write('#!/bin/sh\ncat "%s"\n' % self.rpm_qa)
+        os.chmod(os.path.join(self.tmpdir, 'rpm'), 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_file(self, name, vflags='-1', state='0', changed=True):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(name)
+        digest = hashlib.md5(('' if changed else name).encode()).hexdigest()
+        st = os.stat(path)
+        self.lines.append('\t'.join([
+            'pkg-%s' % name, '(none):1.0-1', '1', '0', vflags, state,
+            str(st.st_mode), str(st.st_size), str(int(st.st_mtime)),
+            digest, path]))
+        return path
+
+    def verify(self):
+        with open(self.rpm_qa, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        env = dict(os.environ, CUDET_MD5_JOBS='2',
+                   PATH='%s:%s' % (self.tmpdir, os.environ['PATH']))
+        p = subprocess.Popen(['bash', os.path.join(
+            SCRIPTS_DIR, 'packages-md5-verify-centos')],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=env, universal_newlines=True)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        return out.splitlines()
+
+    def test_changed_files(self):
+        changed = self.add_file('changed')
+        self.add_file('unchanged', changed=False)
+        self.assertEqual(self.verify(),
+                         ['pkg-changed\t1.0-1\t..5......    %s' % changed])
+
+    def test_verify_flags(self):
+        # %verify(not md5 size mtime)
+        self.add_file('not-md5', vflags=str(0xffffffff & ~(1 | 2 | 32)))
+        # %verify(not size mtime)
+        checked = self.add_file('md5-only', vflags=str(1))
+        self.assertEqual([l.split(None, 3)[-1] for l in self.verify()],
+                         [checked])
+
+    def test_file_states(self):
+        # replaced, not installed, netshared
+        for state in ('1', '2', '3'):
+            self.add_file('state-%s' % state, state=state)
+        normal = self.add_file('normal')
+        self.assertEqual([l.split(None, 3)[-1] for l in self.verify()],
+                         [normal])
+
+    def test_packages_without_the_tags(self):
+        path = self.add_file('old', vflags='(none)', state='(none)')
+        self.assertEqual([l.split(None, 3)[-1] for l in self.verify()],
+                         [path])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from cudet import configuration
+from cudet.nodes import NodeFilter
+from cudet.nodes import NodeIndex
+
+
+# as the Fuel nodes list gives them, roles by the CLI are a string
+NODES = [{'id': 1, 'roles': ['controller', 'mongo'], 'status': 'ready',
+          'online': True, 'cluster': 1},
+         {'id': 2, 'roles': 'compute, ceph-osd', 'status': 'ready',
+          'online': True, 'cluster': 1},
+         {'id': 3, 'roles': ['compute'], 'status': 'error',
+          'online': True, 'cluster': 2},
+         {'id': 4, 'roles': ['compute'], 'status': 'ready',
+          'online': False, 'cluster': None}]
+
+
+class NodeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = NodeIndex(NODES)
+
+    def test_values_are_compared_as_strings(self):
+        self.assertEqual(self.index.get('id', 2), set([1]))
+        self.assertEqual(self.index.get('id', '2'), set([1]))
+        self.assertEqual(self.index.get('cluster', 'None'), set([3]))
+        self.assertEqual(self.index.get('online', True), set([0, 1, 2]))
+
+    def test_roles_are_indexed_by_each_role(self):
+        self.assertEqual(self.index.get('roles', 'compute'), set([1, 2, 3]))
+        self.assertEqual(self.index.get('roles', 'ceph-osd'), set([1]))
+        self.assertEqual(self.index.get('roles', 'mongo'), set([0]))
+
+    def test_unknown_values(self):
+        self.assertEqual(self.index.get('roles', 'cinder'), frozenset())
+        self.assertEqual(self.index.get('name', 'node-1'), frozenset())
+        self.assertEqual(self.index.get('name', 'None'), self.index.all)
+
+    def test_index_is_built_once(self):
+        self.index.get('status', 'ready')
+        built = self.index.indexes['status']
+        self.index.get('status', 'error')
+        self.assertIs(self.index.indexes['status'], built)
+
+
+class NodeFilterTest(unittest.TestCase):
+
+    def select(self, **filters):
+        """Returns ids of the nodes passing filters, in the nodes' order"""
+        node_filter = NodeFilter()
+        node_filter.filters = filters
+        return [n['id'] for n in node_filter.filter_nodes(NODES)]
+
+    def test_no_filters(self):
+        self.assertEqual(self.select(), [1, 2, 3, 4])
+        self.assertEqual(self.select(roles=[], id=[], check_master=True),
+                         [1, 2, 3, 4])
+
+    def test_online(self):
+        self.assertEqual(self.select(online=True), [1, 2, 3])
+        self.assertEqual(self.select(online=False), [1, 2, 3, 4])
+
+    def test_default_filters(self):
+        filters = configuration.CudetConfig().filters
+        self.assertEqual(self.select(**filters), [1, 2, 4])
+
+    def test_any_of_the_values(self):
+        self.assertEqual(self.select(status=['ready']), [1, 2, 4])
+        self.assertEqual(self.select(roles=['mongo', 'ceph-osd']), [1, 2])
+        self.assertEqual(self.select(id=[3, '1']), [1, 3])
+        self.assertEqual(self.select(cluster=['None']), [4])
+        self.assertEqual(self.select(status='error'), [3])
+
+    def test_all_of_the_terms(self):
+        self.assertEqual(self.select(roles=['compute+ceph-osd']), [2])
+        self.assertEqual(self.select(roles=['compute+!ceph-osd']), [3, 4])
+        self.assertEqual(self.select(roles=['controller+!mongo']), [])
+
+    def test_excluded_values(self):
+        self.assertEqual(self.select(roles=['!compute']), [1])
+        self.assertEqual(self.select(id=['!1', '!4']), [2, 3])
+        self.assertEqual(self.select(roles=['compute', '!ceph-osd']),
+                         [3, 4])
+        self.assertEqual(self.select(roles=['!compute+ceph-osd']), [1, 3, 4])
+
+    def test_filters_of_all_attributes(self):
+        self.assertEqual(self.select(roles=['compute'], status=['ready'],
+                                     online=True), [2])
+        self.assertEqual(self.select(cluster=[1], id=['!1']), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
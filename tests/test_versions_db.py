@@ -0,0 +1,284 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from cudet import versions_db
+from cudet.versions_db import VersionsCache
+from cudet.versions_db import VersionsDB
+from cudet.versions_db import VersionsIndex
+
+
+# (release, mu, os, package_name, package_version)
+ROWS = [('9.0', 0, 'ubuntu', 'nova', '2:13.0.0-1'),
+        ('9.0', 1, 'ubuntu', 'nova', '2:13.1.0-1'),
+        ('9.0', 2, 'ubuntu', 'nova', '2:13.1.0-1'),
+        ('9.0', 0, 'ubuntu', 'bash', '4.3-14'),
+        ('9.0', 1, 'ubuntu', 'neutron', '2:8.1.0-1'),
+        ('9.0', 0, 'centos', 'nova', '13.0.0-1.el7'),
+        ('8.0', 0, 'ubuntu', 'nova', '2:12.0.0-1')]
+
+PACKAGES = {'nova': {'mu': set([0, 1, 2]),
+                     'versions': {'2:13.0.0-1': set([0]),
+                                  '2:13.1.0-1': set([1, 2])},
+                     'max_version': '2:13.1.0-1'},
+            'bash': {'mu': set([0]),
+                     'versions': {'4.3-14': set([0])},
+                     'max_version': '4.3-14'},
+            'neutron': {'mu': set([1]),
+                        'versions': {'2:8.1.0-1': set([1])},
+                        'max_version': '2:8.1.0-1'}}
+
+NAMES = ['nova', 'bash', 'missing', 'neutron']
+
+
+def make_db(db_file, rows=ROWS, index=False):
+    c = sqlite3.connect(db_file)
+    with c:
+        c.execute('CREATE TABLE versions (id INTEGER PRIMARY KEY, '
+                  'source_id INTEGER, job_id INTEGER, release TEXT, '
+                  'mu INTEGER, os TEXT, package_name TEXT, '
+                  'package_version TEXT, package_filename TEXT)')
+        c.executemany('INSERT INTO versions (release, mu, os, package_name, '
+                      'package_version) VALUES (?, ?, ?, ?, ?)', rows)
+        if index:
+            c.execute('CREATE INDEX %s ON versions '
+                      '(os, package_name, package_version)' %
+                      versions_db.INDEX_NAME)
+    c.close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def indexes(db_file):
+    c = sqlite3.connect(db_file)
+    try:
+        return [n for n, in c.execute("SELECT name FROM sqlite_master "
+                                      "WHERE type = 'index'")]
+    finally:
+        c.close()
+
+
+class VersionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.db_file = os.path.join(self.tmpdir, 'versions.sqlite')
+        make_db(self.db_file)
+
+    def tearDown(self):
+        versions_db.close_connections()
+        shutil.rmtree(self.tmpdir)
+
+    def replace_db(self, rows):
+        """Replaces the database by rename, as VersionsSync does"""
+        new_file = self.db_file + '.new'
+        make_db(new_file, rows)
+        versions_db.close_connection(self.db_file)
+        os.rename(new_file, self.db_file)
+
+    def cached(self):
+        """Returns the files in cache_dir but the kept md5s"""
+        return sorted(n for n in os.listdir(self.cache_dir) if n != 'md5')
+
+
+class VersionsDBTest(VersionsTestCase):
+
+    def test_packages(self):
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        expected = dict([(n, PACKAGES[n]) for n in ('nova', 'bash',
+                                                    'neutron')])
+        self.assertEqual(db.packages(NAMES), expected)
+        self.assertEqual(db.get('nova'), PACKAGES['nova'])
+        self.assertIsNone(db.get('missing'))
+        self.assertEqual(db.packages([]), {})
+
+    def test_lookups_in_batches(self):
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        db.batch_size = 2
+        self.assertEqual(db.packages(NAMES),
+                         VersionsDB(self.db_file, '9.0', 'ubuntu').packages(
+                             NAMES))
+
+    def test_other_releases_and_oses(self):
+        db = VersionsDB(self.db_file, '8.0', 'ubuntu', self.cache_dir)
+        self.assertEqual(db.get('nova')['max_version'], '2:12.0.0-1')
+        self.assertEqual(db.packages(['bash']), {})
+        db = VersionsDB(self.db_file, '9.0', 'centos', self.cache_dir)
+        self.assertEqual(db.get('nova')['versions'],
+                         {'13.0.0-1.el7': set([0])})
+
+    def test_indexed_copy(self):
+        before = read(self.db_file)
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        db.get('nova')
+        self.assertEqual(read(self.db_file), before)
+        self.assertEqual(indexes(self.db_file), [])
+        self.assertEqual(db.connection_file, db.indexed_name())
+        self.assertEqual(self.cached(),
+                         [os.path.basename(db.indexed_name())])
+        self.assertIn(versions_db.md5_file(self.db_file),
+                      db.connection_file)
+        self.assertTrue(os.path.exists(versions_db.md5_cache_file(
+            self.db_file, self.cache_dir)))
+        self.assertEqual(indexes(db.connection_file),
+                         [versions_db.INDEX_NAME])
+
+    def test_without_cache_dir(self):
+        before = read(self.db_file)
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu')
+        self.assertTrue(db.prepared())
+        self.assertEqual(db.get('nova'), PACKAGES['nova'])
+        self.assertEqual(db.connection_file, self.db_file)
+        self.assertEqual(read(self.db_file), before)
+
+    def test_database_with_the_index(self):
+        os.remove(self.db_file)
+        make_db(self.db_file, index=True)
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertTrue(db.prepared())
+        self.assertEqual(db.get('nova'), PACKAGES['nova'])
+        self.assertEqual(db.connection_file, self.db_file)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_changed_database_gets_a_new_copy(self):
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        db.get('nova')
+        old_copy = db.connection_file
+        db.close()
+        self.replace_db(ROWS[:1])
+        db = VersionsDB(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertFalse(db.prepared())
+        self.assertEqual(db.get('nova')['versions'],
+                         {'2:13.0.0-1': set([0])})
+        self.assertNotEqual(db.connection_file, old_copy)
+        self.assertEqual(self.cached(),
+                         [os.path.basename(db.connection_file)])
+
+
+class VersionsCacheTest(VersionsTestCase):
+
+    def test_packages(self):
+        cache = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertEqual(cache.packages(NAMES),
+                         VersionsDB(self.db_file, '9.0', 'ubuntu').packages(
+                             NAMES))
+        self.assertIsNone(cache.get('missing'))
+
+    def test_cache_file(self):
+        before = read(self.db_file)
+        cache = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertFalse(cache.prepared())
+        cache.load()
+        self.assertEqual(read(self.db_file), before)
+        self.assertIn(versions_db.md5_file(self.db_file), cache.cache_file())
+        self.assertEqual(self.cached(),
+                         [os.path.basename(cache.cache_file())])
+        again = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertTrue(again.read())
+        self.assertEqual(again.cache, cache.cache)
+
+    def test_broken_cache_is_rebuilt(self):
+        cache = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        cache.load()
+        with open(cache.cache_file(), 'wb') as f:
+            f.write(read(cache.cache_file())[:10])
+        again = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertEqual(again.get('nova'), PACKAGES['nova'])
+        self.assertTrue(VersionsCache(self.db_file, '9.0', 'ubuntu',
+                                      self.cache_dir).read())
+
+    def test_changed_database_is_compiled_again(self):
+        cache = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        cache.load()
+        old_file = cache.cache_file()
+        self.replace_db(ROWS[:1])
+        cache = VersionsCache(self.db_file, '9.0', 'ubuntu', self.cache_dir)
+        self.assertEqual(cache.packages(NAMES),
+                         {'nova': {'mu': set([0]),
+                                   'versions': {'2:13.0.0-1': set([0])},
+                                   'max_version': '2:13.0.0-1'}})
+        self.assertNotEqual(cache.cache_file(), old_file)
+        self.assertEqual(self.cached(),
+                         [os.path.basename(cache.cache_file())])
+
+
+class VersionsIndexTest(VersionsTestCase):
+
+    def make_index(self, backend):
+        index = VersionsIndex(backend, self.cache_dir)
+        for release in ('8.0', '9.0'):
+            index.add(release, 'ubuntu', self.db_file)
+        return index
+
+    def lookup(self, index):
+        return dict([(key, db.packages(NAMES))
+                     for key, db in index.dbs.items()])
+
+    def test_load_in_worker_processes(self):
+        for backend in ('index', 'cache'):
+            serial = self.make_index(backend)
+            serial.load(processes=1)
+            expected = self.lookup(serial)
+            self.assertEqual(expected[('9.0', 'ubuntu')],
+                             VersionsDB(self.db_file, '9.0',
+                                        'ubuntu').packages(NAMES))
+            shutil.rmtree(self.cache_dir)
+            versions_db.close_connections()
+
+            parallel = self.make_index(backend)
+            self.assertFalse(any([db.prepared()
+                                  for db in parallel.dbs.values()]))
+            parallel.load(processes=2)
+            self.assertTrue(all([db.prepared()
+                                 for db in parallel.dbs.values()]))
+            self.assertEqual(self.lookup(parallel), expected)
+            self.assertEqual(self.lookup(self.make_index(backend)),
+                             expected)
+            shutil.rmtree(self.cache_dir)
+            versions_db.close_connections()
+
+    def test_get(self):
+        index = self.make_index('index')
+        self.assertEqual(len(index), 2)
+        self.assertIs(index.get('9.0', 'ubuntu'), index.dbs[('9.0',
+                                                              'ubuntu')])
+        self.assertIsNone(index.get('9.0', 'centos'))
+
+    def test_close(self):
+        for backend in ('index', 'cache'):
+            index = self.make_index(backend)
+            index.load(processes=1)
+            self.lookup(index)
+            index.close()
+            self.assertEqual(versions_db._connections, {})
+        # the copies with the index are there, the database is only asked
+        # whether it has the index
+        index = self.make_index('index')
+        self.lookup(index)
+        self.assertEqual(len(versions_db._connections), 3)
+        index.close()
+        self.assertEqual(versions_db._connections, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from cudet import versions_db
+from cudet import versions_sync
+
+
+UTIL_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'util')
+
+
+def make_db(db_file, version):
+    if not os.path.isdir(os.path.dirname(db_file)):
+        os.makedirs(os.path.dirname(db_file))
+    c = sqlite3.connect(db_file)
+    with c:
+        c.execute('CREATE TABLE versions (id INTEGER PRIMARY KEY, '
+                  'release TEXT, mu INTEGER, os TEXT, package_name TEXT, '
+                  'package_version TEXT)')
+        c.execute("INSERT INTO versions (release, mu, os, package_name, "
+                  "package_version) VALUES ('1.0', 0, 'ubuntu', 'nova', ?)",
+                  (version,))
+    c.close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class VersionsSyncTest(unittest.TestCase):
+    """VersionsSync against util/fake-versions-mirror.py
+
+    The mirror has 1.0/ubuntu, the same as the local one, 1.0/centos and
+    2.0/ubuntu, which differ from the local ones, 2.0/ubuntu served
+    corrupted, and 2.0/centos, which is not there locally. 3.0/ubuntu is
+    nowhere.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cudet-test-')
+        self.mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        self.local_dir = os.path.join(self.tmpdir, 'local')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        for release, os_platform, local in (('1.0', 'ubuntu', '1'),
+                                            ('1.0', 'centos', 'old'),
+                                            ('2.0', 'ubuntu', 'old'),
+                                            ('2.0', 'centos', None)):
+            name = os.path.join(release, os_platform + '.sqlite')
+            make_db(os.path.join(self.mirror_dir, name), '1')
+            if local is not None:
+                make_db(os.path.join(self.local_dir, name), local)
+        os.makedirs(os.path.join(self.local_dir, '3.0'))
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(UTIL_DIR,
+                                          'fake-versions-mirror.py'),
+             self.mirror_dir, '--port', '0', '--delay', '0',
+             '--corrupt', '2.0/ubuntu'],
+            stdout=subprocess.PIPE)
+        self.mirror = 'http://127.0.0.1:%d' % int(
+            self.server.stdout.readline())
+        versions_db._md5s.clear()
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        versions_db.close_connections()
+        versions_db._md5s.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def db_file(self, release, os_platform, local=True):
+        return os.path.join(self.local_dir if local else self.mirror_dir,
+                            release, os_platform + '.sqlite')
+
+    def sync(self, release, os_platform, mirror=None):
+        sync = versions_sync.VersionsSync(mirror or self.mirror, timeout=5,
+                                          cache_dir=self.cache_dir)
+        return sync.sync(release, os_platform,
+                         self.db_file(release, os_platform))
+
+    def temp_files(self):
+        return [n for r in os.listdir(self.local_dir)
+                for n in os.listdir(os.path.join(self.local_dir, r))
+                if n.startswith('.')]
+
+    def test_current(self):
+        self.assertEqual(self.sync('1.0', 'ubuntu'), versions_sync.CURRENT)
+
+    def test_updated(self):
+        self.assertEqual(self.sync('1.0', 'centos'), versions_sync.UPDATED)
+        self.assertEqual(read(self.db_file('1.0', 'centos')),
+                         read(self.db_file('1.0', 'centos', local=False)))
+        self.assertEqual(self.sync('1.0', 'centos'), versions_sync.CURRENT)
+
+    def test_corrupted_download(self):
+        before = read(self.db_file('2.0', 'ubuntu'))
+        self.assertEqual(self.sync('2.0', 'ubuntu'),
+                         versions_sync.UPDATE_FAILED)
+        self.assertEqual(read(self.db_file('2.0', 'ubuntu')), before)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_missing_database(self):
+        self.assertEqual(self.sync('2.0', 'centos'),
+                         versions_sync.DOWNLOADED)
+        self.assertEqual(read(self.db_file('2.0', 'centos')),
+                         read(self.db_file('2.0', 'centos', local=False)))
+        self.assertEqual(self.sync('3.0', 'ubuntu'), versions_sync.MISSING)
+        self.assertFalse(os.path.exists(self.db_file('3.0', 'ubuntu')))
+        self.assertEqual(self.temp_files(), [])
+
+    def test_mirror_down(self):
+        # nothing listens on port 1
+        down = 'http://127.0.0.1:1'
+        before = read(self.db_file('1.0', 'centos'))
+        self.assertEqual(self.sync('1.0', 'centos', down),
+                         versions_sync.UNKNOWN)
+        self.assertEqual(read(self.db_file('1.0', 'centos')), before)
+        self.assertEqual(self.sync('3.0', 'ubuntu', down),
+                         versions_sync.MISSING)
+
+    def test_sync_all(self):
+        dbs = [(r, p, self.db_file(r, p))
+               for r, p in (('1.0', 'ubuntu'), ('1.0', 'centos'),
+                            ('2.0', 'ubuntu'), ('2.0', 'centos'),
+                            ('3.0', 'ubuntu'))]
+        sync = versions_sync.VersionsSync(self.mirror, timeout=5,
+                                          cache_dir=self.cache_dir)
+        self.assertEqual(sync.sync_all(dbs),
+                         [versions_sync.CURRENT, versions_sync.UPDATED,
+                          versions_sync.UPDATE_FAILED,
+                          versions_sync.DOWNLOADED, versions_sync.MISSING])
+
+    def test_md5_is_kept_between_runs(self):
+        db_file = self.db_file('1.0', 'ubuntu')
+        self.sync('1.0', 'ubuntu')
+        md5_file = versions_db.md5_cache_file(db_file, self.cache_dir)
+        with open(md5_file, 'r') as f:
+            stamp, md5 = f.read().splitlines()
+        self.assertEqual(md5, versions_db.md5_file(db_file))
+        # as kept by an earlier run, the database is not read again
+        versions_db._md5s.clear()
+        with open(md5_file, 'w') as f:
+            f.write('%s\n%s\n' % (stamp, '0' * 32))
+        self.assertEqual(self.sync('1.0', 'centos'), versions_sync.UPDATED)
+        self.assertEqual(versions_db.md5_file(db_file, self.cache_dir),
+                         '0' * 32)
+        # a changed database is read again
+        versions_db._md5s.clear()
+        make_db(self.db_file('1.0', 'ubuntu') + '.new', '2')
+        os.rename(db_file + '.new', db_file)
+        self.assertNotEqual(versions_db.md5_file(db_file, self.cache_dir),
+                            '0' * 32)
+        self.assertEqual(versions_db.md5_file(db_file, self.cache_dir),
+                         versions_db.md5_file(db_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+"""
+Measures applying the configuration to many nodes.
+
+Creates N nodes of a few kinds with the default configuration and rq.yaml,
+plus --sections extra by_roles sections, once compiling a plan for every
+node, the way every node walked the configuration before, and once with a
+ConfPlanner shared by all nodes.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import configuration  # noqa
+from cudet import nodes  # noqa
+
+
+ROLES = [['controller', 'mongo'], ['compute'], ['compute', 'ceph-osd'],
+         ['cinder'], ['ceph-osd']]
+
+
+def make_nodes(conf, count, planner=None):
+    result = []
+    for i in range(count):
+        result.append(nodes.Node(id=i + 1, name='node-%d' % (i + 1),
+                                 fqdn='node-%d' % (i + 1), mac='n/a',
+                                 cluster=i % 4 + 1, release='9.0',
+                                 roles=ROLES[i % len(ROLES)],
+                                 os_platform=('ubuntu', 'centos')[i % 2],
+                                 online=True, status='ready',
+                                 ip='10.%d.%d.%d' % (i // 65536,
+                                                     i // 256 % 256, i % 256),
+                                 conf=conf, planner=planner))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=2000)
+    parser.add_argument('--sections', type=int, default=50,
+                        help='extra by_roles sections in the configuration')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    root = os.path.dirname(UTIL_DIR)
+    conf = configuration.get_config()
+    conf['rqdir'] = os.path.join(root, 'rq')
+    conf['rqfile'] = os.path.join(root, 'rq.yaml')
+    nm = nodes.NodeManager.__new__(nodes.NodeManager)
+    nm.conf = conf
+    nm._import_rq()
+    by_roles = conf.config.setdefault('by_roles', {})
+    for i in range(args.sections):
+        by_roles['role-%d' % i] = {'cmds': [{'cmd-%d' % i: 'true'}],
+                                   'files': ['/etc/role-%d' % i]}
+
+    start = time.time()
+    make_nodes(conf, args.nodes)
+    per_node = time.time() - start
+    planner = nodes.ConfPlanner(conf)
+    start = time.time()
+    make_nodes(conf, args.nodes, planner)
+    shared = time.time() - start
+    print('%d nodes, %d extra sections: plan per node %.2fs, shared '
+          'planner %.2fs (%d plans)' % (args.nodes, args.sections, per_node,
+                                        shared, len(planner.plans)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python2
+"""
+Measures the Fuel discovery phase of NodeManager.
+
+Starts util/fake-fuel-api.py and compares getting the master release, the
+nodes list and the cluster releases one after another, the way NodeManager
+did before, with NodeManager.discover:
+
+- api: through a client opening a new connection per request, as older
+  fuelclient versions do, against a FuelSession shared by concurrent
+  requests
+- cli: one ssh to the master per fuel CLI command, against all commands
+  in one ssh session, with util/fake-ssh and util/fake-fuel as ssh and fuel
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import configuration  # noqa
+from cudet import fuel_client  # noqa
+from cudet import nodes  # noqa
+
+
+class LegacyClient(object):
+    """Fuel client opening a new connection for every request"""
+
+    auth_token = ''
+
+    def __init__(self, url):
+        self.url = url
+
+    def get_request(self, api):
+        return json.loads(urllib2.urlopen('%s/api/v1/%s' %
+                                          (self.url, api)).read())
+
+
+def make_manager(conf, client):
+    nm = nodes.NodeManager.__new__(nodes.NodeManager)
+    nm.conf = conf
+    nm.logger = logging.getLogger('bench')
+    nm.nodes = {}
+    nm.nodes_filter = nodes.NodeFilter()
+    nm.nodes_filter.filters = dict(nm.nodes_filter.filters,
+                                   check_master=True)
+    nm.fuel_client = client
+    nm.fuel_session = None
+    nm.fuel_cli_results = {}
+    nm.cli_creds = ''
+    return nm
+
+
+def sequential(nm):
+    nm.master_release = nm.get_master_release()
+    nm.get_nodes()
+    nm.release_map = nm.get_slave_nodes_release()
+
+
+def measure(title, func, url):
+    stats = json.loads(urllib2.urlopen(url + '/stats').read())
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    after = json.loads(urllib2.urlopen(url + '/stats').read())
+    # the /stats requests themselves open a connection each
+    print('%-16s %6.2fs, %d connections, %d requests' %
+          (title + ':', elapsed,
+           after['connections'] - stats['connections'] - 1,
+           after['requests'] - stats['requests'] - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--delay', default='0.2',
+                        help='seconds each Fuel API request takes')
+    parser.add_argument('--connect-delay', default='0.1',
+                        help='seconds each new Fuel API connection takes')
+    parser.add_argument('--startup', default='0.5',
+                        help='seconds the fuel CLI takes to start')
+    parser.add_argument('--ssh-delay', default='0.1',
+                        help='seconds each ssh handshake takes')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='cudet-bench-')
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(UTIL_DIR, 'fake-fuel-api.py'),
+                               '--port', '0', '--nodes', str(args.nodes),
+                               '--delay', args.delay,
+                               '--connect-delay', args.connect_delay],
+                              stdout=subprocess.PIPE)
+    try:
+        port = int(server.stdout.readline())
+        url = 'http://127.0.0.1:%d' % port
+        os.symlink(os.path.join(UTIL_DIR, 'fake-ssh'),
+                   os.path.join(tmpdir, 'ssh'))
+        os.symlink(os.path.join(UTIL_DIR, 'fake-fuel'),
+                   os.path.join(tmpdir, 'fuel'))
+        os.environ['PATH'] = tmpdir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_SSH_DELAY'] = args.ssh_delay
+        os.environ['FAKE_FUEL_STARTUP'] = args.startup
+        os.environ['FAKE_FUEL_API'] = url
+
+        conf = configuration.get_config()
+        conf['fuel_port'] = port
+        conf['fuel_http_proxy'] = ''
+        conf['ssh_opts'] = []
+
+        conf['fuel_ip'] = '127.0.0.1'
+        client = LegacyClient(url)
+        nm = make_manager(conf, client)
+        nm.fuel_session = client
+        measure('api sequential', lambda: sequential(nm), url)
+        nm.fuel_session = fuel_client.FuelSession(client, conf)
+        measure('api discover', nm.discover, url)
+
+        # not a local address, so that commands go through ssh
+        conf['fuel_ip'] = '10.20.0.2'
+        nm = make_manager(conf, None)
+        measure('cli sequential', lambda: sequential(nm), url)
+        measure('cli discover', nm.discover, url)
+        print('%d nodes, master release %s, cluster releases %s' %
+              (len(nm.nodes_json), nm.master_release, nm.release_map))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
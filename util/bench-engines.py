@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+"""
+Compares data collection engines on a fake fleet.
+
+Collects a few commands from N fake nodes through NodeManager.run_commands,
+using util/fake-ssh as the ssh binary, and reports wall time and the peak
+total RSS of cudet and all its child processes for each engine.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import configuration  # noqa
+from cudet import nodes  # noqa
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def tree_rss(root_pid):
+    """Total RSS in bytes of a process and all its descendants"""
+    children = {}
+    rss = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                stat = f.read()
+            with open('/proc/%s/statm' % pid) as f:
+                statm = f.read()
+        except IOError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(pid))
+        rss[int(pid)] = int(statm.split()[1]) * PAGE_SIZE
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, interval=0.05):
+        super(RSSSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, tree_rss(os.getpid()))
+            time.sleep(self.interval)
+
+
+def make_manager(conf, count):
+    nm = nodes.NodeManager.__new__(nodes.NodeManager)
+    nm.conf = conf
+    nm.logger = logging.getLogger('bench')
+    nm.nodes = {}
+    for i in range(count):
+        ip = '10.%d.%d.%d' % (i // 65536, i // 256 % 256, i % 256)
+        nm.nodes[ip] = nodes.Node(id=i + 1, name='node-%d' % (i + 1),
+                                  fqdn='node-%d' % (i + 1), mac='n/a',
+                                  cluster=1, release='9.0',
+                                  roles=['compute'], os_platform='ubuntu',
+                                  online=True, status='ready', ip=ip,
+                                  conf=conf)
+    return nm
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=500)
+    parser.add_argument('--cmds', type=int, default=2)
+    parser.add_argument('--runtime', default='0.5',
+                        help='seconds each remote command takes')
+    parser.add_argument('--engines', nargs='+', default=['process', 'poll'])
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='cudet-bench-')
+    try:
+        os.symlink(os.path.join(UTIL_DIR, 'fake-ssh'),
+                   os.path.join(tmpdir, 'ssh'))
+        os.environ['PATH'] = '%s:%s' % (tmpdir, os.environ['PATH'])
+        os.environ['FAKE_SSH_DELAY'] = '0.05'
+
+        conf = configuration.get_config()
+        conf['outdir'] = os.path.join(tmpdir, 'out')
+        conf['prefix'] = ''
+        conf['scripts'] = []
+        conf['cmds'] = [{'cmd%d' % i: 'sleep %s; echo %d' % (args.runtime, i)}
+                        for i in range(args.cmds)]
+        for name in args.engines:
+            conf['engine'] = name
+            nm = make_manager(conf, args.nodes)
+            sampler = RSSSampler()
+            sampler.start()
+            start = time.time()
+            nm.run_commands(fake=False)
+            elapsed = time.time() - start
+            sampler.stopped.set()
+            sampler.join()
+            print('%-8s %5d nodes: %7.2fs, peak RSS %7.1f MiB' %
+                  (name, args.nodes, elapsed, sampler.peak / 1048576.0))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
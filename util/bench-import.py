@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+"""
+Measures the startup time of cudet.
+
+Runs 'cudet -h' and the import of cudet.main in fresh interpreters a few
+times and reports the best time of each, and which of the modules cudet
+should only load when needed got loaded. Exits with 1 if any did, or if
+'cudet -h' takes longer than --max-ms, so that it can guard against
+startup regressions.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(UTIL_DIR)
+
+# modules which must not be loaded by 'cudet -h'
+LAZY_MODULES = ['pkg_resources', 'fuelclient', 'yaml', 'urllib2', 'uuid']
+
+HELP = '''
+import sys
+sys.argv = ['cudet', '-h']
+from cudet import main
+try:
+    main.main(sys.argv)
+except SystemExit:
+    pass
+'''
+
+IMPORT = 'import cudet.main'
+
+REPORT = '''
+import sys
+sys.stderr.write(' '.join([m for m in %r if m in sys.modules]))
+''' % LAZY_MODULES
+
+
+def run(code, count):
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    best = None
+    for i in range(count):
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, '-c', code + REPORT],
+                                stdout=open(os.devnull, 'w'),
+                                stderr=subprocess.PIPE, env=env)
+        loaded = proc.communicate()[1].split()
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=0,
+                        help='fail if cudet -h takes longer, 0 - no limit')
+    args = parser.parse_args()
+
+    baseline = run('', args.count)[0]
+    print('%-18s %6.1f ms' % ('python:', baseline))
+    failed = False
+    for title, code in (('import cudet.main', IMPORT), ('cudet -h', HELP)):
+        elapsed, loaded = run(code, args.count)
+        print('%-18s %6.1f ms, loaded: %s' % (title + ':', elapsed,
+                                               ', '.join(loaded) or '-'))
+        if title == 'cudet -h':
+            failed = bool(loaded) or bool(args.max_ms and
+                                          elapsed > args.max_ms)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
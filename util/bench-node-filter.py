@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+"""
+Measures NodeFilter.filter_nodes on a large synthetic Fuel nodes list.
+
+Compares the indexed filter with the former implementation, which deep
+copied the nodes list and matched every node against every filter value,
+for a few filters, and checks that both select the same nodes. The former
+implementation ignored the online filter, so it is off for the comparison.
+"""
+
+import argparse
+import copy
+import logging
+import os
+import random
+import sys
+import time
+
+from collections import Iterable
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import nodes  # noqa
+from six import string_types  # noqa
+
+
+ROLES = [['controller', 'mongo'], ['compute'], ['compute', 'ceph-osd'],
+         ['cinder'], ['ceph-osd']]
+STATUSES = ['ready'] * 8 + ['error', 'provisioned']
+
+FILTERS = [
+    ('status', {'status': ['ready']}),
+    ('status, roles', {'status': ['ready'], 'roles': ['compute', 'cinder']}),
+    ('cluster, id', {'cluster': [1, 2, 3], 'id': range(1, 5000, 3)}),
+    ('everything', {'status': ['ready'], 'roles': ['compute'],
+                    'cluster': range(1, 20), 'id': range(1, 10000, 2)}),
+]
+
+NEW_FILTERS = [
+    ('negation', {'status': ['!error'], 'roles': ['!controller']}),
+    ('role combination', {'roles': ['compute+!ceph-osd', 'controller+mongo']}),
+]
+
+
+def make_nodes(count, clusters=20, seed=1):
+    rnd = random.Random(seed)
+    return [{'id': i + 1,
+             'cluster': rnd.randint(1, clusters),
+             'name': 'node-%d' % (i + 1),
+             'fqdn': 'node-%d.domain.tld' % (i + 1),
+             'mac': 'n/a',
+             'ip': '10.%d.%d.%d' % (i // 65536, i // 256 % 256, i % 256),
+             'roles': list(rnd.choice(ROLES)),
+             'os_platform': 'ubuntu',
+             'status': rnd.choice(STATUSES),
+             'online': rnd.random() > 0.05} for i in range(count)]
+
+
+def legacy_filter_nodes(filters, nodes_info):
+    def _to_set(data):
+        return set([data]) if \
+            isinstance(data, string_types) or \
+            not isinstance(data, Iterable) else set(data)
+
+    filtered_nodes = copy.deepcopy(nodes_info)
+    for attr in [a for a in filters if a not in ['check_master', 'online']
+                 and len(filters[a]) > 0]:
+        filtered_nodes = [node for node in filtered_nodes
+                          if len(_to_set(node.get(attr)).intersection(
+                              _to_set(filters[attr]))) > 0]
+    return filtered_nodes
+
+
+def measure(func, count):
+    start = time.time()
+    for i in range(count):
+        result = func()
+    return (time.time() - start) / count * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--count', type=int, default=5)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    nodes_info = make_nodes(args.nodes)
+    node_filter = nodes.NodeFilter.__new__(nodes.NodeFilter)
+    print('%d nodes' % len(nodes_info))
+    for title, filters in FILTERS:
+        node_filter.filters = dict(filters, online=False)
+        legacy, legacy_nodes = measure(
+            lambda: legacy_filter_nodes(node_filter.filters, nodes_info),
+            args.count)
+        current, current_nodes = measure(
+            lambda: node_filter.filter_nodes(nodes_info), args.count)
+        same = ([n['id'] for n in legacy_nodes] ==
+                [n['id'] for n in current_nodes])
+        print('%-18s former %8.2f ms, indexed %7.2f ms, %5d nodes%s' %
+              (title + ':', legacy, current, len(current_nodes),
+               '' if same else ', DIFFERENT RESULTS'))
+    for title, filters in NEW_FILTERS:
+        node_filter.filters = dict(filters, online=True)
+        current, current_nodes = measure(
+            lambda: node_filter.filter_nodes(nodes_info), args.count)
+        print('%-18s indexed %7.2f ms, %5d nodes' %
+              (title + ':', current, len(current_nodes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+"""
+Measures the memory taken by nodes.
+
+Creates N nodes of a few kinds with the default configuration and rq.yaml,
+the way NodeManager does, and reports per node:
+
+- rss: growth of the resident set size of the process
+- objects: size of the objects reachable from the nodes, each object
+  counted once however many nodes refer to it, loggers excluded
+"""
+
+import argparse
+import gc
+import logging
+import os
+import sys
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import configuration  # noqa
+from cudet import nodes  # noqa
+
+
+ROLES = [['controller', 'mongo'], ['compute'], ['compute', 'ceph-osd'],
+         ['cinder'], ['ceph-osd']]
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def make_nodes(conf, count, planner):
+    result = []
+    for i in range(count):
+        # values are new strings for every node, as parsed from Fuel json
+        result.append(nodes.Node(id=i + 1, name=u'node-%d' % (i + 1),
+                                 fqdn=u'node-%d.domain.tld' % (i + 1),
+                                 mac=u'n/a', cluster=i % 4 + 1,
+                                 release=u''.join(u'9.0'),
+                                 roles=[u''.join(r)
+                                        for r in ROLES[i % len(ROLES)]],
+                                 os_platform=u''.join(
+                                     ('ubuntu', 'centos')[i % 2]),
+                                 online=True, status=u''.join(u'ready'),
+                                 ip=u'10.%d.%d.%d' % (i // 65536,
+                                                      i // 256 % 256,
+                                                      i % 256),
+                                 conf=conf, planner=planner))
+    return result
+
+
+def referents(obj):
+    if isinstance(obj, dict):
+        return obj.keys() + obj.values()
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return list(obj)
+    result = []
+    if hasattr(obj, '__dict__'):
+        result.append(obj.__dict__)
+    for slot in getattr(type(obj), '__slots__', []):
+        if hasattr(obj, slot):
+            result.append(getattr(obj, slot))
+    return result
+
+
+def objects_size(roots):
+    seen = set()
+    size = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, logging.Logger):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(referents(obj))
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=10000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    root = os.path.dirname(UTIL_DIR)
+    conf = configuration.get_config()
+    conf['rqdir'] = os.path.join(root, 'rq')
+    conf['rqfile'] = os.path.join(root, 'rq.yaml')
+    nm = nodes.NodeManager.__new__(nodes.NodeManager)
+    nm.conf = conf
+    nm._import_rq()
+    planner = nodes.ConfPlanner(conf)
+    # plans for every kind of node, so that they are not counted
+    make_nodes(conf, len(ROLES) * 2, planner)
+
+    gc.collect()
+    before = rss()
+    result = make_nodes(conf, args.nodes, planner)
+    gc.collect()
+    grown = rss() - before
+    print('%d nodes: rss %d bytes per node, objects %d bytes per node' %
+          (len(result), grown // len(result),
+           objects_size(result) // len(result)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+"""
+Counts ssh handshakes per run with and without connection multiplexing.
+
+Runs the same set of commands against a number of fake nodes through
+cudet.utils.ssh_node, using util/fake-ssh as the ssh binary, once with plain
+ssh options and once with an SSHControlPool.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import utils  # noqa
+
+
+def run(ips, commands, ssh_opts, log):
+    open(log, 'w').close()
+    start = time.time()
+    for ip in ips:
+        for command in commands:
+            utils.ssh_node(ip, command=command, ssh_opts=ssh_opts, timeout=15)
+    elapsed = time.time() - start
+    with open(log) as f:
+        handshakes = len(f.readlines())
+    return handshakes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--scripts', type=int, default=4)
+    parser.add_argument('--delay', default='0.05',
+                        help='emulated handshake time, seconds')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='cudet-bench-')
+    try:
+        os.symlink(os.path.join(UTIL_DIR, 'fake-ssh'),
+                   os.path.join(tmpdir, 'ssh'))
+        os.environ['PATH'] = '%s:%s' % (tmpdir, os.environ['PATH'])
+        os.environ['FAKE_SSH_DELAY'] = args.delay
+        log = os.path.join(tmpdir, 'handshakes.log')
+        os.environ['FAKE_SSH_LOG'] = log
+
+        ips = ['10.20.0.%d' % (i + 2) for i in range(args.nodes)]
+        commands = ['echo %d' % i for i in range(args.scripts)]
+
+        handshakes, elapsed = run(ips, commands, [], log)
+        print('plain ssh:     %5d handshakes, %6.2fs' % (handshakes, elapsed))
+
+        pool = utils.SSHControlPool()
+        try:
+            handshakes, elapsed = run(ips, commands, pool.ssh_opts, log)
+        finally:
+            pool.close()
+        print('ControlMaster: %5d handshakes, %6.2fs' % (handshakes, elapsed))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
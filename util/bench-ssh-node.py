@@ -0,0 +1,50 @@
+#!/usr/bin/env python2
+"""
+Measures per-call overhead of cudet.utils.ssh_node.
+
+Runs a trivial command many times through the local (127.*) path, which
+uses the same wrapper as remote calls but without ssh, and compares it with
+the former wrapper which passed stdin through xxd.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import utils  # noqa
+
+
+def legacy_cmd(command, timeout=15):
+    cmd = " timeout '%s' bash -c  %s" % (timeout, utils.pipes.quote(' ' +
+                                                                    command))
+    return ("input=\"$(cat | xxd -p)\"; trap 'kill $pid' 15; " +
+            "trap 'kill $pid' 2; echo -n \"$input\" | xxd -r -p | " + cmd +
+            ' &:; pid=$!; wait $!')
+
+
+def measure(cmd, count, input=None):
+    start = time.time()
+    for i in range(count):
+        utils.launch_cmd(cmd, 15, input=input)
+    return (time.time() - start) / count * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    for title, input in (('no stdin', None), ('64 KiB stdin', 'x' * 65536)):
+        legacy = measure(legacy_cmd('cat > /dev/null'), args.count, input)
+        current = measure(utils.ssh_node_cmd('127.0.0.1', 'cat > /dev/null'),
+                          args.count, input)
+        print('%-13s xxd wrapper %6.2f ms/call, current %6.2f ms/call' %
+              (title + ':', legacy, current))
+
+
+if __name__ == '__main__':
+    main()
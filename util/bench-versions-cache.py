@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+"""
+Measures preparing the versions databases of this repository for lookups.
+
+For each backend, compiles the caches (cache) or makes the indexed copies
+(index) of all databases one after another, the way VersionsDB and
+VersionsCache do on first use, and with VersionsIndex.load, which does it
+in worker processes at once, then loads what was made. Reports the time
+taken by the largest database alone, which bounds the parallel load given
+enough CPUs, and checks that all give the same data.
+"""
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import versions_db  # noqa
+
+
+def make_index(backend, dbs, cache_dir):
+    index = versions_db.VersionsIndex(backend, cache_dir)
+    for release, os_platform, db_file in dbs:
+        index.add(release, os_platform, db_file)
+    return index
+
+
+def lookup_all(index):
+    """Returns all packages of all databases of index"""
+    result = {}
+    for key, db in index.dbs.items():
+        c = sqlite3.connect(db.db_file)
+        names = [r[0] for r in c.execute('SELECT DISTINCT package_name '
+                                         'FROM versions')]
+        c.close()
+        result[key] = db.packages(names)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=0,
+                        help='worker processes, 0 - as many as CPUs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    root = os.path.dirname(UTIL_DIR)
+    tmpdir = tempfile.mkdtemp(prefix='cudet-bench-')
+    try:
+        dbs = []
+        for src in sorted(glob.glob(os.path.join(root, 'db', 'versions',
+                                                 '*', '*.sqlite'))):
+            c = sqlite3.connect(src)
+            row = c.execute('SELECT release, os FROM versions '
+                            'LIMIT 1').fetchone()
+            c.close()
+            if row is None:
+                continue
+            db_file = os.path.join(tmpdir, '%s-%s.sqlite' % row)
+            shutil.copy(src, db_file)
+            dbs.append((row[0], row[1], db_file))
+
+        print('%d databases, %d CPUs' % (len(dbs),
+                                         multiprocessing.cpu_count()))
+        same = True
+        for backend in ('cache', 'index'):
+            cache_dir = os.path.join(tmpdir, backend)
+            serial = make_index(backend, dbs, cache_dir + '-serial')
+            times = []
+            for db in serial.dbs.values():
+                start = time.time()
+                db.load()
+                times.append(time.time() - start)
+            print('%-28s %6.2fs (largest alone %.2fs)' %
+                  (backend + ', one after another:', sum(times),
+                   max(times)))
+
+            parallel = make_index(backend, dbs, cache_dir)
+            start = time.time()
+            parallel.load(args.processes or None)
+            print('%-28s %6.2fs' % (backend + ', worker processes:',
+                                    time.time() - start))
+
+            warm = make_index(backend, dbs, cache_dir)
+            start = time.time()
+            warm.load()
+            print('%-28s %6.2fs' % (backend + ', already made:',
+                                    time.time() - start))
+
+            result = lookup_all(serial)
+            same &= result == lookup_all(parallel) == lookup_all(warm)
+            versions_db.close_connections()
+        print('same data: %s' % same)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2
+"""
+Measures looking up package versions in a versions database.
+
+Compares loading the whole database into a dict, the way the versions
+analyses did before, with VersionsDB looking up only the packages of a
+node, for a random sample of --packages packages of the database, and with
+VersionsCache compiling the whole database once and reading the compiled
+file on the next runs. Checks that all give the same data. VersionsDB
+looks packages up in an indexed copy of the database it makes on the first
+lookup.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+
+from cudet import versions_db  # noqa
+from cudet.vercmp import vercmp  # noqa
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def legacy_load(db_file):
+    versions_dict = {}
+    import_db = sqlite3.connect(db_file)
+    rows = import_db.execute('''
+        SELECT
+            id,
+            job_id,
+            release,
+            mu,
+            os,
+            package_name,
+            package_version,
+            package_filename
+        FROM versions
+        ORDER BY package_name ASC, mu DESC
+        ''')
+    for row in rows.fetchall():
+        release, mu, os_platform, p_name, p_version = row[2:7]
+        vdr = versions_dict.setdefault(release, {})
+        p_dict = vdr.setdefault(os_platform, {}).setdefault(p_name, {})
+        p_dict.setdefault('mu', set()).add(mu)
+        p_dict.setdefault('versions', {}).setdefault(p_version, set())
+        if 'max_version' not in p_dict:
+            p_dict['max_version'] = p_version
+        else:
+            r = vercmp(os_platform, p_version, p_dict['max_version'])
+            max_v_mus = p_dict['versions'][p_dict['max_version']]
+            if r > 0 and mu in max_v_mus:
+                p_dict['max_version'] = p_version
+        p_dict['versions'][p_version].add(mu)
+    import_db.close()
+    return versions_dict
+
+
+def measure(func):
+    gc.collect()
+    before = rss()
+    start = time.time()
+    result = func()
+    return (time.time() - start) * 1000, (rss() - before) // 1024, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=os.path.join(
+        os.path.dirname(UTIL_DIR), 'db', 'versions', '8.0', 'centos.sqlite'))
+    parser.add_argument('--packages', type=int, default=300)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    tmpdir = tempfile.mkdtemp(prefix='cudet-bench-')
+    try:
+        db_file = os.path.join(tmpdir, 'versions.sqlite')
+        shutil.copy(args.db, db_file)
+        c = sqlite3.connect(db_file)
+        release, os_platform = c.execute('SELECT release, os FROM versions '
+                                         'LIMIT 1').fetchone()
+        names = [r[0] for r in c.execute('SELECT DISTINCT package_name '
+                                         'FROM versions')]
+        c.close()
+        names = random.Random(1).sample(names, min(args.packages,
+                                                   len(names)))
+
+        legacy, legacy_kb, vd = measure(lambda: legacy_load(db_file))
+        vd = vd[release][os_platform]
+        print('%d packages in %s %s' % (len(vd), release, os_platform))
+        print('%-22s %7.1f ms, rss +%d KiB' %
+              ('whole database:', legacy, legacy_kb))
+        del vd
+        results = []
+        cache_dir = os.path.join(tmpdir, 'cache')
+        for title, cls, args in (
+                ('cache, cold:', versions_db.VersionsCache, [cache_dir]),
+                ('cache, warm:', versions_db.VersionsCache, [cache_dir]),
+                ('first lookup:', versions_db.VersionsDB, [cache_dir]),
+                ('indexed lookup:', versions_db.VersionsDB, [cache_dir])):
+            vdb = cls(db_file, release, os_platform, *args)
+            elapsed, kb, result = measure(lambda: vdb.packages(names))
+            print('%-22s %7.1f ms, rss +%d KiB, %d packages' %
+                  (title, elapsed, kb, len(result)))
+            vdb.close()
+            results.append(result)
+        same = legacy_load(db_file)[release][os_platform]
+        same = all([same[n] == result[n] for n in names
+                    for result in results])
+        print('same data: %s' % same)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python2
+"""
+Measures and checks bringing the versions databases up to date.
+
+Starts util/fake-versions-mirror.py with the databases of this repository
+and a local databases directory where some are the same as on the mirror,
+some differ, some are missing and one comes corrupted from the mirror.
+Compares checking them one after another and reading each whole into
+memory to hash it, the way load_versions_dict did before, with
+VersionsSync.sync_all, then runs sync_all again, once all databases are up
+to date, and once more with the mirror down. Exits with 1 if any result is
+not the expected one.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(UTIL_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from cudet import versions_sync  # noqa
+
+
+def legacy_sync(mirror, release, os_platform, db_file):
+    def online(ext):
+        try:
+            return urllib2.urlopen('%s/%s/%s-latest.%s' % (
+                mirror, release, os_platform, ext)).read()
+        except Exception:
+            return None
+
+    if not os.path.isfile(db_file):
+        ext_db = online('sqlite')
+        if ext_db:
+            open(db_file, 'w').write(ext_db)
+        return
+    ext_md5 = online('md5')
+    if ext_md5 and ext_md5.rstrip('\n') != hashlib.md5(
+            open(db_file, 'rb').read()).hexdigest():
+        ext_db = online('sqlite')
+        if ext_db:
+            open(db_file, 'w').write(ext_db)
+
+
+def prepare(tmpdir):
+    """Returns the mirror and local directories and the expected results"""
+    src = os.path.join(ROOT_DIR, 'db', 'versions')
+    mirror = os.path.join(tmpdir, 'mirror')
+    local = os.path.join(tmpdir, 'local')
+    expected = {}
+    for release in ('6.0', '6.1', '7.0', '8.0'):
+        for os_platform in ('centos', 'ubuntu'):
+            name = os.path.join(release, os_platform + '.sqlite')
+            for d in (mirror, local):
+                if not os.path.isdir(os.path.join(d, release)):
+                    os.makedirs(os.path.join(d, release))
+            shutil.copy(os.path.join(src, name), os.path.join(mirror, name))
+            shutil.copy(os.path.join(src, name), os.path.join(local, name))
+            expected[(release, os_platform)] = versions_sync.CURRENT
+    # another database of the same release and OS on the mirror
+    shutil.copy(os.path.join(src, '7.0', 'ubuntu.sqlite'),
+                os.path.join(local, '6.0', 'ubuntu.sqlite'))
+    expected[('6.0', 'ubuntu')] = versions_sync.UPDATED
+    os.remove(os.path.join(local, '6.1', 'centos.sqlite'))
+    expected[('6.1', 'centos')] = versions_sync.DOWNLOADED
+    shutil.copy(os.path.join(src, '7.0', 'ubuntu.sqlite'),
+                os.path.join(local, '6.1', 'ubuntu.sqlite'))
+    expected[('6.1', 'ubuntu')] = versions_sync.UPDATE_FAILED
+    os.makedirs(os.path.join(local, '5.0'))
+    expected[('5.0', 'ubuntu')] = versions_sync.MISSING
+    return mirror, local, expected
+
+
+def dbs(local, expected):
+    return [(r, p, os.path.join(local, r, p + '.sqlite'))
+            for r, p in sorted(expected)]
+
+
+def check(title, elapsed, results, expected):
+    wrong = ['%s %s: %s' % (r, p, result)
+             for (r, p), result in zip(sorted(expected), results)
+             if result != expected[(r, p)]]
+    print('%-22s %6.2fs%s' % (title + ':', elapsed,
+                              ', WRONG ' + '; '.join(wrong) if wrong else ''))
+    return not wrong
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay', default='0.2',
+                        help='seconds each mirror request takes')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    tmpdir = tempfile.mkdtemp(prefix='cudet-bench-')
+    server = None
+    try:
+        mirror_dir, local, expected = prepare(tmpdir)
+        server = subprocess.Popen([sys.executable,
+                                   os.path.join(UTIL_DIR,
+                                                'fake-versions-mirror.py'),
+                                   mirror_dir, '--port', '0',
+                                   '--delay', args.delay,
+                                   '--corrupt', '6.1/ubuntu'],
+                                  stdout=subprocess.PIPE)
+        mirror = 'http://127.0.0.1:%d' % int(server.stdout.readline())
+        ok = True
+
+        legacy_dir = os.path.join(tmpdir, 'legacy')
+        shutil.copytree(local, legacy_dir)
+        start = time.time()
+        for db in dbs(legacy_dir, expected):
+            legacy_sync(mirror, *db)
+        print('%-22s %6.2fs' % ('sequential:', time.time() - start))
+
+        sync = versions_sync.VersionsSync(mirror, timeout=5)
+        start = time.time()
+        results = sync.sync_all(dbs(local, expected))
+        ok &= check('sync_all', time.time() - start, results, expected)
+        for r, p, db_file in dbs(local, expected):
+            if expected[(r, p)] in (versions_sync.UPDATED,
+                                    versions_sync.DOWNLOADED):
+                same = (open(db_file, 'rb').read() ==
+                        open(os.path.join(mirror_dir, r, p + '.sqlite'),
+                             'rb').read())
+                if not same:
+                    print('%s %s differs from the mirror' % (r, p))
+                    ok = False
+            expected[(r, p)] = {
+                versions_sync.UPDATED: versions_sync.CURRENT,
+                versions_sync.DOWNLOADED: versions_sync.CURRENT,
+            }.get(expected[(r, p)], expected[(r, p)])
+
+        start = time.time()
+        results = sync.sync_all(dbs(local, expected))
+        ok &= check('sync_all, again', time.time() - start, results,
+                    expected)
+
+        server.terminate()
+        server.wait()
+        server = None
+        for key in expected:
+            expected[key] = (versions_sync.MISSING
+                             if expected[key] == versions_sync.MISSING
+                             else versions_sync.UNKNOWN)
+        start = time.time()
+        results = sync.sync_all(dbs(local, expected))
+        ok &= check('sync_all, mirror down', time.time() - start, results,
+                    expected)
+        leftovers = [n for r in os.listdir(local)
+                     for n in os.listdir(os.path.join(local, r))
+                     if n.startswith('.')]
+        if leftovers:
+            print('temporary files left: %s' % ', '.join(leftovers))
+            ok = False
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmpdir)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+"""
+Local stand-in for the Fuel API used by util/bench-discovery.py.
+
+Serves GET /api/v1/version, /api/v1/nodes and /api/v1/clusters for a fake
+environment of --nodes nodes in --clusters clusters. Every request takes
+--delay seconds and every new connection --connect-delay seconds more, to
+emulate Nailgun and the connection setup. HTTP/1.1 keep-alive is
+supported. GET /stats returns the number of connections and requests
+served so far. The port listened on is printed on the first line of
+stdout, --port 0 picks a free one.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import sys
+import threading
+import time
+
+
+def make_inventory(nodes, clusters, release='9.0'):
+    """Returns the API responses of a fake environment by path"""
+    cluster_list = [{'id': i + 1,
+                     'name': 'env-%d' % (i + 1),
+                     'fuel_version': release,
+                     'status': 'operational'} for i in range(clusters)]
+    node_list = []
+    for i in range(nodes):
+        node_list.append({'id': i + 1,
+                          'cluster': i % clusters + 1 if clusters else None,
+                          'name': 'node-%d' % (i + 1),
+                          'fqdn': 'node-%d.domain.tld' % (i + 1),
+                          'mac': '52:54:00:%02x:%02x:%02x' % (
+                              i // 65536 % 256, i // 256 % 256, i % 256),
+                          'ip': '10.%d.%d.%d' % (20 + i // 65536,
+                                                 i // 256 % 256, i % 256),
+                          'roles': ['controller'] if i < 3 else ['compute'],
+                          'os_platform': 'ubuntu',
+                          'status': 'ready',
+                          'online': True})
+    return {'/api/v1/version': {'release': release,
+                                'api': '1',
+                                'auth_required': False},
+            '/api/v1/nodes': node_list,
+            '/api/v1/clusters': cluster_list}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+        time.sleep(self.server.connect_delay)
+
+    def do_GET(self):
+        self.server.count('requests')
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/stats':
+            data = dict(self.server.stats)
+        elif path in self.server.responses:
+            time.sleep(self.server.delay)
+            data = self.server.responses[path]
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeFuelAPI(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, responses, delay=0.1, connect_delay=0.1):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.responses = responses
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'requests': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--clusters', type=int, default=2)
+    parser.add_argument('--delay', type=float, default=0.1,
+                        help='seconds each request takes')
+    parser.add_argument('--connect-delay', type=float, default=0.1,
+                        help='seconds each new connection takes')
+    args = parser.parse_args()
+
+    server = FakeFuelAPI((args.host, args.port),
+                         make_inventory(args.nodes, args.clusters),
+                         args.delay, args.connect_delay)
+    sys.stdout.write('%d\n' % server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+"""
+Local stand-in for the versions databases mirror used by
+util/bench-versions-sync.py.
+
+Serves GET /<release>/<os>-latest.sqlite from <dir>/<release>/<os>.sqlite
+and GET /<release>/<os>-latest.md5 with its md5. Every request takes
+--delay seconds. Databases listed in --corrupt, as <release>/<os>, are
+served with a byte changed, so that they do not match their md5. The port
+listened on is printed on the first line of stdout, --port 0 picks a free
+one.
+"""
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import os
+import SocketServer
+import sys
+import time
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        path = self.path.split('?')[0].strip('/')
+        name, ext = os.path.splitext(path)
+        if not name.endswith('-latest') or ext not in ('.sqlite', '.md5'):
+            self.send_error(404)
+            return
+        name = name[:-len('-latest')]
+        db_file = os.path.join(self.server.directory, name + '.sqlite')
+        if not os.path.isfile(db_file):
+            self.send_error(404)
+            return
+        with open(db_file, 'rb') as f:
+            body = f.read()
+        if ext == '.md5':
+            body = '%s\n' % hashlib.md5(body).hexdigest()
+        elif name in self.server.corrupt:
+            body = body[:-1] + chr((ord(body[-1]) + 1) % 256)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMirror(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory, delay=0.1, corrupt=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.directory = directory
+        self.delay = delay
+        self.corrupt = set(corrupt or [])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--delay', type=float, default=0.1,
+                        help='seconds each request takes')
+    parser.add_argument('--corrupt', nargs='*', default=[],
+                        help='databases served not matching their md5')
+    args = parser.parse_args()
+
+    server = FakeMirror((args.host, args.port), args.dir, args.delay,
+                        args.corrupt)
+    sys.stdout.write('%d\n' % server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()